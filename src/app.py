@@ -1,21 +1,29 @@
-import time
+import asyncio
+import functools
 import os
+import time
 import uuid
 
+from contextlib import asynccontextmanager
+
 import dotenv
 
-from fastapi import FastAPI
+from fastapi import FastAPI, HTTPException, Request
+from fastapi.responses import PlainTextResponse
 from langchain_core.messages import HumanMessage
 from langchain_core.output_parsers import StrOutputParser, PydanticOutputParser
-from langchain_core.runnables import RunnablePassthrough, RunnableConfig
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough, RunnableConfig
 from langchain_openai import ChatOpenAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.globals import set_debug
 
 from langfuse import get_client, propagate_attributes
 
-from rag.embedder import Embedder
-from rag.vector_store import ChromaStore, QdrantStore
+from rag.benchmark import atime_search, latency_summary
+from rag.answer_cache import SemanticAnswerCache
+from rag.context import ContextPacker, load_encoding
+from rag.metrics import REGISTRY as METRICS, LLMMetricsCallback, time_stage
+from rag.registry import StoreRegistry
 
 from prompts.prompts import get_basic_rag_prompt, get_query_cat_prompt
 
@@ -30,108 +38,209 @@ dotenv.load_dotenv('../.env')
 
 langfuse_client = get_client()
 
-llm = ChatOpenAI(
-    api_key=os.environ['API_KEY'],
-    base_url=os.environ['API_BASE_URL'],
-    temperature=0.0,
-    model='qwen-3-32b'
+@functools.cache
+def _get_llm():
+    return ChatOpenAI(
+        api_key=os.environ['API_KEY'],
+        base_url=os.environ['API_BASE_URL'],
+        temperature=0.0,
+        model='qwen-3-32b',
+        callbacks=[LLMMetricsCallback()],
+    )
+
+# stores are built on first use, so e.g. an unreachable Qdrant does not block Chroma-only traffic
+# 'lexical' loads the BM25 index built by prepare_storage_*.py and sets the reciprocal-rank fusion weights
+LEXICAL_FUSION = {'dense_weight': 1.0, 'lexical_weight': 1.0, 'rrf_k': 60, 'candidates': 50}
+# 'classifier' loads the category centroids built by prepare_storage_*.py; less confident queries go to the LLM
+CATEGORY_CLASSIFIER = {'min_confidence': float(os.environ.get('RAG_CLASSIFIER_MIN_CONFIDENCE', '0.6')),
+                       'coverage': 0.9, 'max_categories': 3}
+STORES_CONFIG = {
+    'chroma_bad': {'type': 'chroma', 'construction_ef': 4, 'M': 2, 'search_ef': 1, 'lexical': LEXICAL_FUSION,
+                   'classifier': CATEGORY_CLASSIFIER},
+    'chroma_good': {'type': 'chroma', 'construction_ef': 100, 'M': 16, 'search_ef': 10, 'lexical': LEXICAL_FUSION},
+    'qdrant_bad': {'type': 'qdrant', 'construction_ef': 4, 'M': 2, 'search_ef': 1, 'need_setup': False, 'lexical': LEXICAL_FUSION},
+    'qdrant_good': {'type': 'qdrant', 'construction_ef': 100, 'M': 16, 'search_ef': 10, 'need_setup': False, 'lexical': LEXICAL_FUSION},
+}
+# which stores to warm up before the app reports ready (comma separated, empty = none)
+WARMUP_STORES = os.environ.get('RAG_WARMUP_STORES', 'chroma_good,chroma_bad')
+
+# concurrent requests embed their queries in one model call (1 = every query on its own)
+registry = StoreRegistry(STORES_CONFIG, embedder_kwargs={
+    'model': 'BAAI/bge-m3',
+    'query_batch_size': int(os.environ.get('RAG_QUERY_BATCH_SIZE', '8')),
+    'query_batch_wait_ms': float(os.environ.get('RAG_QUERY_BATCH_WAIT_MS', '5')),
+})
+
+answer_cache = SemanticAnswerCache(
+    threshold=float(os.environ.get('RAG_ANSWER_CACHE_THRESHOLD', '0.95')),
+    max_entries=int(os.environ.get('RAG_ANSWER_CACHE_SIZE', '2048')),
+    ttl=float(os.environ.get('RAG_ANSWER_CACHE_TTL', '3600')),
 )
 
-embedder = Embedder(model='BAAI/bge-m3')
-store_chroma_bad = ChromaStore(embedder=embedder.get_model(), construction_ef=4, M=2, search_ef=1)
-store_chroma_good = ChromaStore(embedder=embedder.get_model(), construction_ef=100, M=16, search_ef=10)
-store_qdrant_bad  = QdrantStore(embedder=embedder.get_model(), construction_ef=4, M=2, search_ef=1, need_setup=False)
-store_qdrant_good = QdrantStore(embedder=embedder.get_model(), construction_ef=100, M=16, search_ef=10, need_setup=False)
+# retrieved chunks are merged, deduplicated and cut to this many prompt tokens
+context_packer = ContextPacker(max_tokens=int(os.environ.get('RAG_CONTEXT_TOKENS', '3000')))
+
+# With `gunicorn --preload -k uvicorn.workers.UvicornWorker` this runs once in the master process
+# and the workers share the loaded model pages.
+if os.environ.get('RAG_PRELOAD_MODEL') == '1':
+    registry.preload()
 
 def _get_vector_store():
-    return store_chroma_good
+    return registry.get('chroma_good')
 
 def _get_bad_vector_store():
-    return store_chroma_bad
+    return registry.get('chroma_bad')
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    names = [name for name in WARMUP_STORES.split(',') if name]
+    await asyncio.get_running_loop().run_in_executor(None, load_encoding)
+    await registry.awarm_up(names)
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+HTTP_IN_FLIGHT = METRICS.gauge('rag_http_requests_in_flight', 'HTTP requests being served')
+HTTP_SECONDS = METRICS.histogram('rag_http_request_seconds', 'HTTP request latency', ('route', 'method', 'status'))
+CHAIN_IN_FLIGHT = METRICS.gauge('rag_chain_in_flight', 'RAG chains being answered', ('chain',))
+CATEGORY_ROUTES = METRICS.counter('rag_category_routing_total', 'Queries routed by the local classifier or the LLM', ('route',))
+
+def _collect_cache_metrics():
+    caches = {'answer': answer_cache.get_stats()}
+    embedder = registry.get_loaded_embedder()
+    if embedder is not None and embedder.get_query_cache() is not None:
+        caches['query_embedding'] = embedder.get_query_cache().get_stats()
+    families = [
+        ('rag_cache_hits_total', 'counter', 'Cache hits', 'hits'),
+        ('rag_cache_misses_total', 'counter', 'Cache misses', 'misses'),
+        ('rag_cache_entries', 'gauge', 'Entries held by the cache', 'entries'),
+    ]
+    result = [
+        (name, kind, help, [({'cache': cache}, stats.get(key, stats.get('size', 0))) for cache, stats in caches.items()])
+        for name, kind, help, key in families
+    ]
+    result.append(('rag_cache_hit_ratio', 'gauge', 'Cache hits / lookups since start', [
+        ({'cache': cache}, stats['hits'] / (stats['hits'] + stats['misses']) if stats['hits'] + stats['misses'] else 0.0)
+        for cache, stats in caches.items()
+    ]))
+    return result
+
+METRICS.add_collector(_collect_cache_metrics)
+
+@app.middleware("http")
+async def _track_requests(request: Request, call_next):
+    status = 500
+    start = time.perf_counter()
+    with HTTP_IN_FLIGHT.track():
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            # the route template keeps label cardinality bounded, unknown paths share one series
+            route = request.scope.get('route')
+            HTTP_SECONDS.observe(time.perf_counter() - start, route=getattr(route, 'path', 'unmatched'),
+                                 method=request.method, status=status)
+
+async def simple_llm(query:str, llm_cfg):
+    return await (ChatPromptTemplate.from_messages([HumanMessage(query)]) | _get_llm() | StrOutputParser()).ainvoke({}, config=llm_cfg)
+
+async def _with_answer_cache(chain: str, vector_storage, query: str, answer):
+    # near-identical questions to the same chain and store reuse the previous LLM answer
+    loop = asyncio.get_running_loop()
+    with CHAIN_IN_FLIGHT.track(chain=chain):
+        vector = await vector_storage.aembed_query(query)
+        with time_stage('answer_cache_lookup', vector_storage.get_name()):
+            cached = await loop.run_in_executor(None, answer_cache.lookup, chain, vector_storage, vector)
+        if cached is not None:
+            return cached
+        with time_stage(f'chain_{chain}', vector_storage.get_name()):
+            result = await answer()
+        await loop.run_in_executor(None, answer_cache.insert, chain, vector_storage, vector, result)
+        return result
+
+async def simple_rag(query: str, llm_cfg, vector_storage=None):
+    if vector_storage is None:
+        vector_storage = _get_vector_store()
 
-app = FastAPI()
+    async def _answer():
+        splits = await vector_storage.afind_splits(query, 15)
+        context = context_packer.format(splits)
+        return await (get_basic_rag_prompt() | _get_llm() | StrOutputParser()).ainvoke({'context': context, 'query': query}, config=llm_cfg)
 
-def simple_llm(query:str, llm_cfg):
-    return (ChatPromptTemplate.from_messages([HumanMessage(query)]) | llm | StrOutputParser()).invoke({}, config=llm_cfg)
+    return await _with_answer_cache('simple_rag', vector_storage, query, _answer)
 
-def simple_rag(query: str, llm_cfg, vector_storage=None):
-    if vector_storage is None:
-        vector_storage = _get_vector_store()
-    splits = vector_storage.find_splits(query, 15)
-    context = ''.join([f"<document>{doc.page_content}</document>" for (doc, score) in splits])
-    return (get_basic_rag_prompt() | llm | StrOutputParser()).invoke({'context': context, 'query': query}, config=llm_cfg)
+async def hallucinations_check(query:str, llm_cfg):
+    return await simple_rag(query, llm_cfg, _get_bad_vector_store())
 
-def hallucinations_check(query:str, llm_cfg):
-    return simple_rag(query, llm_cfg, _get_bad_vector_store())
+async def simple_rag_mmr(query: str, llm_cfg):
+    vector_storage = _get_vector_store()
 
-def simple_rag_mmr(query: str, llm_cfg):
-    retriever = _get_vector_store().get_retriever(search_type='mmr', limit=15, fetch_limit=70)
-    splits = retriever.invoke(query)
-    context = ''.join([f"<document>{doc.page_content}</document>" for doc in splits])
-    return (get_basic_rag_prompt() | llm | StrOutputParser()).invoke({'context': context, 'query': query}, config=llm_cfg)
+    async def _answer():
+        retriever = vector_storage.get_retriever(search_type='mmr', limit=15, fetch_limit=70)
+        splits = await retriever.ainvoke(query)
+        context = context_packer.format(splits)
+        return await (get_basic_rag_prompt() | _get_llm() | StrOutputParser()).ainvoke({'context': context, 'query': query}, config=llm_cfg)
 
-def _format_context(splits):
-    context = ''.join([f"<document>{doc.page_content}</document>" for doc in splits])
-    return context
+    return await _with_answer_cache('simple_rag_mmr', vector_storage, query, _answer)
 
-def rag_with_hyde(query: str, llm_cfg):
-    retriever = _get_vector_store().get_retriever(limit=15)
+async def rag_with_hyde(query: str, llm_cfg):
+    vector_storage = _get_vector_store()
+    retriever = vector_storage.get_retriever(limit=15)
 
-    def _get_hyde_output(query: str):
-        return (ChatPromptTemplate.from_messages([HumanMessage(query)]) | llm | StrOutputParser()).invoke({},
-                                                                                                          config=llm_cfg)
+    async def _get_hyde_output(query: str):
+        return await (ChatPromptTemplate.from_messages([HumanMessage(query)]) | _get_llm() | StrOutputParser()).ainvoke({},
+                                                                                                                 config=llm_cfg)
 
     chain = (
             {
                 "query": RunnablePassthrough(),
-                "context": _get_hyde_output | retriever | _format_context,
+                "context": RunnableLambda(_get_hyde_output) | retriever | context_packer.format,
             }
             | get_basic_rag_prompt()
-            | llm
+            | _get_llm()
             | StrOutputParser()
     )
-    return chain.invoke(query, config=llm_cfg)
+    return await _with_answer_cache('rag_with_hyde', vector_storage, query, lambda: chain.ainvoke(query, config=llm_cfg))
 
-def rag_with_hyde_mmr(query: str, llm_cfg):
-    retriever = _get_vector_store().get_retriever(search_type='mmr', limit=15, fetch_limit=70)
+async def rag_with_hyde_mmr(query: str, llm_cfg):
+    vector_storage = _get_vector_store()
+    retriever = vector_storage.get_retriever(search_type='mmr', limit=15, fetch_limit=70)
 
-    def _get_hyde_output(query: str):
-        return (ChatPromptTemplate.from_messages([HumanMessage(query)]) | llm | StrOutputParser()).invoke({},
-                                                                                                          config=llm_cfg)
+    async def _get_hyde_output(query: str):
+        return await (ChatPromptTemplate.from_messages([HumanMessage(query)]) | _get_llm() | StrOutputParser()).ainvoke({},
+                                                                                                                 config=llm_cfg)
 
     chain = (
             {
                 "query": RunnablePassthrough(),
-                "context": _get_hyde_output | retriever | _format_context,
+                "context": RunnableLambda(_get_hyde_output) | retriever | context_packer.format,
             }
             | get_basic_rag_prompt()
-            | llm
+            | _get_llm()
             | StrOutputParser()
     )
-    return chain.invoke(query, config=llm_cfg)
-
-def _naive_search(vector_store, query:str, limit:int=5, cycles=10):
-    splits = []
-    start = time.time()
-    for _ in range(cycles):
-        splits = vector_store.find_splits(query, limit)
-    end = time.time()
+    return await _with_answer_cache('rag_with_hyde_mmr', vector_storage, query, lambda: chain.ainvoke(query, config=llm_cfg))
+
+async def _naive_search(vector_store, query:str, limit:int=5, cycles=10, vector=None):
+    splits, latencies = await atime_search(vector_store, query, limit, cycles, vector)
     resp = []
     for i, (document, score) in enumerate(splits):
         resp.append({'document': document, 'score': score})
-    return {'documents': resp, 'timing': end - start}
+    # full recall / concurrency benchmark lives in benchmark_search.py
+    return {'documents': resp, 'timing': sum(latencies), 'latency': latency_summary(latencies)}
 
-def naive_chroma_search_good(query:str, limit:int=5, cycles=10):
-    return _naive_search(store_chroma_good, query, limit, cycles)
+async def naive_chroma_search_good(query:str, limit:int=5, cycles=10, vector=None):
+    return await _naive_search(registry.get('chroma_good'), query, limit, cycles, vector)
 
-def naive_chroma_search_bad(query:str, limit:int=5, cycles=10):
-    return _naive_search(store_chroma_bad, query, limit, cycles)
+async def naive_chroma_search_bad(query:str, limit:int=5, cycles=10, vector=None):
+    return await _naive_search(registry.get('chroma_bad'), query, limit, cycles, vector)
 
-def naive_qdrant_search_good(query:str, limit:int=5, cycles=10):
-    return _naive_search(store_qdrant_good, query, limit, cycles)
+async def naive_qdrant_search_good(query:str, limit:int=5, cycles=10, vector=None):
+    return await _naive_search(registry.get('qdrant_good'), query, limit, cycles, vector)
 
-def naive_qdrant_search_bad(query:str, limit:int=5, cycles=10):
-    return _naive_search(store_qdrant_bad, query, limit, cycles)
+async def naive_qdrant_search_bad(query:str, limit:int=5, cycles=10, vector=None):
+    return await _naive_search(registry.get('qdrant_bad'), query, limit, cycles, vector)
 
 class Category(str, Enum):
     astro_ph = 'astro-ph'
@@ -157,29 +266,69 @@ class Category(str, Enum):
 class SearchCategories(BaseModel):
     categories: list[Category] = Field(description='Categories of query, which fit the most')
 
-def rag_with_hybrid_search(query: str, llm_cfg):
+async def _llm_categories(query: str, llm_cfg):
     parser = PydanticOutputParser(pydantic_object=SearchCategories)
-
-    categories = (get_query_cat_prompt() | llm | parser).invoke({
+    categories = await (get_query_cat_prompt() | _get_llm() | parser).ainvoke({
             'query': query,
             'format_instruction': parser.get_format_instructions()
         },
         config=llm_cfg)
-
-    categories = [str(c).split('.')[1] for c in categories.categories]
+    # stored categories are the enum values ('astro-ph'), not the member names
+    return [c.value for c in categories.categories]
+
+async def rag_with_hybrid_search(query: str, llm_cfg):
+    store = _get_bad_vector_store()
+
+    vector = await store.aembed_query(query)
+    # the centroid classifier answers in microseconds, the LLM round trip is only paid when it is unsure
+    categories = store.classify_query(vector)
+    if categories is None:
+        CATEGORY_ROUTES.inc(route='llm')
+        with time_stage('llm_classify', store.get_name()):
+            categories = await _llm_categories(query, llm_cfg)
+    else:
+        CATEGORY_ROUTES.inc(route='classifier')
 
     print(categories)
-    split = _get_bad_vector_store().find_splits(query, limit=5, categories=categories)
+    with time_stage('hybrid_search', store.get_name()):
+        split = await store.afind_splits_hybrid(query, limit=5, categories=categories, vector=vector)
 
     return split
 
 
+class BatchSearchQuery(BaseModel):
+    query: str
+    k: int = Field(default=5, ge=1, le=1000)
+    categories: list[str] | None = None
+
+class BatchSearchRequest(BaseModel):
+    queries: list[BatchSearchQuery]
+    store: str = 'chroma_good'
+    # Qdrant only: a tier ('default', 'fast', 'accurate', 'exact') or {'hnsw_ef', 'exact', 'rescore', 'oversampling'}
+    search_params: str | dict | None = None
+    # MMR over that many nearest splits per query (None = plain similarity search)
+    mmr_fetch_k: int | None = None
+    lambda_mult: float = 0.5
+
+
 @app.get("/")
-def root():
-    return {"status": "ok"}
+async def root():
+    return {"status": "ok" if registry.is_ready() else "starting"}
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def metrics():
+    return PlainTextResponse(METRICS.render(), media_type='text/plain; version=0.0.4')
+
+@app.get("/cache/stats")
+async def cache_stats():
+    # stats only, must not load the model on a cold worker
+    embedder = registry.get_loaded_embedder()
+    query_cache = embedder.get_query_cache() if embedder is not None else None
+    return {'answer_cache': answer_cache.get_stats(),
+            'query_embedding_cache': query_cache.get_stats() if query_cache is not None else None}
 
 @app.get("/test")
-def test_endpoint():
+async def test_endpoint():
     session_id = uuid.uuid4().hex
     llm_cfg: RunnableConfig = {
         'configurable': {'thread_id': session_id},
@@ -187,19 +336,58 @@ def test_endpoint():
     }
     query = 'Which parameters help predict oil consumption?'
     #query = 'Which star is the closest to Earth?'
+    # all stores share the same embedding model, embed the query once
+    vector = await _get_vector_store().aembed_query(query)
     with langfuse_client.start_as_current_observation(as_type='span', name='langchain_call'):
         with propagate_attributes(session_id=session_id):
+            tasks = {
+                'chroma_naive_good': naive_chroma_search_good(query, vector=vector),
+                'chroma_naive_bad': naive_chroma_search_bad(query, vector=vector),
+                'qdrant_naive_good': naive_qdrant_search_good(query, vector=vector),
+                'qdrant_naive_bad': naive_qdrant_search_bad(query, vector=vector),
+                #'simple_llm_answer': simple_llm(query, llm_cfg),
+                #'simple_rag_answer': simple_rag(query, llm_cfg),
+                #'simple_rag_mmr_answer': simple_rag_mmr(query, llm_cfg),
+                #'rag_with_hyde_answer': rag_with_hyde(query, llm_cfg),
+                #'rag_with_hyde_mmr_answer': rag_with_hyde_mmr(query, llm_cfg),
+                'rag_with_hybrid_search_answer_with_bad_index': rag_with_hybrid_search(query, llm_cfg),
+                #'hallucinations_check': hallucinations_check(query, llm_cfg),
+            }
+            results = await asyncio.gather(*tasks.values())
             return {'status': 'ok',
                     'query': query,
-                    'chroma_naive_good': naive_chroma_search_good(query),
-                    'chroma_naive_bad': naive_chroma_search_bad(query),
-                    'qdrant_naive_good': naive_qdrant_search_good(query),
-                    'qdrant_naive_bad': naive_qdrant_search_bad(query),
-                    #'simple_llm_answer': simple_llm(query, llm_cfg),
-                    #'simple_rag_answer': simple_rag(query, llm_cfg),
-                    #'simple_rag_mmr_answer': simple_rag_mmr(query, llm_cfg),
-                    #'rag_with_hyde_answer': rag_with_hyde(query, llm_cfg),
-                    #'rag_with_hyde_mmr_answer': rag_with_hyde_mmr(query, llm_cfg),
-                    'rag_with_hybrid_search_answer_with_bad_index': rag_with_hybrid_search(query, llm_cfg),
-                    #'hallucinations_check': hallucinations_check(query, llm_cfg),
+                    **dict(zip(tasks.keys(), results)),
                     }
+
+
+@app.post("/search/batch")
+async def search_batch(request: BatchSearchRequest):
+    if request.store not in registry.names():
+        raise HTTPException(status_code=404, detail=f"Unknown store {request.store}")
+    if request.search_params is not None and registry.get_type(request.store) != 'qdrant':
+        raise HTTPException(status_code=400, detail=f"search_params are only supported by Qdrant stores, "
+                                                    f"{request.store} is {registry.get_type(request.store)}")
+    store = registry.get(request.store)
+    if request.search_params is not None:
+        # an unknown tier or key is the caller's mistake, not a server error
+        try:
+            store.resolve_search_params(request.search_params)
+        except Exception as e:
+            raise HTTPException(status_code=400, detail=str(e))
+    queries = [q.query for q in request.queries]
+    limits = [q.k for q in request.queries]
+    categories = [q.categories for q in request.queries]
+    if request.mmr_fetch_k is not None:
+        results = await store.afind_splits_mmr_batch(queries, limits=limits,
+                                                     fetch_limits=[max(request.mmr_fetch_k, k) for k in limits],
+                                                     lambda_mult=request.lambda_mult, categories=categories,
+                                                     search_params=request.search_params)
+    else:
+        results = await store.afind_splits_batch(queries, limits=limits, categories=categories,
+                                                 search_params=request.search_params)
+    return {'status': 'ok',
+            'store': request.store,
+            'results': [
+                [{'document': document, 'score': score} for document, score in splits]
+                for splits in results
+            ]}
@@ -0,0 +1,54 @@
+import argparse
+
+import dotenv
+
+from rag.benchmark import build_store, copy_vectors, ground_truth, run_store, sample_queries, write_report
+from rag.embedder import Embedder
+from rag.vector_store import NumpyStore
+
+dotenv.load_dotenv('../.env')
+
+# одна и та же конфигурация HNSW в трёх раскладках: фильтр по индексу, is_tenant, коллекция на категорию
+DEFAULT_STORES = 'qdrant:100:16:10,qdrant:100:16:10:tenant,qdrant:100:16:10:collections'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Category-filtered search latency across Qdrant partitioning layouts')
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--concurrency', default='1,8')
+    parser.add_argument('--stores', default=DEFAULT_STORES)
+    parser.add_argument('--exact-path', default=None)
+    parser.add_argument('--qdrant-location', default=None)
+    parser.add_argument('--populate', action='store_true', help='rebuild every layout from the exact store vectors first')
+    parser.add_argument('--output', default='../bench/filters')
+    args = parser.parse_args()
+
+    embedder = Embedder(model='BAAI/bge-m3')
+    exact_store = NumpyStore(embedder=embedder.get_model(), path=args.exact_path)
+
+    # every query is filtered by the category of the chunk it was sampled from
+    queries, categories = sample_queries(exact_store, n=args.sample, with_categories=True)
+    categories = [[c] for c in categories]
+    vectors = embedder.get_model().embed_documents(queries)
+    truth = {True: ground_truth(exact_store, vectors, args.k, categories=categories),
+             False: ground_truth(exact_store, vectors, args.k)}
+
+    rows = []
+    for spec in args.stores.split(','):
+        store = build_store(spec, embedder.get_model(), args.qdrant_location)
+        if args.populate:
+            copy_vectors(exact_store, store)
+        for concurrency in (int(c) for c in args.concurrency.split(',')):
+            for filtered in (True, False):
+                row = run_store(store, queries, vectors, truth[filtered], k=args.k, concurrency=concurrency, categories=categories if filtered else None)
+                row['spec'] = spec
+                row['filtered'] = filtered
+                print(row)
+                rows.append(row)
+
+    write_report(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+import argparse
+
+import dotenv
+
+from rag.benchmark import build_store, copy_vectors, ground_truth, load_queries, run_store, sample_queries, write_report
+from rag.embedder import Embedder
+from rag.vector_store import NumpyStore
+
+dotenv.load_dotenv('../.env')
+
+DEFAULT_STORES = 'chroma:4:2:1,chroma:100:16:10,qdrant:4:2:1,qdrant:100:16:10'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Recall / latency benchmark of the vector stores')
+    parser.add_argument('--queries', help='file with queries (one per line or JSONL with "query"), sampled from the corpus if omitted')
+    parser.add_argument('--sample', type=int, default=200, help='number of queries sampled from the corpus')
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--concurrency', default='1,4,16')
+    parser.add_argument('--stores', default=DEFAULT_STORES)
+    parser.add_argument('--exact-path', default=None, help='NumpyStore directory used as ground truth')
+    parser.add_argument('--qdrant-location', default=None, help="':memory:' or a path for embedded Qdrant, QDRANT_URL otherwise")
+    parser.add_argument('--tiers', default='default', help='comma separated search tiers (default, fast, accurate, exact) run per store')
+    parser.add_argument('--populate', action='store_true', help='rebuild the stores from the exact store vectors first')
+    parser.add_argument('--output', default='../bench/search')
+    args = parser.parse_args()
+
+    embedder = Embedder(model='BAAI/bge-m3')
+    exact_store = NumpyStore(embedder=embedder.get_model(), path=args.exact_path)
+
+    queries = load_queries(args.queries) if args.queries else sample_queries(exact_store, n=args.sample)
+    print(f"{len(queries)} queries")
+    vectors = embedder.get_model().embed_documents(queries)
+    truth = ground_truth(exact_store, vectors, args.k)
+
+    rows = []
+    for spec in args.stores.split(','):
+        store = exact_store if spec == 'numpy' else build_store(spec, embedder.get_model(), args.qdrant_location)
+        if args.populate and store is not exact_store:
+            copy_vectors(exact_store, store)
+        # only Qdrant has search-time tiers, the other stores run once
+        tiers = args.tiers.split(',') if spec.startswith('qdrant') else [None]
+        for tier in tiers:
+            for concurrency in (int(c) for c in args.concurrency.split(',')):
+                row = run_store(store, queries, vectors, truth, k=args.k, concurrency=concurrency, search_params=tier)
+                row['spec'] = spec
+                print(row)
+                rows.append(row)
+
+    write_report(rows, args.output)
+
+
+if __name__ == "__main__":
+    main()
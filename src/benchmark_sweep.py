@@ -0,0 +1,143 @@
+import argparse
+import itertools
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import dotenv
+
+from rag.benchmark import (build_store, copy_vectors, dir_size, estimate_index_memory, ground_truth, load_queries,
+                           run_store, sample_queries, write_report)
+from rag.embedder import Embedder
+from rag.ingest import prepare_store
+from rag.vector_store import NumpyStore
+
+dotenv.load_dotenv('../.env')
+
+
+def _ints(value):
+    return [int(v) for v in value.split(',')]
+
+
+def prepare_exact_store(args, embedder):
+    # The exact store holds the one embedding pass every grid point is built from.
+    # Missing or stale documents are (re)embedded, the embedding cache makes repeated passes cheap.
+    exact_store = NumpyStore(embedder=embedder.get_model(), path=args.exact_path)
+    if args.ingest or exact_store.count() == 0:
+        prepare_store(exact_store, embedder.get_model_name(), data_path=args.data, build_lexical_index=False,
+                      build_category_classifier=False, chunk_size=args.chunk_size, chunk_overlap=args.chunk_overlap,
+                      batch_size=256)
+    return exact_store
+
+
+def build_grid_point(exact_store, store, backend, construction_ef, M, args):
+    stats = copy_vectors(exact_store, store, bulk=True)
+    row = {
+        'backend': backend,
+        'construction_ef': construction_ef,
+        'M': M,
+        'store': store.get_name(),
+        'vectors': stats['vectors'],
+        'build_seconds': stats['total_seconds'],
+        'load_seconds': stats['load_seconds'],
+        'index_seconds': stats['index_seconds'],
+        'disk_bytes': None,
+    }
+    dim = exact_store.get_dim()
+    # estimated_memory_bytes is computed from the index parameters (estimate_index_memory), not measured
+    if backend == 'chroma':
+        row['disk_bytes'] = dir_size(store.get_persist_directory())
+        row['estimated_memory_bytes'] = estimate_index_memory(stats['vectors'], dim, M)
+    else:
+        collections = [os.path.join(args.qdrant_storage, 'collections', c) for c in store.get_collection_names()]
+        if all(os.path.isdir(c) for c in collections):
+            row['disk_bytes'] = sum(dir_size(c) for c in collections)
+        row['estimated_memory_bytes'] = estimate_index_memory(stats['vectors'], dim, M, args.qdrant_quantization)
+        row.update(store.get_collection_stats())
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build one index per HNSW grid point from a single embedding pass, '
+                                                 'then measure size, recall and latency')
+    parser.add_argument('--backends', default='chroma,qdrant')
+    parser.add_argument('--construction-ef', default='16,64,128', type=_ints)
+    parser.add_argument('--M', default='4,16,32', type=_ints)
+    parser.add_argument('--search-ef', default='10,32,128', type=_ints)
+    parser.add_argument('--queries', help='file with queries (one per line or JSONL with "query"), sampled from the corpus if omitted')
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--recall-target', type=float, default=0.95)
+    parser.add_argument('--build-workers', type=int, default=2, help='grid points built at the same time')
+    parser.add_argument('--exact-path', default=None, help='NumpyStore directory with the corpus vectors')
+    parser.add_argument('--ingest', action='store_true', help='bring the exact store up to date with the dataset first')
+    parser.add_argument('--data', default='../data')
+    parser.add_argument('--chunk-size', type=int, default=1000)
+    parser.add_argument('--chunk-overlap', type=int, default=200)
+    parser.add_argument('--qdrant-storage', default='../qdrant_storage', help='Qdrant storage mount, for disk usage')
+    parser.add_argument('--qdrant-quantization', default='scalar', choices=['scalar', 'binary', 'none'])
+    parser.add_argument('--cleanup', action='store_true', help='drop the sweep collections afterwards')
+    parser.add_argument('--output', default='../bench/sweep')
+    args = parser.parse_args()
+    args.qdrant_quantization = None if args.qdrant_quantization == 'none' else args.qdrant_quantization
+
+    embedder = Embedder(model='BAAI/bge-m3', cache_dir='../embedding_cache')
+    exact_store = prepare_exact_store(args, embedder)
+
+    queries = load_queries(args.queries) if args.queries else sample_queries(exact_store, n=args.sample)
+    vectors = embedder.get_model().embed_documents(queries)
+    truth = ground_truth(exact_store, vectors, args.k)
+    print(f"{len(queries)} queries, {exact_store.count()} vectors")
+
+    # Qdrant takes hnsw_ef per request, so one collection serves every search_ef of a (construction_ef, M) pair;
+    # Chroma fixes search_ef in the collection metadata and needs a collection per full grid point
+    points = []
+    for backend in args.backends.split(','):
+        for construction_ef, M in itertools.product(args.construction_ef, args.M):
+            if backend == 'qdrant':
+                spec = f'qdrant:{construction_ef}:{M}:{args.search_ef[0]}::{args.qdrant_quantization or "none"}'
+                points.append((backend, construction_ef, M, args.search_ef, spec))
+            else:
+                for search_ef in args.search_ef:
+                    points.append((backend, construction_ef, M, [search_ef], f'chroma:{construction_ef}:{M}:{search_ef}'))
+
+    def _build(point):
+        backend, construction_ef, M, search_efs, spec = point
+        store = build_store(spec, embedder.get_model(), name_prefix='sweep')
+        return store, build_grid_point(exact_store, store, backend, construction_ef, M, args)
+
+    start = time.time()
+    # Qdrant builds segments server side and Chroma releases the GIL in hnswlib, threads are enough
+    with ThreadPoolExecutor(max_workers=args.build_workers) as executor:
+        built = list(executor.map(_build, points))
+    print(f"Built {len(built)} indexes for {time.time() - start:.1f} seconds")
+
+    rows = []
+    for (backend, construction_ef, M, search_efs, spec), (store, build_row) in zip(points, built):
+        for search_ef in search_efs:
+            search_params = {'hnsw_ef': search_ef} if backend == 'qdrant' else None
+            row = {**build_row, 'search_ef': search_ef,
+                   **run_store(store, queries, vectors, truth, k=args.k, concurrency=args.concurrency,
+                               search_params=search_params)}
+            print(row)
+            rows.append(row)
+        if args.cleanup:
+            store.drop()
+
+    write_report(rows, args.output)
+
+    recall_key = f'recall@{args.k}'
+    passing = [row for row in rows if row[recall_key] >= args.recall_target]
+    if passing:
+        best = min(passing, key=lambda row: (row['estimated_memory_bytes'], row['p95_ms']))
+        print(f"Cheapest config with {recall_key} >= {args.recall_target}: {best['backend']} "
+              f"construction_ef={best['construction_ef']} M={best['M']} search_ef={best['search_ef']} "
+              f"({best[recall_key]:.3f} recall, p95 {best['p95_ms']:.1f} ms, "
+              f"~{best['estimated_memory_bytes'] / 2 ** 20:.0f} MiB estimated)")
+    else:
+        print(f"No config reached {recall_key} >= {args.recall_target}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,44 +1,56 @@
+import asyncio
 import json
 import os
-import shutil
 
-import requests
 from bs4 import BeautifulSoup
 
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from rag.downloader import AsyncDownloader
 
-# сколько одновременно качать PDF (подберите под сеть/диск)
-PDF_WORKERS = 15
-# сколько одновременно парсить категорий
-CAT_WORKERS = 8
+# откуда качать (для проверки можно поднять локальный stub-сервер и указать его адрес)
+BASE_URL = os.environ.get('ARXIV_BASE_URL', 'https://arxiv.org')
+DATA_DIR = 'data'
+# сколько запросов одновременно всего (подберите под сеть/диск)
+DOWNLOAD_CONCURRENCY = 16
+# сколько соединений к одному хосту и сколько запросов в секунду к нему начинать
+PER_HOST_CONNECTIONS = 8
+PER_HOST_RATE = 4.0
 
-def download_pdf(link, path, session):
-    try:
-        pdf_response = session.get(link, stream=True)
-        pdf_response.raise_for_status()
-        with open(path, 'wb') as f:
-            shutil.copyfileobj(pdf_response.raw, f)
-    except Exception as e:
-        print(f"Error downloading PDF: {e}")
+def _load_known_files(category):
+    # size / sha256 of PDFs downloaded by previous runs, used to skip them without a request
+    path = DATA_DIR + '/' + category + '/meta.json'
+    if not os.path.exists(path):
+        return {}
+    with open(path, 'r') as f:
+        return {m['id']: m for m in json.load(f) if 'sha256' in m}
 
-def download_by_meta(meta, category, session):
-    os.makedirs('data/' + category, exist_ok=True)
-    with open('data/' + category + '/meta.json', 'w') as f:
+def _write_meta(meta, category):
+    path = DATA_DIR + '/' + category + '/meta.json'
+    with open(path + '.tmp', 'w') as f:
         json.dump(meta, f, ensure_ascii=False, indent=4)
+    os.replace(path + '.tmp', path)
 
-    with ThreadPoolExecutor(max_workers=PDF_WORKERS) as executor:
-        futures = [
-            executor.submit(download_pdf, m['link'], 'data/' + category + '/' + m['id'] + '.pdf', session)
-            for m in meta
-        ]
-        for fut in futures:
-            fut.result()
+async def download_by_meta(meta, category, downloader):
+    os.makedirs(DATA_DIR + '/' + category, exist_ok=True)
+    known = _load_known_files(category)
 
-def get_category_page(link, category, session):
-    resp = session.get(link)
-    if resp.status_code != 200:
-        raise Exception(f"Invalid status code {resp.status_code}")
-    soup = BeautifulSoup(resp.content, "html.parser")
+    results = await asyncio.gather(*[
+        downloader.download(m['link'], DATA_DIR + '/' + category + '/' + m['id'] + '.pdf',
+                            size=known.get(m['id'], {}).get('size'), sha256=known.get(m['id'], {}).get('sha256'))
+        for m in meta
+    ])
+    statuses = {}
+    for m, result in zip(meta, results):
+        statuses[result.status] = statuses.get(result.status, 0) + 1
+        if result.status == 'failed':
+            print(f"Error downloading PDF {result.url}: {result.error}")
+            continue
+        m['size'] = result.size
+        m['sha256'] = result.sha256
+    _write_meta(meta, category)
+    print(f"{category}: {statuses}")
+
+async def get_category_page(link, category, downloader):
+    soup = BeautifulSoup(await downloader.get_text(link), "html.parser")
     articles = soup.find_all("div", class_="meta")
     metadata = []
     for article in articles:
@@ -49,37 +61,32 @@ def get_category_page(link, category, session):
     pdf_links = soup.find_all("a", attrs={'title': 'Download PDF'})
     i = 0
     for pdf_link in pdf_links:
-        link = 'https://arxiv.org' + pdf_link["href"]
+        link = BASE_URL + pdf_link["href"]
         metadata[i]["id"] = link.split("/")[-1]
         metadata[i]["link"] = link
         metadata[i]["category"] = category
         i += 1
-    download_by_meta(metadata, category, session)
+    await download_by_meta(metadata, category, downloader)
 
-def main():
-    with requests.Session() as session:
+async def main():
+    async with AsyncDownloader(concurrency=DOWNLOAD_CONCURRENCY, per_host=PER_HOST_CONNECTIONS,
+                               host_rate=PER_HOST_RATE) as downloader:
         links_to_parse = []
 
-        resp = session.get("https://arxiv.org/")
-        if resp.status_code != 200:
-            raise Exception(f"Invalid status code {resp.status_code}")
-        soup = BeautifulSoup(resp.content, "html.parser")
+        soup = BeautifulSoup(await downloader.get_text(BASE_URL + "/"), "html.parser")
         links = soup.find_all("a")
         for link in links:
             if link.has_attr("href") and link["href"].endswith("/new"):
-                href = 'https://arxiv.org' + link["href"]
+                href = BASE_URL + link["href"]
                 cat = link.get("aria-labelledby").split(" ", 1)[1]
                 links_to_parse.append({'href': href, 'cat': cat})
 
-        with ThreadPoolExecutor(max_workers=CAT_WORKERS) as executor:
-            futures = [
-                executor.submit(get_category_page, link_to_parse['href'], link_to_parse['cat'], session)
-                for link_to_parse in links_to_parse
-            ]
-            for fut in futures:
-                fut.result()
+        await asyncio.gather(*[
+            get_category_page(link_to_parse['href'], link_to_parse['cat'], downloader)
+            for link_to_parse in links_to_parse
+        ])
 
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    asyncio.run(main())
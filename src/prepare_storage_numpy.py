@@ -0,0 +1,44 @@
+import dotenv
+
+from rag.embedder import Embedder
+from rag.ingest import prepare_store
+from rag.vector_store import NumpyStore
+
+print('loading dotenv')
+dotenv.load_dotenv('../.env', verbose=True)
+
+# размер батча для эмбеддинга и для записи в хранилище
+EMBED_BATCH_SIZE = 256
+WRITE_BATCH_SIZE = 256
+# сколько потоков пишут в хранилище параллельно с эмбеддингом
+WRITE_WORKERS = 2
+# сколько готовых батчей может ждать записи
+QUEUE_SIZE = 4
+# сколько процессов считают эмбеддинги документов (0 = в этом процессе) и сколько потоков torch у каждого
+EMBED_WORKERS = 0
+EMBED_THREADS = None
+# сколько процессов парсят PDF (None = по числу ядер)
+LOAD_WORKERS = None
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# True = удалить коллекцию и всё переиндексировать (bulk load: сначала загрузка, потом построение индекса)
+FULL_REBUILD = False
+# строить BM25 индекс для гибридного поиска по содержимому хранилища
+BUILD_LEXICAL_INDEX = True
+# строить классификатор категорий запроса по центроидам эмбеддингов (вместо вызова LLM)
+BUILD_CATEGORY_CLASSIFIER = True
+
+def generate_embeddings():
+    # создаём здесь, а не при импорте: процессы пула эмбеддингов (spawn) заново импортируют этот модуль
+    # кэш эмбеддингов общий для всех вариантов индекса
+    embedder = Embedder(model='BAAI/bge-m3', cache_dir='../embedding_cache',
+                        workers=EMBED_WORKERS, threads_per_worker=EMBED_THREADS)
+    store = NumpyStore(embedder=embedder.get_model(), space='cosine')
+
+    prepare_store(store, embedder.get_model_name(), data_path='../data', full_rebuild=FULL_REBUILD,
+                  build_lexical_index=BUILD_LEXICAL_INDEX, build_category_classifier=BUILD_CATEGORY_CLASSIFIER,
+                  chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, batch_size=EMBED_BATCH_SIZE, workers=LOAD_WORKERS,
+                  write_batch_size=WRITE_BATCH_SIZE, write_workers=WRITE_WORKERS, queue_size=QUEUE_SIZE)
+
+if __name__ == "__main__":
+    generate_embeddings()
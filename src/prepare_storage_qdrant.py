@@ -1,38 +1,45 @@
 import dotenv
 
 from rag.embedder import Embedder
-from rag.dataset import ArxivDataset
+from rag.ingest import prepare_store
 from rag.vector_store import QdrantStore
-import time
-import dotenv
 
 print('loading dotenv')
 dotenv.load_dotenv('../.env', verbose=True)
 
-embedder = Embedder(model='BAAI/bge-m3')
-store = QdrantStore(embedder=embedder.get_model(), construction_ef=4, M=2, search_ef=1, need_setup=True)
-#store = QdrantStore(embedder=embedder.get_model(), construction_ef=100, M=16, search_ef=10, need_setup=True)
-
-ITER_SIZE = 50
+# размер батча для эмбеддинга и для записи в хранилище
+EMBED_BATCH_SIZE = 256
+WRITE_BATCH_SIZE = 256
+# сколько потоков пишут в хранилище параллельно с эмбеддингом
+WRITE_WORKERS = 2
+# сколько готовых батчей может ждать записи
+QUEUE_SIZE = 4
+# сколько процессов считают эмбеддинги документов (0 = в этом процессе) и сколько потоков torch у каждого
+EMBED_WORKERS = 0
+EMBED_THREADS = None
+# сколько процессов парсят PDF (None = по числу ядер)
+LOAD_WORKERS = None
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# True = удалить коллекцию и всё переиндексировать (bulk load: сначала загрузка, потом построение индекса)
+FULL_REBUILD = False
+# строить BM25 индекс для гибридного поиска по содержимому хранилища
+BUILD_LEXICAL_INDEX = True
+# строить классификатор категорий запроса по центроидам эмбеддингов (вместо вызова LLM)
+BUILD_CATEGORY_CLASSIFIER = True
 
 def generate_embeddings():
-    print("Prepare storage")
-    store.setup_collection()
-    print("generate embeddings")
-
-    arxiv_dataset = ArxivDataset('../data').load().split()
-    splits = arxiv_dataset.get_splits()
-
-    splits_size = len(splits)
-    i = 0
-    while i < splits_size:
-        start = time.time()
-        store.store_splits(splits[i:min(i+ITER_SIZE, splits_size)])
-        end = time.time()
-        print(f"Vectorized {i}. Chunk of {ITER_SIZE} vectorized for {end-start} seconds")
-        i += ITER_SIZE
-    arxiv_dataset.clean()
-    print("done")
+    # создаём здесь, а не при импорте: процессы пула эмбеддингов (spawn) заново импортируют этот модуль
+    # кэш эмбеддингов общий для всех вариантов индекса
+    embedder = Embedder(model='BAAI/bge-m3', cache_dir='../embedding_cache',
+                        workers=EMBED_WORKERS, threads_per_worker=EMBED_THREADS)
+    store = QdrantStore(embedder=embedder.get_model(), construction_ef=4, M=2, search_ef=1, need_setup=False)
+    #store = QdrantStore(embedder=embedder.get_model(), construction_ef=100, M=16, search_ef=10, need_setup=False)
+
+    prepare_store(store, embedder.get_model_name(), data_path='../data', full_rebuild=FULL_REBUILD,
+                  build_lexical_index=BUILD_LEXICAL_INDEX, build_category_classifier=BUILD_CATEGORY_CLASSIFIER,
+                  chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP, batch_size=EMBED_BATCH_SIZE, workers=LOAD_WORKERS,
+                  write_batch_size=WRITE_BATCH_SIZE, write_workers=WRITE_WORKERS, queue_size=QUEUE_SIZE)
 
 if __name__ == "__main__":
-    generate_embeddings()
\ No newline at end of file
+    generate_embeddings()
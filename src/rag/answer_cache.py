@@ -0,0 +1,166 @@
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class _Namespace:
+    # Query vectors of one (chain, store) pair in a single matrix, so a lookup is one matrix-vector product
+    def __init__(self, dim, version):
+        self.version = version
+        self.vectors = np.zeros((16, dim), dtype=np.float32)
+        self.used = np.zeros(16, dtype=bool)
+        self.expires_at = np.zeros(16, dtype=np.float64)
+        self.entry_ids = [None] * 16
+        self.free = list(range(15, -1, -1))
+
+    def add(self, vector, entry_id, expires_at):
+        if not self.free:
+            size = len(self.used)
+            self.vectors = np.vstack([self.vectors, np.zeros_like(self.vectors)])
+            self.used = np.concatenate([self.used, np.zeros(size, dtype=bool)])
+            self.expires_at = np.concatenate([self.expires_at, np.zeros(size, dtype=np.float64)])
+            self.entry_ids.extend([None] * size)
+            self.free = list(range(2 * size - 1, size - 1, -1))
+        row = self.free.pop()
+        self.vectors[row] = vector
+        self.used[row] = True
+        self.expires_at[row] = expires_at
+        self.entry_ids[row] = entry_id
+        return row
+
+    def remove(self, row):
+        self.used[row] = False
+        self.entry_ids[row] = None
+        self.free.append(row)
+
+    def expired(self, now):
+        return [self.entry_ids[row] for row in np.flatnonzero(self.used & (self.expires_at <= now))]
+
+    def best(self, vector):
+        if not self.used.any():
+            return None, -1.0
+        scores = self.vectors @ vector
+        scores[~self.used] = -np.inf
+        row = int(np.argmax(scores))
+        return row, float(scores[row])
+
+
+class SemanticAnswerCache:
+    # Answers keyed by (chain, store, query vector): a lookup hits when a cached query of the same chain and
+    # store is at least `threshold` cosine-similar. Entries are evicted LRU across all namespaces, expire after
+    # `ttl` seconds and are dropped when the store reports a new version (checked at most every
+    # `version_check_interval` seconds).
+    def __init__(self, threshold=0.95, max_entries=2048, ttl=3600.0, version_check_interval=30.0):
+        self._threshold = threshold
+        self._max_entries = max_entries
+        self._ttl = ttl
+        self._version_check_interval = version_check_interval
+        self._namespaces = {}
+        self._entries = OrderedDict()  # entry id -> (namespace key, row, expires at, answer)
+        self._versions = {}  # store name -> (checked at, version)
+        self._next_id = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def _store_version(self, store):
+        now = time.monotonic()
+        checked = self._versions.get(store.get_name())
+        if checked is None or now - checked[0] > self._version_check_interval:
+            checked = (now, store.get_version())
+            self._versions[store.get_name()] = checked
+        return checked[1]
+
+    def _remove_entry(self, entry_id):
+        key, row, _, _ = self._entries.pop(entry_id)
+        namespace = self._namespaces.get(key)
+        if namespace is not None:
+            namespace.remove(row)
+            # Free the matrix of namespaces that are no longer used
+            if not namespace.used.any():
+                del self._namespaces[key]
+
+    def _drop_namespace(self, key):
+        namespace = self._namespaces.pop(key)
+        for entry_id in namespace.entry_ids:
+            if entry_id is not None:
+                self._entries.pop(entry_id, None)
+        self.invalidations += 1
+
+    def _get_namespace(self, key, dim, version, create):
+        namespace = self._namespaces.get(key)
+        if namespace is not None and namespace.version != version:
+            self._drop_namespace(key)
+            namespace = None
+        if namespace is None and create:
+            namespace = _Namespace(dim, version)
+            self._namespaces[key] = namespace
+        return namespace
+
+    def lookup(self, chain: str, store, vector):
+        vector = self._normalize(vector)
+        version = self._store_version(store)
+        with self._lock:
+            key = (chain, store.get_name())
+            namespace = self._get_namespace(key, len(vector), version, create=False)
+            if namespace is not None:
+                # Expired entries go before the argmax, so one of them cannot shadow a valid match
+                for entry_id in namespace.expired(time.monotonic()):
+                    self._remove_entry(entry_id)
+                namespace = self._namespaces.get(key)
+            if namespace is not None:
+                row, score = namespace.best(vector)
+                if row is not None and score >= self._threshold:
+                    entry_id = namespace.entry_ids[row]
+                    self._entries.move_to_end(entry_id)
+                    self.hits += 1
+                    return self._entries[entry_id][3]
+            self.misses += 1
+            return None
+
+    def insert(self, chain: str, store, vector, answer):
+        vector = self._normalize(vector)
+        version = self._store_version(store)
+        with self._lock:
+            key = (chain, store.get_name())
+            namespace = self._get_namespace(key, len(vector), version, create=True)
+            entry_id = self._next_id
+            self._next_id += 1
+            expires_at = time.monotonic() + self._ttl
+            row = namespace.add(vector, entry_id, expires_at)
+            self._entries[entry_id] = (key, row, expires_at, answer)
+            while len(self._entries) > self._max_entries:
+                self._remove_entry(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, store_name: str = None):
+        with self._lock:
+            for key in [k for k in self._namespaces if store_name is None or k[1] == store_name]:
+                self._drop_namespace(key)
+            if store_name is None:
+                self._versions.clear()
+            else:
+                self._versions.pop(store_name, None)
+
+    def get_stats(self):
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'namespaces': len(self._namespaces),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / total if total else 0.0,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'threshold': self._threshold,
+            }
@@ -0,0 +1,193 @@
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+
+from langchain_core.embeddings import Embeddings
+
+from rag.metrics import EMBEDDING_BATCH_SIZE
+
+
+def estimate_tokens(text: str) -> int:
+    # ~4 characters per token is close enough to bucket by length without running the tokenizer twice
+    return len(text) // 4 + 2
+
+
+def plan_batches(lengths, max_batch_size=64, max_batch_tokens=16384):
+    # Indexes grouped into batches of similar length: sorted longest first, a batch closes when it is full or
+    # when padding everything to its longest text would exceed max_batch_tokens
+    order = sorted(range(len(lengths)), key=lambda i: -lengths[i])
+    batches = []
+    batch = []
+    for i in order:
+        # the first (longest) text of a batch sets its padded length
+        longest = lengths[batch[0]] if batch else lengths[i]
+        if batch and (len(batch) >= max_batch_size or longest * (len(batch) + 1) > max_batch_tokens):
+            batches.append(batch)
+            batch = []
+        batch.append(i)
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+class LengthBucketedEmbeddings(Embeddings):
+    # Documents are embedded in length-sorted batches sized by a token budget, so short chunks are not padded
+    # to the longest one and long chunks do not blow up the activations of a big batch
+    def __init__(self, embeddings: Embeddings, max_batch_size=64, max_batch_tokens=16384):
+        self._embeddings = embeddings
+        self._max_batch_size = max_batch_size
+        self._max_batch_tokens = max_batch_tokens
+
+    def _plan(self, texts):
+        return plan_batches([estimate_tokens(t) for t in texts], self._max_batch_size, self._max_batch_tokens)
+
+    def _embed_batches(self, texts, batches):
+        result = [None] * len(texts)
+        for batch in batches:
+            EMBEDDING_BATCH_SIZE.observe(len(batch), path='bucket')
+            for i, vector in zip(batch, self._embeddings.embed_documents([texts[i] for i in batch])):
+                result[i] = vector
+        return result
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embed_batches(texts, self._plan(texts))
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embeddings.embed_query(text)
+
+
+_worker_model = None
+
+
+def _init_worker(model_name, normalize, threads, cores, counter, onnx_path=None):
+    # Runs once per worker process: pin it to its own cores and thread count before torch spins up its pools
+    global _worker_model
+    with counter.get_lock():
+        index = counter.value
+        counter.value += 1
+    if cores and hasattr(os, 'sched_setaffinity'):
+        os.sched_setaffinity(0, cores[index % len(cores)])
+    for var in ('OMP_NUM_THREADS', 'MKL_NUM_THREADS'):
+        os.environ[var] = str(threads)
+    if onnx_path is not None:
+        from rag.onnx_embeddings import OnnxEmbeddings
+        _worker_model = OnnxEmbeddings(onnx_path, normalize=normalize, threads=threads, batch_size=1024)
+        return
+    import torch
+    from langchain_huggingface import HuggingFaceEmbeddings
+    torch.set_num_threads(threads)
+    torch.set_num_interop_threads(1)
+    _worker_model = HuggingFaceEmbeddings(
+        model_name=model_name,
+        model_kwargs={'device': 'cpu'},
+        encode_kwargs={'normalize_embeddings': normalize, 'batch_size': 1024},
+    )
+
+
+def _embed_in_worker(texts):
+    return _worker_model.embed_documents(texts)
+
+
+class EmbeddingWorkerPool(LengthBucketedEmbeddings):
+    # Ingestion path: length-bucketed batches are spread over worker processes, each holding its own model
+    # with `threads` torch threads pinned to a disjoint set of cores (or an ONNX session from onnx_path).
+    # Queries stay on the in-process model.
+    def __init__(self, embeddings: Embeddings, model_name, normalize=True, workers=2, threads=None,
+                 max_batch_size=64, max_batch_tokens=16384, pin_cores=True, onnx_path=None):
+        super().__init__(embeddings, max_batch_size=max_batch_size, max_batch_tokens=max_batch_tokens)
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count() or 1))
+        threads = threads or max(1, len(cpus) // workers)
+        cores = None
+        if pin_cores and len(cpus) >= workers * threads:
+            cores = [set(cpus[i * threads:(i + 1) * threads]) for i in range(workers)]
+        # spawn: forking a parent that already runs torch thread pools can deadlock the children
+        context = multiprocessing.get_context('spawn')
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=context, initializer=_init_worker,
+            initargs=(model_name, normalize, threads, cores, context.Value('i', 0), onnx_path),
+        )
+        print(f"Embedding pool: {workers} workers x {threads} threads, pinned: {cores is not None}")
+
+    def _embed_batches(self, texts, batches):
+        result = [None] * len(texts)
+        futures = []
+        for batch in batches:
+            EMBEDDING_BATCH_SIZE.observe(len(batch), path='pool')
+            futures.append((batch, self._executor.submit(_embed_in_worker, [texts[i] for i in batch])))
+        for batch, future in futures:
+            for i, vector in zip(batch, future.result()):
+                result[i] = vector
+        return result
+
+    def close(self):
+        self._executor.shutdown()
+
+
+class MicroBatchingEmbeddings(Embeddings):
+    # Serving path: concurrent embed_query calls are gathered into one embed_documents call. A query that finds
+    # the batcher idle with nothing else queued is embedded at once; under load a batch is sent when it holds
+    # max_batch_size queries or max_wait_ms after its first query arrived, whichever comes first (queries that
+    # arrive while a batch is being embedded queue up for the next one anyway).
+    # Batches go through embed_documents, so the model must embed queries and documents alike (bge-m3 does).
+    def __init__(self, embeddings: Embeddings, max_batch_size=32, max_wait_ms=5.0):
+        self._embeddings = embeddings
+        self._max_batch_size = max_batch_size
+        self._max_wait = max_wait_ms / 1000.0
+        self._lock = threading.Lock()
+        self._queue = None
+        self._pid = None
+
+    def _get_queue(self):
+        # The batching thread is started on first use and again after a fork (gunicorn --preload):
+        # threads do not survive into the child, a queue left over from the parent would never be drained
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    self._queue = queue.Queue()
+                    threading.Thread(target=self._loop, args=(self._queue,), name='query-micro-batcher',
+                                     daemon=True).start()
+                    self._pid = pid
+        return self._queue
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        future = Future()
+        self._get_queue().put((text, future))
+        return future.result()
+
+    def _loop(self, requests):
+        while True:
+            batch = [requests.get()]
+            deadline = time.monotonic() + self._max_wait
+            # take what is already waiting, a lone query does not sit out the deadline
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(requests.get_nowait())
+                except queue.Empty:
+                    break
+            while 1 < len(batch) < self._max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(requests.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            EMBEDDING_BATCH_SIZE.observe(len(batch), path='query_micro')
+            try:
+                if len(batch) == 1:
+                    vectors = [self._embeddings.embed_query(batch[0][0])]
+                else:
+                    vectors = self._embeddings.embed_documents([text for text, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+            for (_, future), vector in zip(batch, vectors):
+                future.set_result(vector)
@@ -0,0 +1,204 @@
+import csv
+import json
+import os
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+def split_id(doc):
+    return doc.metadata.get('chunk_id') or doc.id
+
+
+def load_queries(path):
+    # Plain text (one query per line) or JSONL with a 'query' field
+    queries = []
+    with open(path, 'r') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            if line.startswith('{'):
+                queries.append(json.loads(line)['query'])
+            else:
+                queries.append(line)
+    return queries
+
+
+def sample_queries(exact_store, n=200, seed=42, min_words=8, max_words=30, with_categories=False):
+    # Offline pseudo-queries: one sentence from randomly chosen chunks of the corpus.
+    # with_categories also returns the category of the chunk each query came from.
+    rng = random.Random(seed)
+    rows = [int(row) for row in exact_store.get_rows()]
+    rng.shuffle(rows)
+    queries = []
+    categories = []
+    for start in range(0, len(rows), 256):
+        for doc in exact_store.get_documents(rows[start:start + 256]):
+            sentences = [s.strip() for s in re.split(r'(?<=[.?!])\s+', doc.page_content.replace('\n', ' '))]
+            sentences = [s for s in sentences if min_words <= len(s.split()) <= max_words]
+            if sentences:
+                queries.append(rng.choice(sentences))
+                categories.append(doc.metadata.get('loaded_category'))
+            if len(queries) >= n:
+                break
+        if len(queries) >= n:
+            break
+    return (queries, categories) if with_categories else queries
+
+
+def ground_truth(exact_store, vectors, k, categories=None):
+    if categories is None:
+        rows, _ = exact_store.search_rows(vectors, limit=k)
+        return [exact_store.get_ids(query_rows) for query_rows in rows]
+    truth = []
+    for vector, query_categories in zip(vectors, categories):
+        rows, _ = exact_store.search_rows([vector], limit=k, categories=query_categories)
+        truth.append(exact_store.get_ids(rows[0]))
+    return truth
+
+
+def recall_at_k(found_ids, truth_ids, k):
+    truth = set(truth_ids[:k])
+    if not truth:
+        return 1.0
+    return len(truth.intersection(found_ids[:k])) / len(truth)
+
+
+def latency_summary(latencies):
+    if not latencies:
+        return {'count': 0}
+    ms = np.asarray(latencies) * 1000.0
+    return {
+        'count': len(latencies),
+        'mean_ms': float(ms.mean()),
+        'p50_ms': float(np.percentile(ms, 50)),
+        'p95_ms': float(np.percentile(ms, 95)),
+        'p99_ms': float(np.percentile(ms, 99)),
+        'max_ms': float(ms.max()),
+    }
+
+
+def time_search(store, query, limit=5, cycles=10, vector=None):
+    splits = []
+    latencies = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        splits = store.find_splits(query, limit, vector=vector)
+        latencies.append(time.perf_counter() - start)
+    return splits, latencies
+
+
+async def atime_search(store, query, limit=5, cycles=10, vector=None):
+    splits = []
+    latencies = []
+    for _ in range(cycles):
+        start = time.perf_counter()
+        splits = await store.afind_splits(query, limit, vector=vector)
+        latencies.append(time.perf_counter() - start)
+    return splits, latencies
+
+
+def run_store(store, queries, vectors, truth, k=10, concurrency=1, warmup=5, categories=None, search_params=None):
+    # categories: optional per-query category filters; search_params: tier name or dict, see QdrantStore
+    categories = categories or [None] * len(queries)
+    for i in range(min(warmup, len(queries))):
+        store.find_splits(queries[i], k, vector=vectors[i], categories=categories[i], search_params=search_params)
+
+    def _one(i):
+        start = time.perf_counter()
+        splits = store.find_splits(queries[i], k, vector=vectors[i], categories=categories[i], search_params=search_params)
+        latency = time.perf_counter() - start
+        return latency, recall_at_k([split_id(doc) for doc, _ in splits], truth[i], k)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(_one, range(len(queries))))
+    wall = time.perf_counter() - start
+
+    latencies = [latency for latency, _ in results]
+    recalls = [recall for _, recall in results]
+    return {
+        'store': store.get_name(),
+        'k': k,
+        'concurrency': concurrency,
+        'search_params': search_params if isinstance(search_params, str) or search_params is None else json.dumps(search_params),
+        'queries': len(queries),
+        f'recall@{k}': float(np.mean(recalls)) if recalls else 0.0,
+        'qps': len(queries) / wall if wall > 0 else 0.0,
+        'wall_seconds': wall,
+        **latency_summary(latencies),
+    }
+
+
+def write_report(rows, path_prefix):
+    os.makedirs(os.path.dirname(path_prefix) or '.', exist_ok=True)
+    with open(path_prefix + '.json', 'w') as f:
+        json.dump(rows, f, indent=2)
+
+    columns = []
+    for row in rows:
+        columns.extend(c for c in row if c not in columns)
+    with open(path_prefix + '.csv', 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"Report written to {path_prefix}.json and {path_prefix}.csv")
+
+
+def build_store(spec, embedder, qdrant_location=None, name_prefix=None):
+    # 'numpy', 'chroma:<construction_ef>:<M>:<search_ef>' or
+    # 'qdrant:<construction_ef>:<M>:<search_ef>[:<partitioning>[:<quantization>]]', 'none' or empty = None
+    from rag.vector_store import ChromaStore, QdrantStore, NumpyStore
+
+    kind, *params = spec.split(':')
+    if kind == 'numpy':
+        return NumpyStore(embedder=embedder)
+    construction_ef, M, search_ef = (int(p) for p in params[:3])
+    if kind == 'chroma':
+        return ChromaStore(embedder=embedder, construction_ef=construction_ef, M=M, search_ef=search_ef,
+                           name_prefix=name_prefix)
+    if kind == 'qdrant':
+        options = [None if p in ('', 'none') else p for p in params[3:]]
+        return QdrantStore(embedder=embedder, construction_ef=construction_ef, M=M, search_ef=search_ef,
+                           location=qdrant_location, partitioning=options[0] if len(options) > 0 else None,
+                           quantization=options[1] if len(options) > 1 else 'scalar', name_prefix=name_prefix)
+    raise Exception(f"Unknown store spec {spec}")
+
+
+def copy_vectors(source, target, batch_size=1024, bulk=False):
+    # Fill a store from the exact store's vectors, without another embedding pass.
+    # bulk=True loads through begin/finish_bulk_load and returns its per-phase timings instead of the count.
+    if bulk:
+        target.begin_bulk_load()
+    else:
+        target.setup_collection(recreate=True)
+    copied = 0
+    for splits, vectors, ids in source.iter_rows(batch_size=batch_size):
+        target.write_vectors(splits, vectors, ids=ids)
+        copied += len(splits)
+    print(f"Copied {copied} vectors into {target.get_name()}")
+    if bulk:
+        return {'vectors': copied, **target.finish_bulk_load()}
+    return copied
+
+
+def dir_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def estimate_index_memory(points, dim, M, quantization=None):
+    # Resident bytes of an HNSW index: the vectors searched in RAM plus ~2*M level-0 links of 4 bytes per point.
+    # quantization: None (float32), 'scalar' (int8) or 'binary' (1 bit per dimension)
+    vector_bytes = {None: dim * 4, 'scalar': dim, 'binary': (dim + 7) // 8}[quantization]
+    return int(points * (vector_bytes + 2 * M * 4))
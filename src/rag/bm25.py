@@ -0,0 +1,134 @@
+import json
+import math
+import os
+import re
+import time
+
+import numpy as np
+
+from rag.generations import new_generation, publish_generation, resolve_generation
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    return _TOKEN_RE.findall(text.lower())
+
+
+class BM25Index:
+    # Inverted index laid out as flat arrays: postings of term t are
+    # postings_docs[offset:offset + df] / postings_tf[offset:offset + df].
+    # Arrays are memory-mapped, only the vocabulary is loaded into memory.
+    # A rebuild never touches the files of a loaded index: it writes a new generation (see rag.generations).
+    def __init__(self, path):
+        # every file from the generation the link points to now, even if a rebuild flips it meanwhile
+        self._path = resolve_generation(path)
+        with open(self._path + 'meta.json', 'r') as f:
+            meta = json.load(f)
+        self._k1 = meta['k1']
+        self._b = meta['b']
+        self._n_docs = meta['n_docs']
+        self._avgdl = meta['avgdl']
+        with open(self._path + 'vocab.json', 'r') as f:
+            self._vocab = json.load(f)
+        with open(self._path + 'doc_ids.json', 'r') as f:
+            self._doc_ids = json.load(f)
+        with open(self._path + 'categories.json', 'r') as f:
+            self._categories = {c: i for i, c in enumerate(json.load(f))}
+
+        self._postings_docs = self._map('postings_docs.bin', np.uint32)
+        self._postings_tf = self._map('postings_tf.bin', np.uint16)
+        self._doc_len = self._map('doc_len.bin', np.uint32)
+        self._doc_categories = self._map('doc_categories.bin', np.uint16)
+        # Length normalisation depends only on the document, precompute it once
+        self._norm = (self._k1 * (1 - self._b + self._b * self._doc_len / max(self._avgdl, 1e-9))).astype(np.float32) \
+            if self._n_docs > 0 else np.empty(0, dtype=np.float32)
+        print(f"BM25 index {self._path}: {self._n_docs} documents, {len(self._vocab)} terms")
+
+    def _map(self, name, dtype):
+        path = self._path + name
+        if os.path.getsize(path) == 0:
+            return np.empty(0, dtype=dtype)
+        return np.memmap(path, dtype=dtype, mode='r')
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + 'meta.json')
+
+    @classmethod
+    def build(cls, path, splits, k1=1.2, b=0.75):
+        # splits: iterable of Document with id set (the vector store id)
+        start = time.time()
+        target, path = path, new_generation(path)
+        postings = {}
+        doc_ids = []
+        doc_len = []
+        doc_categories = []
+        categories = {}
+        for split in splits:
+            row = len(doc_ids)
+            doc_ids.append(split.id)
+            category = split.metadata.get('loaded_category')
+            doc_categories.append(categories.setdefault(category, len(categories)))
+            tokens = tokenize(split.page_content)
+            doc_len.append(len(tokens))
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, tf in counts.items():
+                postings.setdefault(token, []).append((row, min(tf, 65535)))
+
+        vocab = {}
+        offset = 0
+        with open(path + 'postings_docs.bin', 'wb') as docs_f, open(path + 'postings_tf.bin', 'wb') as tf_f:
+            for term in sorted(postings):
+                term_postings = postings[term]
+                docs_f.write(np.fromiter((row for row, _ in term_postings), dtype=np.uint32).tobytes())
+                tf_f.write(np.fromiter((tf for _, tf in term_postings), dtype=np.uint16).tobytes())
+                vocab[term] = [offset, len(term_postings)]
+                offset += len(term_postings)
+
+        np.asarray(doc_len, dtype=np.uint32).tofile(path + 'doc_len.bin')
+        np.asarray(doc_categories, dtype=np.uint16).tofile(path + 'doc_categories.bin')
+        with open(path + 'vocab.json', 'w') as f:
+            json.dump(vocab, f)
+        with open(path + 'doc_ids.json', 'w') as f:
+            json.dump(doc_ids, f)
+        with open(path + 'categories.json', 'w') as f:
+            json.dump(sorted(categories, key=categories.get), f)
+        with open(path + 'meta.json', 'w') as f:
+            json.dump({'k1': k1, 'b': b, 'n_docs': len(doc_ids),
+                       'avgdl': float(np.mean(doc_len)) if doc_len else 0.0}, f)
+        # the complete generation becomes visible at once, an interrupted build is never published
+        publish_generation(target, path)
+
+        print(f"BM25 index {path}: built over {len(doc_ids)} documents, {len(vocab)} terms for {time.time() - start} seconds")
+        return cls(target)
+
+    def search(self, query: str, limit: int=50, categories: list[str] = None):
+        # Returns [(store id, score)] best first
+        if self._n_docs == 0:
+            return []
+        scores = np.zeros(self._n_docs, dtype=np.float32)
+        for term in set(tokenize(query)):
+            entry = self._vocab.get(term)
+            if entry is None:
+                continue
+            offset, df = entry
+            docs = self._postings_docs[offset:offset + df]
+            tf = self._postings_tf[offset:offset + df].astype(np.float32)
+            idf = math.log(1 + (self._n_docs - df + 0.5) / (df + 0.5))
+            # A term occurs once per document in its postings, so plain fancy-index add is safe
+            scores[docs] += idf * tf * (self._k1 + 1) / (tf + self._norm[docs])
+
+        if categories is not None:
+            codes = [self._categories[c] for c in categories if c in self._categories]
+            scores[~np.isin(self._doc_categories, codes)] = 0.0
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) == 0:
+            return []
+        k = min(limit, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [(self._doc_ids[row], float(scores[row])) for row in top]
@@ -0,0 +1,116 @@
+import json
+import os
+import random
+import time
+
+import numpy as np
+
+from rag.generations import new_generation, publish_generation, resolve_generation
+
+
+class CategoryClassifier:
+    # Nearest-centroid classifier over the stored chunk embeddings: one normalised mean vector per
+    # category, query scores are cosine similarities turned into probabilities by a softmax.
+    # A rebuild writes a new generation and flips the link to it (see rag.generations).
+    def __init__(self, path):
+        self._path = resolve_generation(path)
+        with open(self._path + 'meta.json', 'r') as f:
+            meta = json.load(f)
+        self._categories = meta['categories']
+        self._temperature = meta['temperature']
+        self._centroids = np.load(self._path + 'centroids.npy')
+        print(f"Category classifier {self._path}: {len(self._categories)} categories, "
+              f"holdout accuracy {meta.get('accuracy')}")
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + 'meta.json')
+
+    @staticmethod
+    def _normalize(vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        return vectors / np.maximum(np.linalg.norm(vectors, axis=-1, keepdims=True), 1e-12)
+
+    @classmethod
+    def build(cls, path, rows, temperature=0.02, holdout=2048, seed=42):
+        # rows: iterable of (splits, vectors, ids) batches, as yielded by VectorStore.iter_rows.
+        # A reservoir sample of `holdout` chunks is kept out of the centroids to estimate accuracy.
+        start = time.time()
+        target, path = path, new_generation(path)
+        rng = random.Random(seed)
+        sums = {}
+        counts = {}
+        sample = []
+        seen = 0
+        for splits, vectors, _ in rows:
+            vectors = cls._normalize(vectors)
+            for split, vector in zip(splits, vectors):
+                category = split.metadata.get('loaded_category')
+                if category is None:
+                    continue
+                seen += 1
+                if len(sample) < holdout:
+                    sample.append((category, vector))
+                    continue
+                j = rng.randrange(seen)
+                if j < holdout:
+                    sample[j], (category, vector) = (category, vector), sample[j]
+                if category not in sums:
+                    sums[category] = np.zeros_like(vector)
+                    counts[category] = 0
+                sums[category] += vector
+                counts[category] += 1
+
+        # Tiny corpora: the holdout would take everything, train on it instead
+        if not sums:
+            for category, vector in sample:
+                sums[category] = sums.get(category, np.zeros_like(vector)) + vector
+                counts[category] = counts.get(category, 0) + 1
+            sample = []
+
+        categories = sorted(sums)
+        centroids = cls._normalize(np.stack([sums[c] for c in categories])) if categories \
+            else np.empty((0, 0), dtype=np.float32)
+        accuracy = None
+        if sample:
+            codes = {c: i for i, c in enumerate(categories)}
+            predicted = np.argmax(np.stack([v for _, v in sample]) @ centroids.T, axis=1)
+            accuracy = float(np.mean([codes.get(c, -1) == p for (c, _), p in zip(sample, predicted)]))
+
+        np.save(path + 'centroids.npy', centroids)
+        with open(path + 'meta.json', 'w') as f:
+            json.dump({'categories': categories, 'counts': [counts[c] for c in categories],
+                       'temperature': temperature, 'accuracy': accuracy}, f)
+        publish_generation(target, path)
+
+        print(f"Category classifier {path}: built over {seen} chunks, {len(categories)} categories, "
+              f"holdout accuracy {accuracy} for {time.time() - start} seconds")
+        return cls(target)
+
+    def get_categories(self):
+        return list(self._categories)
+
+    def predict_proba(self, vectors):
+        # vectors: (n, dim) or (dim,) -> probabilities (n, categories) or (categories,)
+        if len(self._categories) == 0:
+            return np.empty((0,), dtype=np.float32)
+        logits = self._normalize(vectors) @ self._centroids.T / self._temperature
+        logits -= logits.max(axis=-1, keepdims=True)
+        proba = np.exp(logits)
+        return proba / proba.sum(axis=-1, keepdims=True)
+
+    def classify(self, vector, coverage=0.9, max_categories=3):
+        # Smallest set of most likely categories covering `coverage` of the probability mass.
+        # Returns (categories, confidence), confidence is the mass the set actually covers.
+        proba = self.predict_proba(vector)
+        if len(proba) == 0:
+            return [], 0.0
+        order = np.argsort(-proba)[:max_categories]
+        categories = []
+        confidence = 0.0
+        for i in order:
+            categories.append(self._categories[i])
+            confidence += float(proba[i])
+            if confidence >= coverage:
+                break
+        return categories, confidence
@@ -0,0 +1,156 @@
+import functools
+import re
+
+from langchain_core.documents import Document
+
+from rag.batching import estimate_tokens
+from rag.metrics import time_stage
+
+_WORD_RE = re.compile(r'\w+', re.UNICODE)
+
+
+@functools.cache
+def _get_encoding():
+    # tiktoken downloads the BPE file on first use: None when that fails (offline host), tokens are then estimated
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')
+    except Exception as e:
+        print(f"cl100k encoding unavailable, estimating tokens from characters: {e}")
+        return None
+
+
+def load_encoding():
+    # Call at startup, so the first request neither waits for the download nor fails on it
+    return _get_encoding() is not None
+
+
+def count_tokens(text: str) -> int:
+    # cl100k is not the served model's tokenizer, but close enough to budget a prompt
+    encoding = _get_encoding()
+    if encoding is None:
+        return estimate_tokens(text)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def _text_overlap(left: str, right: str, min_overlap=20):
+    # Length of the longest suffix of `left` that is a prefix of `right`, 0 if shorter than min_overlap
+    if len(right) < min_overlap:
+        return 0
+    probe = right[:min_overlap]
+    start = left.find(probe)
+    while start != -1:
+        if right.startswith(left[start:]):
+            return len(left) - start
+        start = left.find(probe, start + 1)
+    return 0
+
+
+class _Piece:
+    __slots__ = ('source', 'page', 'text', 'start', 'end', 'rank', 'metadata', 'ids')
+
+    def __init__(self, doc, rank):
+        self.source = doc.metadata.get('source')
+        self.page = doc.metadata.get('page')
+        self.text = doc.page_content
+        self.start = doc.metadata.get('start_index')
+        self.end = self.start + len(self.text) if self.start is not None else None
+        self.rank = rank
+        self.metadata = doc.metadata
+        self.ids = [doc.id or doc.metadata.get('chunk_id')]
+
+    def absorb(self, other, overlap):
+        self.text = self.text + other.text[overlap:]
+        if other.end is not None:
+            self.end = max(self.end, other.end)
+        self.rank = min(self.rank, other.rank)
+        self.ids.extend(other.ids)
+
+
+class ContextPacker:
+    # Turns retrieved chunks (best first) into the prompt context:
+    #  1. chunks of the same source and page that overlap or touch are merged into one piece,
+    #  2. pieces whose words are mostly contained in an already kept piece are dropped,
+    #  3. pieces are taken by rank while they fit into max_tokens.
+    # Chunks carry 'start_index' when split with add_start_index, otherwise the overlap is found in the text.
+    def __init__(self, max_tokens=3000, duplicate_threshold=0.9, max_gap=2, token_counter=None):
+        self._max_tokens = max_tokens
+        self._duplicate_threshold = duplicate_threshold
+        self._max_gap = max_gap
+        self._count_tokens = token_counter or count_tokens
+
+    def _merge_group(self, pieces):
+        if all(p.start is not None for p in pieces):
+            pieces = sorted(pieces, key=lambda p: p.start)
+            merged = [pieces[0]]
+            for piece in pieces[1:]:
+                last = merged[-1]
+                if piece.start <= last.end + self._max_gap:
+                    if piece.end > last.end:
+                        if piece.start > last.end:
+                            # the splitter dropped the separator between adjacent chunks
+                            last.text += ' '
+                        last.absorb(piece, max(last.end - piece.start, 0))
+                    else:
+                        # fully inside the previous piece
+                        last.rank = min(last.rank, piece.rank)
+                        last.ids.extend(piece.ids)
+                else:
+                    merged.append(piece)
+            return merged
+
+        # Without offsets: chain pieces whose tail overlaps the head of another one
+        merged = list(pieces)
+        changed = True
+        while changed and len(merged) > 1:
+            changed = False
+            for i, left in enumerate(merged):
+                for j, right in enumerate(merged):
+                    if i == j:
+                        continue
+                    if right.text in left.text:
+                        overlap = len(right.text)
+                    else:
+                        overlap = _text_overlap(left.text, right.text)
+                    if overlap:
+                        left.absorb(right, overlap)
+                        del merged[j]
+                        changed = True
+                        break
+                if changed:
+                    break
+        return merged
+
+    def merge(self, splits):
+        groups = {}
+        for rank, split in enumerate(splits):
+            doc = split[0] if isinstance(split, tuple) else split
+            piece = _Piece(doc, rank)
+            groups.setdefault((piece.source, piece.page), []).append(piece)
+        pieces = [piece for group in groups.values() for piece in self._merge_group(group)]
+        return sorted(pieces, key=lambda p: p.rank)
+
+    def pack(self, splits):
+        # splits: [(Document, score)] or [Document], best first. Returns the packed Documents.
+        kept = []
+        kept_words = []
+        used = 0
+        for piece in self.merge(splits):
+            words = set(_WORD_RE.findall(piece.text.lower()))
+            if any(len(words & other) >= self._duplicate_threshold * max(len(words), 1) for other in kept_words):
+                continue
+            tokens = self._count_tokens(piece.text)
+            if used + tokens > self._max_tokens:
+                # a smaller piece further down may still fit
+                continue
+            used += tokens
+            kept_words.append(words)
+            metadata = dict(piece.metadata)
+            metadata['packed_ids'] = piece.ids
+            metadata.pop('start_index', None)
+            kept.append(Document(page_content=piece.text, metadata=metadata))
+        return kept
+
+    def format(self, splits):
+        with time_stage('context'):
+            return ''.join([f"<document>{doc.page_content}</document>" for doc in self.pack(splits)])
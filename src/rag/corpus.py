@@ -0,0 +1,195 @@
+import gzip
+import json
+import os
+import threading
+
+from filelock import FileLock
+from langchain_core.documents import Document
+
+
+def pages_to_record(pdf_hash, docs):
+    # One PDF as a corpus record: metadata shared by all its pages is stored once, each page keeps
+    # its text and the keys that differ (page, page_label)
+    shared = dict(docs[0].metadata) if docs else {}
+    for doc in docs[1:]:
+        shared = {k: v for k, v in shared.items() if k in doc.metadata and doc.metadata[k] == v}
+    return {
+        'hash': pdf_hash,
+        'metadata': shared,
+        'pages': [[doc.page_content, {k: v for k, v in doc.metadata.items() if k not in shared}] for doc in docs],
+    }
+
+
+def record_to_documents(record, source):
+    # source is the current path of the PDF, the same content may have moved or be present twice
+    return [Document(page_content=text, metadata={**record['metadata'], **page_metadata, 'source': source})
+            for text, page_metadata in record['pages']]
+
+
+def read_record(data_path, offset, length):
+    # Usable from worker processes with a location from ParsedCorpus.locate()
+    with open(data_path, 'rb') as f:
+        f.seek(offset)
+        return json.loads(gzip.decompress(f.read(length)))
+
+
+class ParsedCorpus:
+    # Page texts and metadata of parsed PDFs, keyed by the sha256 of the PDF, so re-chunking skips the parser.
+    # corpus-<generation>.jsonl.gz: one gzip member per PDF, appended only (the file as a whole is an ordinary
+    # gzip of JSONL); index-<generation>.jsonl: hash -> offset and length of its member, a record is visible
+    # once its index line is written. meta.json names the current generation, compact() switches it atomically.
+    # Records of another parser version are dropped.
+    # Several processes (the prepare_storage_* scripts) may share one corpus: opening, appending and compacting
+    # happen under a file lock, and each of them first picks up what the others wrote.
+    def __init__(self, path, parser, compress_level=6):
+        self._dir = path
+        os.makedirs(path, exist_ok=True)
+        self._parser = parser
+        self._compress_level = compress_level
+        self._meta_path = path + os.sep + 'meta.json'
+        self._file_lock = FileLock(path + os.sep + '.lock')
+        self._lock = threading.Lock()
+        self._generation = None
+        self._index = {}
+        self._index_read = 0
+        with self._file_lock:
+            if os.path.exists(self._meta_path):
+                meta = self._read_meta()
+                if meta.get('parser') != parser:
+                    print(f"Parsed corpus {path} was built with {meta.get('parser')}, starting over")
+                    self._remove_generation(meta['generation'])
+                    self._write_meta(meta['generation'] + 1)
+            else:
+                self._write_meta(0)
+            self._sync()
+        print(f"Parsed corpus {path}: {len(self._index)} documents")
+
+    def _data_path(self, generation=None):
+        return self._dir + os.sep + f'corpus-{self._generation if generation is None else generation}.jsonl.gz'
+
+    def _index_path(self, generation=None):
+        return self._dir + os.sep + f'index-{self._generation if generation is None else generation}.jsonl'
+
+    def _remove_generation(self, generation):
+        for path in (self._data_path(generation), self._index_path(generation)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _read_meta(self):
+        with open(self._meta_path, 'r') as f:
+            return json.load(f)
+
+    def _write_meta(self, generation):
+        with open(self._meta_path + '.tmp', 'w') as f:
+            json.dump({'parser': self._parser, 'generation': generation}, f)
+        os.replace(self._meta_path + '.tmp', self._meta_path)
+
+    def _sync(self):
+        # Under the file lock: follow a compaction by another process, read index lines appended since the
+        # last sync and cut off a torn index line or data tail left by a crash (no writer is active now)
+        generation = self._read_meta()['generation']
+        if generation != self._generation:
+            self._generation = generation
+            self._index = {}
+            self._index_read = 0
+        index_path = self._index_path()
+        size = 0
+        if os.path.exists(index_path):
+            good = self._index_read
+            with open(index_path, 'rb') as f:
+                f.seek(self._index_read)
+                for line in f:
+                    if not line.endswith(b'\n'):
+                        break
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        break
+                    self._index[record['hash']] = (record['offset'], record['length'])
+                    good += len(line)
+            if os.path.getsize(index_path) > good:
+                os.truncate(index_path, good)
+            self._index_read = good
+        if self._index:
+            size = max(offset + length for offset, length in self._index.values())
+        data_path = self._data_path()
+        if os.path.exists(data_path) and os.path.getsize(data_path) > size:
+            os.truncate(data_path, size)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, pdf_hash):
+        return pdf_hash in self._index
+
+    def locate(self, pdf_hash):
+        # (data path, offset, length) for read_record(), None if the PDF was never parsed.
+        # A compaction by another process can remove the file, readers fall back to parsing.
+        with self._lock:
+            location = self._index.get(pdf_hash)
+            return (self._data_path(), *location) if location is not None else None
+
+    def get(self, pdf_hash):
+        location = self.locate(pdf_hash)
+        return read_record(*location) if location is not None else None
+
+    def add(self, record):
+        data = gzip.compress((json.dumps(record, ensure_ascii=False, default=str) + '\n').encode('utf-8'),
+                             compresslevel=self._compress_level)
+        with self._lock, self._file_lock:
+            self._sync()
+            if record['hash'] in self._index:
+                return
+            data_path = self._data_path()
+            # the file size, not a remembered offset: other processes append to the same file
+            offset = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+            # data before the index, so every indexed record is backed by bytes on disk
+            with open(data_path, 'ab') as f:
+                f.write(data)
+            with open(self._index_path(), 'a') as f:
+                f.write(json.dumps({'hash': record['hash'], 'offset': offset, 'length': len(data)}) + '\n')
+            self._sync()
+
+    def stream(self, hashes=None):
+        # Yields (hash, record) in file order, only for `hashes` if given, reading the file front to back.
+        # The data file is opened under the lock, a later compaction elsewhere does not pull it from under us.
+        with self._lock, self._file_lock:
+            self._sync()
+            entries = sorted(self._index.items(), key=lambda item: item[1][0])
+            data_path = self._data_path()
+            f = open(data_path, 'rb') if entries else None
+        if f is None:
+            return
+        with f:
+            for pdf_hash, (offset, length) in entries:
+                if hashes is not None and pdf_hash not in hashes:
+                    continue
+                f.seek(offset)
+                yield pdf_hash, json.loads(gzip.decompress(f.read(length)))
+
+    def compact(self, live_hashes, min_garbage=0.3):
+        # Rewrites the corpus without records of PDFs that changed or disappeared, once they take
+        # at least min_garbage of the file. Members are copied as they are, nothing is recompressed.
+        # live_hashes must cover every PDF users of the corpus still need.
+        with self._lock, self._file_lock:
+            self._sync()
+            size = sum(length for _, length in self._index.values())
+            garbage = sum(length for h, (_, length) in self._index.items() if h not in live_hashes)
+            if not size or garbage / size < min_garbage:
+                return False
+            old = self._generation
+            new = old + 1
+            entries = sorted(((h, loc) for h, loc in self._index.items() if h in live_hashes), key=lambda item: item[1][0])
+            offset = 0
+            with open(self._data_path(old), 'rb') as src, open(self._data_path(new), 'wb') as data, \
+                    open(self._index_path(new), 'w') as index:
+                for pdf_hash, (old_offset, length) in entries:
+                    src.seek(old_offset)
+                    data.write(src.read(length))
+                    index.write(json.dumps({'hash': pdf_hash, 'offset': offset, 'length': length}) + '\n')
+                    offset += length
+            self._write_meta(new)
+            self._remove_generation(old)
+            self._sync()
+        print(f"Parsed corpus {self._dir}: compacted, {garbage} bytes of stale records dropped")
+        return True
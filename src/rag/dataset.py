@@ -1,10 +1,18 @@
 import os
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from importlib.metadata import version
 
-from langchain_community.document_loaders import PyPDFDirectoryLoader
-from langchain_core.documents import Document
+from langchain_community.document_loaders import PyPDFLoader
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 import json
 
+from rag.corpus import ParsedCorpus, pages_to_record, read_record, record_to_documents
+from rag.manifest import file_hash
+from rag.splits import SplitTable
+
+# Parsed texts depend on the extractor, a new pypdf version re-parses the corpus
+_PARSER = f"PyPDFLoader/pypdf-{version('pypdf')}"
+
 class SubsetMetadata():
     _metadata = {}
 
@@ -25,54 +33,172 @@ class SubsetMetadata():
     def get_all_metadata(self):
         return self._metadata
 
+def _enrich_docs(docs, doc_metadata):
+    for d in docs:
+        d.metadata['loaded_title'] = doc_metadata['title']
+        d.metadata['loaded_link'] = doc_metadata['link']
+        d.metadata['loaded_category'] = doc_metadata['category']
+        d.metadata['loaded_authors'] = ";".join(doc_metadata['all_authors'])
+    return docs
+
+def _get_text_splitter(chunk_size, chunk_overlap):
+    return RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        # lets the context packer merge overlapping chunks of a page exactly
+        add_start_index=True,
+    )
+
+# Runs in a worker process: parse one PDF (or read its pages from the parsed corpus at `location`),
+# enrich and split its pages. Returns (corpus record of a freshly parsed PDF or None, SplitTable);
+# the SplitTable pickles the shared document metadata once instead of once per chunk.
+def _load_and_split_pdf(path, doc_metadata, chunk_size, chunk_overlap, pdf_hash=None, location=None):
+    record = None
+    docs = None
+    if location is not None:
+        try:
+            docs = _enrich_docs(record_to_documents(read_record(*location), path), doc_metadata)
+        except OSError:
+            # the corpus was compacted by another process since the lookup, parse instead
+            location = None
+    if docs is None:
+        docs = _enrich_docs(PyPDFLoader(path).load(), doc_metadata)
+        if pdf_hash is not None:
+            record = pages_to_record(pdf_hash, docs)
+    return record, SplitTable.from_documents(_get_text_splitter(chunk_size, chunk_overlap).split_documents(docs))
+
 class ArxivDataset:
     _path: str = '../data'
-    _docs: list[Document] = []
-    _docs_splits: list[Document] = []
 
-    def __init__(self, path='../data'):
+    # corpus_path: where parsed page texts are kept (default: next to the data directory, '<path>_parsed'),
+    # False = always parse the PDFs
+    def __init__(self, path='../data', corpus_path=None):
         self._path = path
+        # per instance: class-level lists were shared by every dataset
+        self._docs = SplitTable()
+        self._docs_splits = SplitTable()
+        self._corpus_path = os.path.normpath(path) + '_parsed' if corpus_path is None else corpus_path
+        self._corpus = None
+
+    def get_corpus(self):
+        if self._corpus is None and self._corpus_path:
+            self._corpus = ParsedCorpus(self._corpus_path, _PARSER)
+        return self._corpus
 
     @staticmethod
     def _get_doc_id(path):
         return path.split(os.sep)[-1][:-4]
 
-    def _load_directory(self, subdir):
-        print("loading directory {}".format(subdir))
-        dir_metadata = SubsetMetadata(subdir)
-
-        loader = PyPDFDirectoryLoader(subdir, recursive=True)
-        docs_of_subdir = loader.load()
-
-        for d in docs_of_subdir:
-            doc_metadata = dir_metadata.get_metadata_of_doc(self._get_doc_id(d.metadata.get("source")))
-            d.metadata['loaded_title'] = doc_metadata['title']
-            d.metadata['loaded_link'] = doc_metadata['link']
-            d.metadata['loaded_category'] = doc_metadata['category']
-            d.metadata['loaded_authors'] = ";".join(doc_metadata['all_authors'])
-
-        self._docs.extend(docs_of_subdir)
-        print("Now loaded {} documents".format(len(self._docs)))
-
-        return self
-
     def load(self):
-        dirs = os.listdir(self._path)
-        for dir in dirs:
-            self._load_directory(self._path + os.sep + dir)
-            #break #TODO: delete
+        if self.get_corpus() is not None:
+            return self._load_with_corpus()
+        for path, doc_metadata in self.list_pdfs():
+            print("parsing {}".format(path))
+            try:
+                self._docs.extend(_enrich_docs(PyPDFLoader(path).load(), doc_metadata))
+            except Exception as e:
+                print(f"Error loading {path}: {e}")
         print("loaded {} documents".format(len(self._docs)))
         return self
 
+    def _load_with_corpus(self):
+        # Pages of already parsed PDFs are streamed from the corpus, only new or changed PDFs are parsed
+        corpus = self.get_corpus()
+        by_hash = {}
+        for path, doc_metadata in self.list_pdfs():
+            by_hash.setdefault(file_hash(path), []).append((path, doc_metadata))
+
+        for pdf_hash, record in corpus.stream(set(by_hash)):
+            # the same PDF can be listed in several categories
+            for path, doc_metadata in by_hash[pdf_hash]:
+                self._docs.extend(_enrich_docs(record_to_documents(record, path), doc_metadata))
+        cached = len(self._docs)
+
+        missing = [(pdf_hash, pdfs) for pdf_hash, pdfs in by_hash.items() if pdf_hash not in corpus]
+        for pdf_hash, pdfs in missing:
+            for path, doc_metadata in pdfs:
+                print("parsing {}".format(path))
+                try:
+                    docs = _enrich_docs(PyPDFLoader(path).load(), doc_metadata)
+                except Exception as e:
+                    print(f"Error loading {path}: {e}")
+                    continue
+                corpus.add(pages_to_record(pdf_hash, docs))
+                self._docs.extend(docs)
+        corpus.compact(set(by_hash))
+        print("loaded {} pages, {} from the parsed corpus, {} documents parsed".format(
+            len(self._docs), cached, len(missing)))
+        return self
+
+    def list_pdfs(self):
+        for dir in sorted(os.listdir(self._path)):
+            subdir = self._path + os.sep + dir
+            dir_metadata = SubsetMetadata(subdir)
+            for root, _, files in os.walk(subdir):
+                for file in sorted(files):
+                    if not file.endswith('.pdf') or file.startswith('.'):
+                        continue
+                    path = root + os.sep + file
+                    yield path, dir_metadata.get_metadata_of_doc(self._get_doc_id(path))
+
+    def iter_splits(self, workers=None, chunk_size=1000, chunk_overlap=200, sources=None, max_pending=None,
+                    hashes=None):
+        # Yields (source, splits) per PDF as soon as a worker finishes it. At most max_pending PDFs
+        # (2 per worker by default) are parsed ahead of the consumer, so a slow consumer bounds memory
+        # instead of letting parsed documents pile up.
+        # PDFs found in the parsed corpus are split from their stored pages; hashes: path -> sha256 already
+        # computed by the caller (the ingestion hashes every PDF anyway).
+        workers = workers or os.cpu_count() or 1
+        max_pending = max_pending or 2 * workers
+        corpus = self.get_corpus()
+        hashes = dict(hashes or {})
+        pdfs = ((path, doc_metadata) for path, doc_metadata in self.list_pdfs() if sources is None or path in sources)
+        scheduled = 0
+        from_corpus = 0
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {}
+            while True:
+                for path, doc_metadata in pdfs:
+                    pdf_hash = location = None
+                    if corpus is not None:
+                        pdf_hash = hashes.get(path) or file_hash(path)
+                        hashes[path] = pdf_hash
+                        location = corpus.locate(pdf_hash)
+                        from_corpus += location is not None
+                    futures[executor.submit(_load_and_split_pdf, path, doc_metadata, chunk_size, chunk_overlap,
+                                            pdf_hash, location)] = path
+                    scheduled += 1
+                    if len(futures) >= max_pending:
+                        break
+                if not futures:
+                    break
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                for fut in done:
+                    source = futures.pop(fut)
+                    try:
+                        record, splits = fut.result()
+                    except Exception as e:
+                        print(f"Error loading {source}: {e}")
+                        continue
+                    if record is not None:
+                        corpus.add(record)
+                    yield source, list(splits)
+        print("split {} documents, {} parsed, {} from the parsed corpus".format(scheduled, scheduled - from_corpus,
+                                                                                from_corpus))
+        if corpus is not None and sources is None:
+            # every current PDF was seen, records of the others are stale
+            corpus.compact(set(hashes.values()))
+
     def split(self, chunk_size=1000, chunk_overlap=200):
-        text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=chunk_size,
-            chunk_overlap=chunk_overlap,
-        )
-        self._docs_splits =text_splitter.split_documents(self._docs)
+        text_splitter = _get_text_splitter(chunk_size, chunk_overlap)
+        # page by page, so only one page worth of Documents is materialized at a time
+        self._docs_splits.clear()
+        sources = set()
+        for doc in self._docs:
+            self._docs_splits.extend(text_splitter.split_documents([doc]))
+            sources.add(doc.metadata.get("source"))
         print("split {} documents".format(len(self._docs_splits)))
 
-        sources = {d.metadata.get("source") for d in self._docs}
         print("unique sources:", len(sources))
         print(list(sorted(sources))[:10])
 
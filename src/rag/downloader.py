@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import os
+import re
+import time
+from urllib.parse import urlsplit
+
+import aiohttp
+
+_CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-(\d+)/(\d+|\*)')
+_RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class DownloadResult:
+    __slots__ = ('url', 'path', 'status', 'size', 'sha256', 'error')
+
+    # status: 'skipped' (already present and valid), 'downloaded', 'resumed' or 'failed'
+    def __init__(self, url, path, status, size=None, sha256=None, error=None):
+        self.url = url
+        self.path = path
+        self.status = status
+        self.size = size
+        self.sha256 = sha256
+        self.error = error
+
+    def __repr__(self):
+        return f"DownloadResult({self.status}, {self.path}, size={self.size}, error={self.error})"
+
+
+def sha256_of(path, chunk_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        while chunk := f.read(chunk_size):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+class _HostRateLimiter:
+    # Spaces request starts to the same host at least 1 / rate seconds apart
+    def __init__(self, rate):
+        self._interval = 1.0 / rate if rate else 0.0
+        self._locks = {}
+        self._next = {}
+
+    async def wait(self, host):
+        if not self._interval:
+            return
+        lock = self._locks.setdefault(host, asyncio.Lock())
+        async with lock:
+            now = time.monotonic()
+            start = max(now, self._next.get(host, 0.0))
+            self._next[host] = start + self._interval
+        if start > now:
+            await asyncio.sleep(start - now)
+
+
+class AsyncDownloader:
+    # One aiohttp session with a sized connection pool for every request of a run.
+    #  - concurrency: requests in flight overall, per_host: connections per host
+    #  - host_rate: request starts per second per host, so a crawl stays polite
+    #  - files go to `<path>.part` and are renamed into place only once complete, a later run resumes
+    #    a leftover .part with an HTTP Range request
+    # Usage: async with AsyncDownloader() as downloader: await downloader.download(url, path)
+    def __init__(self, concurrency=16, per_host=8, host_rate=4.0, pool_size=None, timeout=120.0, retries=3,
+                 chunk_size=1 << 16, user_agent='otus-llm-dataset-generator'):
+        self._concurrency = concurrency
+        self._per_host = per_host
+        self._pool_size = pool_size or concurrency
+        self._timeout = timeout
+        self._retries = retries
+        self._chunk_size = chunk_size
+        self._headers = {'User-Agent': user_agent}
+        self._rate_limiter = _HostRateLimiter(host_rate)
+        self._semaphore = None
+        self._session = None
+
+    async def __aenter__(self):
+        self._semaphore = asyncio.Semaphore(self._concurrency)
+        self._session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self._pool_size, limit_per_host=self._per_host),
+            timeout=aiohttp.ClientTimeout(total=self._timeout),
+            headers=self._headers,
+        )
+        return self
+
+    async def __aexit__(self, *exc):
+        await self._session.close()
+        self._session = None
+
+    async def _request(self, method, url, handler, headers=None):
+        # Runs handler(response) under the concurrency and rate limits, retrying transient failures.
+        # headers may be a callable, evaluated per attempt (a retried download resumes from a new offset)
+        delay = 1.0
+        for attempt in range(self._retries + 1):
+            async with self._semaphore:
+                await self._rate_limiter.wait(urlsplit(url).netloc)
+                try:
+                    request_headers = headers() if callable(headers) else headers
+                    async with self._session.request(method, url, headers=request_headers) as response:
+                        if response.status in _RETRY_STATUSES and attempt < self._retries:
+                            retry_after = response.headers.get('Retry-After', '')
+                            delay = float(retry_after) if retry_after.isdigit() else delay
+                        else:
+                            return await handler(response)
+                except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    # 4xx answers will not change on retry
+                    if attempt == self._retries or (isinstance(e, aiohttp.ClientResponseError)
+                                                    and e.status not in _RETRY_STATUSES):
+                        raise
+            await asyncio.sleep(delay)
+            delay *= 2
+        raise Exception(f"Giving up on {url}")
+
+    async def get_text(self, url):
+        async def _read(response):
+            response.raise_for_status()
+            return await response.text()
+        return await self._request('GET', url, _read)
+
+    async def _remote_size(self, url):
+        async def _length(response):
+            if response.status != 200:
+                return None
+            length = response.headers.get('Content-Length')
+            return int(length) if length is not None else None
+        try:
+            return await self._request('HEAD', url, _length)
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            return None
+
+    async def is_present(self, url, path, size=None, sha256=None):
+        # A file at `path` is trusted when it matches the known hash or size; without either,
+        # its size is compared to the server's Content-Length
+        if not os.path.exists(path):
+            return False
+        if sha256 is not None:
+            return sha256_of(path) == sha256
+        if size is None:
+            size = await self._remote_size(url)
+        return size is not None and os.path.getsize(path) == size
+
+    async def download(self, url, path, size=None, sha256=None):
+        try:
+            if await self.is_present(url, path, size=size, sha256=sha256):
+                return DownloadResult(url, path, 'skipped', size=os.path.getsize(path),
+                                      sha256=sha256 or sha256_of(path))
+            return await self._download(url, path, sha256)
+        except Exception as e:
+            return DownloadResult(url, path, 'failed', error=f"{type(e).__name__}: {e}")
+
+    async def _download(self, url, path, expected_sha256):
+        part = path + '.part'
+
+        def _offset():
+            return os.path.getsize(part) if os.path.exists(part) else 0
+
+        def _headers():
+            offset = _offset()
+            return {'Range': f'bytes={offset}-'} if offset else None
+
+        async def _save(response):
+            offset = _offset()
+            if response.status == 416:
+                # the .part is not a prefix the server can continue from, start over
+                os.remove(part)
+                raise aiohttp.ClientPayloadError("Range not satisfiable, restarting")
+            response.raise_for_status()
+
+            if response.status == 206:
+                match = _CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+                if match is None or int(match.group(1)) != offset:
+                    raise aiohttp.ClientPayloadError("Unexpected Content-Range")
+                total = int(match.group(3)) if match.group(3) != '*' else None
+                mode = 'ab'
+            else:
+                # the server ignored the Range header, the body is the whole file
+                offset = 0
+                length = response.headers.get('Content-Length')
+                total = int(length) if length is not None else None
+                mode = 'wb'
+
+            resumed = mode == 'ab' and offset > 0
+            h = hashlib.sha256()
+            if resumed:
+                with open(part, 'rb') as f:
+                    while chunk := f.read(1 << 20):
+                        h.update(chunk)
+            with open(part, mode) as f:
+                async for chunk in response.content.iter_chunked(self._chunk_size):
+                    f.write(chunk)
+                    h.update(chunk)
+                    offset += len(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+            if total is not None and offset != total:
+                raise aiohttp.ClientPayloadError(f"Truncated body: {offset} of {total} bytes")
+            return resumed, h.hexdigest()
+
+        # a dropped connection leaves a valid prefix in .part, the retry resumes from it
+        resumed, digest = await self._request('GET', url, _save, headers=_headers)
+
+        if expected_sha256 is not None and digest != expected_sha256:
+            os.remove(part)
+            raise Exception(f"Hash mismatch for {url}")
+        os.replace(part, path)
+        return DownloadResult(url, path, 'resumed' if resumed else 'downloaded', size=os.path.getsize(path), sha256=digest)
@@ -1,25 +1,85 @@
 from langchain_huggingface import HuggingFaceEmbeddings
 import torch
 
+from rag.batching import EmbeddingWorkerPool, LengthBucketedEmbeddings, MicroBatchingEmbeddings
+from rag.embedding_cache import EmbeddingCache, CachedEmbeddings
+from rag.onnx_embeddings import OnnxEmbeddings, default_onnx_path, export_onnx
+from rag.query_cache import QueryEmbeddingCache, CachedQueryEmbeddings
+
 class Embedder:
     _device: str = "cpu"
     _embedding_model_name: str = "fitlemon/bge-m3-ru-ostap"
 
-    def __init__(self, model='fitlemon/bge-m3-ru-ostap'):
-        self._device = "cuda" if torch.cuda.is_available() else "cpu"
-        if self._device == "cuda":
-            print(f"   GPU: {torch.cuda.get_device_name(0)}")
-
+    # Wrapping order: model -> query micro-batching -> length-bucketed batches (or the worker pool)
+    # -> disk cache of document vectors -> query cache, so cache hits skip every batching stage.
+    #  - max_batch_size / max_batch_tokens: document batches by length, 0 tokens = the model's own batching
+    #  - workers > 0: documents are embedded in that many processes with threads_per_worker torch threads
+    #  - query_batch_size > 1: concurrent queries share a model call, waiting at most query_batch_wait_ms
+    #    and only when other queries are already queued (a lone query is embedded at once)
+    #  - backend='onnx': CPU inference of an exported ONNX graph (int8 weights if onnx_quantize), exported to
+    #    onnx_path on first use; its vectors are cached apart from the torch ones
+    def __init__(self, model='fitlemon/bge-m3-ru-ostap', normalize=True, cache_dir=None, cache_dtype='float16',
+                 query_cache_size=1024, query_cache_ttl=3600.0, max_batch_size=64, max_batch_tokens=16384,
+                 workers=0, threads_per_worker=None, query_batch_size=1, query_batch_wait_ms=5.0,
+                 backend='torch', onnx_path=None, onnx_quantize=True):
         self._embedding_model_name = model
+        self._backend = backend
+        onnx_path = onnx_path or default_onnx_path(model, onnx_quantize)
+
+        if backend == 'onnx':
+            self._device = "cpu"
+            if not OnnxEmbeddings.exists(onnx_path):
+                export_onnx(model, onnx_path, quantize=onnx_quantize)
+            self._embedding_model = OnnxEmbeddings(onnx_path, normalize=normalize, threads=threads_per_worker,
+                                                   batch_size=max_batch_size)
+            self._cache_name = f'{model}@onnx-{"int8" if onnx_quantize else "fp32"}'
+        elif backend == 'torch':
+            self._device = "cuda" if torch.cuda.is_available() else "cpu"
+            if self._device == "cuda":
+                print(f"   GPU: {torch.cuda.get_device_name(0)}")
+            self._embedding_model = HuggingFaceEmbeddings(
+                model_name=self._embedding_model_name,
+                model_kwargs={'device': self._device},
+                encode_kwargs={'normalize_embeddings': normalize, 'batch_size': max_batch_size}
+            )
+            self._cache_name = model
+        else:
+            raise Exception(f"Unknown embedding backend {backend}")
+
+        if query_batch_size > 1:
+            self._embedding_model = MicroBatchingEmbeddings(self._embedding_model, max_batch_size=query_batch_size,
+                                                            max_wait_ms=query_batch_wait_ms)
+
+        if workers > 0 and self._device == "cpu":
+            self._embedding_model = EmbeddingWorkerPool(self._embedding_model, self._embedding_model_name,
+                                                        normalize=normalize, workers=workers,
+                                                        threads=threads_per_worker, max_batch_size=max_batch_size,
+                                                        max_batch_tokens=max_batch_tokens or 16384,
+                                                        onnx_path=onnx_path if backend == 'onnx' else None)
+        elif max_batch_tokens:
+            self._embedding_model = LengthBucketedEmbeddings(self._embedding_model, max_batch_size=max_batch_size,
+                                                             max_batch_tokens=max_batch_tokens)
 
-        self._embedding_model = HuggingFaceEmbeddings(
-            model_name=self._embedding_model_name,
-            model_kwargs={'device': self._device},
-            encode_kwargs={'normalize_embeddings': True}
-        )
+        if cache_dir is not None:
+            cache = EmbeddingCache(cache_dir, self._cache_name, normalize=normalize, dtype=cache_dtype)
+            self._embedding_model = CachedEmbeddings(self._embedding_model, cache)
+
+        self._query_cache = None
+        if query_cache_size > 0:
+            self._query_cache = QueryEmbeddingCache(max_size=query_cache_size, ttl=query_cache_ttl)
+            self._embedding_model = CachedQueryEmbeddings(self._embedding_model, self._query_cache)
 
     def get_embedding(self, text: str) -> list[float]:
         return self._embedding_model.embed_query(text=text)
 
+    def get_query_cache(self):
+        return self._query_cache
+
+    def get_model_name(self):
+        return self._embedding_model_name
+
+    def get_backend(self):
+        return self._backend
+
     def get_model(self):
-        return self._embedding_model
\ No newline at end of file
+        return self._embedding_model
@@ -0,0 +1,141 @@
+import hashlib
+import json
+import os
+import threading
+
+import numpy as np
+from filelock import FileLock
+from langchain_core.embeddings import Embeddings
+
+_KEY_SIZE = 16
+
+
+def _text_key(text: str) -> bytes:
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=_KEY_SIZE).digest()
+
+
+class EmbeddingCache:
+    # Append-only store: keys.bin holds fixed size text digests, vectors.bin the
+    # rows in the same order. Vectors are read through a memory map.
+    def __init__(self, path, model_name, normalize=True, dtype='float16'):
+        namespace = hashlib.sha256(f'{model_name}|normalize={normalize}'.encode('utf-8')).hexdigest()[:16]
+        self._dir = path + os.sep + namespace
+        os.makedirs(self._dir, exist_ok=True)
+
+        self._model_name = model_name
+        self._normalize = normalize
+        self._dtype = np.dtype(dtype)
+        self._keys_path = self._dir + os.sep + 'keys.bin'
+        self._vectors_path = self._dir + os.sep + 'vectors.bin'
+        self._meta_path = self._dir + os.sep + 'meta.json'
+        self._file_lock = FileLock(self._dir + os.sep + '.lock')
+        self._lock = threading.Lock()
+
+        self._dim = None
+        self._index = {}
+        self._rows = 0
+        self._vectors = None
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r') as f:
+                meta = json.load(f)
+            self._dim = meta['dim']
+            self._dtype = np.dtype(meta['dtype'])
+            with self._file_lock:
+                self._refresh()
+
+        print(f"Embedding cache {self._dir}: {self._rows} vectors")
+
+    def _row_bytes(self):
+        return self._dim * self._dtype.itemsize
+
+    def _refresh(self):
+        # Pick up rows appended by other processes and drop a torn tail left by a crash
+        key_rows = os.path.getsize(self._keys_path) // _KEY_SIZE if os.path.exists(self._keys_path) else 0
+        vector_rows = os.path.getsize(self._vectors_path) // self._row_bytes() if os.path.exists(self._vectors_path) else 0
+        rows = min(key_rows, vector_rows)
+
+        for path, size in ((self._keys_path, rows * _KEY_SIZE), (self._vectors_path, rows * self._row_bytes())):
+            if os.path.exists(path) and os.path.getsize(path) != size:
+                os.truncate(path, size)
+
+        if rows > self._rows:
+            with open(self._keys_path, 'rb') as f:
+                f.seek(self._rows * _KEY_SIZE)
+                data = f.read((rows - self._rows) * _KEY_SIZE)
+            for i in range(rows - self._rows):
+                self._index[data[i * _KEY_SIZE:(i + 1) * _KEY_SIZE]] = self._rows + i
+
+        if rows != self._rows or (self._vectors is None and rows > 0):
+            self._rows = rows
+            self._vectors = np.memmap(self._vectors_path, dtype=self._dtype, mode='r', shape=(rows, self._dim)) if rows > 0 else None
+
+    def __len__(self):
+        return self._rows
+
+    def get_many(self, texts):
+        keys = [_text_key(t) for t in texts]
+        with self._lock:
+            rows = [self._index.get(k) for k in keys]
+            hits = [i for i, r in enumerate(rows) if r is not None]
+            result = [None] * len(texts)
+            if hits:
+                vectors = np.asarray(self._vectors[[rows[i] for i in hits]], dtype=np.float32)
+                for i, v in zip(hits, vectors):
+                    result[i] = v.tolist()
+        return result
+
+    def put_many(self, texts, vectors):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock, self._file_lock:
+            if self._dim is None:
+                self._dim = int(vectors.shape[1])
+                with open(self._meta_path, 'w') as f:
+                    json.dump({'model': self._model_name, 'normalize': self._normalize,
+                               'dtype': self._dtype.name, 'dim': self._dim}, f)
+            self._refresh()
+
+            new_keys = []
+            new_rows = []
+            for text, vector in zip(texts, vectors):
+                key = _text_key(text)
+                if key in self._index:
+                    continue
+                self._index[key] = self._rows + len(new_keys)
+                new_keys.append(key)
+                new_rows.append(vector)
+            if not new_keys:
+                return
+
+            # Vectors first: a crash between the two writes leaves rows without keys, which _refresh trims
+            with open(self._vectors_path, 'ab') as f:
+                f.write(np.asarray(new_rows, dtype=self._dtype).tobytes())
+            with open(self._keys_path, 'ab') as f:
+                f.write(b''.join(new_keys))
+            self._refresh()
+
+
+class CachedEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, cache: EmbeddingCache):
+        self._embeddings = embeddings
+        self._cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        result = self._cache.get_many(texts)
+
+        missing = {}
+        for i, vector in enumerate(result):
+            if vector is None:
+                missing.setdefault(texts[i], []).append(i)
+        if missing:
+            missing_texts = list(missing.keys())
+            computed = self._embeddings.embed_documents(missing_texts)
+            self._cache.put_many(missing_texts, computed)
+            for text, vector in zip(missing_texts, computed):
+                for i in missing[text]:
+                    result[i] = list(vector)
+
+        return result
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embeddings.embed_query(text)
@@ -0,0 +1,39 @@
+import glob
+import os
+import shutil
+import uuid
+
+
+# A served directory ('../x/') is a symlink to its current generation ('../x.gen-<id>/'). A build writes a fresh
+# generation and flips the link, replacing a symlink is atomic, so a reader that resolves the link once
+# (resolve_generation) only ever opens files of one complete generation. The generation the link pointed to
+# before stays for readers still using it and is removed by the next build.
+
+def resolve_generation(path):
+    return os.path.realpath(path.rstrip(os.sep)) + os.sep
+
+
+def new_generation(path):
+    # Returns the directory to build into, with a trailing separator like `path`
+    base = path.rstrip(os.sep)
+    live = os.path.realpath(base) if os.path.islink(base) else None
+    for old in glob.glob(base + '.gen-*') + glob.glob(base + '.link-*'):
+        if os.path.realpath(old) == live:
+            continue
+        if os.path.islink(old) or not os.path.isdir(old):
+            os.remove(old)
+        else:
+            shutil.rmtree(old, ignore_errors=True)
+    directory = f'{base}.gen-{uuid.uuid4().hex[:8]}'
+    os.makedirs(directory)
+    return directory + os.sep
+
+
+def publish_generation(path, directory):
+    base = path.rstrip(os.sep)
+    if os.path.exists(base) and not os.path.islink(base):
+        # built before generations: moved aside once, the next build removes it
+        os.rename(base, f'{base}.gen-{uuid.uuid4().hex[:8]}')
+    link = f'{base}.link-{uuid.uuid4().hex[:8]}'
+    os.symlink(os.path.basename(directory.rstrip(os.sep)), link)
+    os.replace(link, base)
@@ -0,0 +1,148 @@
+import threading
+
+from rag.dataset import ArxivDataset
+from rag.manifest import IngestionManifest, file_hash, assign_chunk_ids
+from rag.vector_store import IngestionPipeline
+
+
+class IncrementalIngestion:
+    def __init__(self, dataset, store, manifest, batch_size=50, workers=None, chunk_size=1000, chunk_overlap=200,
+                 write_batch_size=None, write_workers=2, queue_size=4):
+        self._dataset = dataset
+        self._store = store
+        self._manifest = manifest
+        self._batch_size = batch_size
+        self._workers = workers
+        self._chunk_size = chunk_size
+        self._chunk_overlap = chunk_overlap
+        self._write_batch_size = write_batch_size or batch_size
+        self._write_workers = write_workers
+        self._queue_size = queue_size
+        self._hashes = {}
+        # source -> {'chunks': {chunk_id: chunk_hash}, 'remaining': splits not yet written}
+        self._pending = {}
+        self._stored = 0
+        self._changed = False
+        self._lock = threading.Lock()
+        self._stats = None
+
+    def _finish_document(self, source):
+        new_chunks = self._pending.pop(source)['chunks']
+        stale = [cid for cid in self._manifest.get_chunks(source) if cid not in new_chunks]
+        if stale:
+            self._store.delete_splits(stale)
+            self._changed = True
+        self._manifest.set_document(source, self._hashes[source], new_chunks)
+
+    def _on_written(self, items):
+        # Called from pipeline writer threads once a batch is in the store
+        with self._lock:
+            for split, cid, source in items:
+                pending = self._pending[source]
+                self._manifest.add_chunks(source, {cid: pending['chunks'][cid]})
+                pending['remaining'] -= 1
+                if pending['remaining'] == 0:
+                    self._finish_document(source)
+            self._manifest.commit()
+            self._stored += len(items)
+            self._changed = True
+            print(f"Stored {self._stored} chunks")
+
+    def _remove_deleted(self):
+        for source in self._manifest.get_sources() - set(self._hashes):
+            print(f"Removing {source}")
+            stale = list(self._manifest.get_chunks(source))
+            if stale:
+                self._store.delete_splits(stale)
+                self._changed = True
+            self._manifest.remove_document(source)
+        self._manifest.commit()
+
+    def run(self):
+        try:
+            return self._run()
+        finally:
+            # folds the per-batch journal into the manifest snapshot
+            self._manifest.close()
+            if self._changed:
+                self._store.bump_version()
+
+    def _run(self):
+        for path, _ in self._dataset.list_pdfs():
+            self._hashes[path] = file_hash(path)
+
+        self._remove_deleted()
+        corpus = self._dataset.get_corpus()
+        if corpus is not None:
+            corpus.compact(set(self._hashes.values()))
+
+        changed = {source for source, h in self._hashes.items() if not self._manifest.is_unchanged(source, h)}
+        print(f"{len(self._hashes) - len(changed)} documents unchanged, {len(changed)} to ingest")
+        if not changed:
+            return self
+
+        pipeline = IngestionPipeline(self._store, embed_batch_size=self._batch_size,
+                                     write_batch_size=self._write_batch_size, write_workers=self._write_workers,
+                                     queue_size=self._queue_size, on_written=self._on_written).start()
+        try:
+            for source, splits in self._dataset.iter_splits(workers=self._workers, chunk_size=self._chunk_size,
+                                                            chunk_overlap=self._chunk_overlap, sources=changed,
+                                                            hashes=self._hashes):
+                chunks = assign_chunk_ids(source, splits)
+                with self._lock:
+                    # After a crash, chunks written by the last committed batch are already in the manifest
+                    written = self._manifest.get_chunks(source)
+                    fresh = [split for split in splits if split.metadata['chunk_id'] not in written]
+                    self._pending[source] = {'chunks': chunks, 'remaining': len(fresh)}
+                    if not fresh:
+                        self._finish_document(source)
+                        self._manifest.commit()
+
+                for split in fresh:
+                    pipeline.put(split, split.metadata['chunk_id'], source)
+        finally:
+            self._stats = pipeline.close()
+            pipeline.print_stats()
+        return self
+
+    def get_stats(self):
+        return self._stats
+
+
+def prepare_store(store, model_name, data_path='../data', full_rebuild=False, build_lexical_index=True,
+                  build_category_classifier=True, chunk_size=1000, chunk_overlap=200, **ingestion_kwargs):
+    # The whole prepare_storage_* sequence for one store: (re)build or update it from the dataset, then the
+    # BM25 index and the category classifier on top. ingestion_kwargs go to IncrementalIngestion.
+    print("Prepare storage")
+    manifest_path = f'../manifests/{store.get_name()}'
+    build_out_of_place = full_rebuild and not store.bulk_loads_in_place()
+    # an out of place build gets its own manifest: the live one keeps describing the live store until the swap
+    manifest = IngestionManifest(manifest_path + '.build' if build_out_of_place else manifest_path, model_name,
+                                 chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    if full_rebuild:
+        store.begin_bulk_load()
+        manifest.reset()
+    elif store.setup_collection(recreate=False):
+        manifest.reset()
+
+    print("generate embeddings")
+    try:
+        IncrementalIngestion(ArxivDataset(data_path), store, manifest, chunk_size=chunk_size,
+                             chunk_overlap=chunk_overlap, **ingestion_kwargs).run()
+    except BaseException:
+        # never leave a half-built store in bulk mode: it is finished or rolled back
+        if full_rebuild:
+            store.abort_bulk_load()
+        raise
+    if full_rebuild:
+        store.finish_bulk_load()
+        if build_out_of_place:
+            manifest.move_to(manifest_path)
+    if build_lexical_index:
+        print("build lexical index")
+        store.build_lexical_index()
+    if build_category_classifier:
+        print("build category classifier")
+        store.build_category_classifier()
+    print("done")
+    return store
@@ -0,0 +1,182 @@
+import hashlib
+import json
+import os
+import re
+import uuid
+
+_CHUNK_NAMESPACE = uuid.UUID('6f1c2b9e-4d2a-4b8e-9a51-3f0e7c1d2a64')
+
+
+def file_hash(path, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def chunk_hash(split):
+    h = hashlib.sha256()
+    h.update(str(split.metadata.get('page', '')).encode('utf-8'))
+    h.update(b'\0')
+    h.update(split.page_content.encode('utf-8'))
+    return h.hexdigest()
+
+
+def assign_chunk_ids(source, splits):
+    # Ids depend on content, not on position, so an edit early in a PDF
+    # does not invalidate every chunk after it
+    chunks = {}
+    seen = {}
+    for split in splits:
+        h = chunk_hash(split)
+        n = seen.get(h, 0)
+        seen[h] = n + 1
+        cid = str(uuid.uuid5(_CHUNK_NAMESPACE, f'{source}#{h}#{n}'))
+        split.metadata['chunk_id'] = cid
+        chunks[cid] = h
+    return chunks
+
+
+class IngestionManifest:
+    # source -> {'hash': pdf hash or None while incomplete, 'chunks': {chunk_id: chunk_hash}}
+    # Persisted as a snapshot plus an append-only journal: commit() appends the changes since the last commit
+    # as one fsync'd line, every snapshot_every commits (and on close) the journal is folded into a new snapshot.
+    # Journal lines carry the generation of the snapshot they apply to, lines of an older snapshot are skipped.
+    _documents: dict
+
+    def __init__(self, path, model, chunk_size=1000, chunk_overlap=200, snapshot_every=256):
+        self._key = {'model': model, 'chunk_size': chunk_size, 'chunk_overlap': chunk_overlap}
+        self._name = re.sub(r'[^A-Za-z0-9_.-]+', '-', f'{model}_{chunk_size}_{chunk_overlap}')
+        self._snapshot_every = snapshot_every
+        self._open(path)
+        print(f"Manifest {self._path}: {len(self._documents)} documents")
+
+    def _open(self, path):
+        os.makedirs(path, exist_ok=True)
+        self._dir = path
+        self._path = path + os.sep + f'manifest_{self._name}.json'
+        self._journal_path = self._path + '.journal'
+        self._documents = {}
+        self._changes = []
+        self._journal_lines = 0
+        self._generation = None
+
+        if os.path.exists(self._path):
+            with open(self._path, 'r') as f:
+                data = json.load(f)
+            if data.get('key') == self._key:
+                self._documents = data['documents']
+                self._generation = data.get('generation')
+            else:
+                print(f"Manifest {self._path} was built with {data.get('key')}, ignoring it")
+                self.reset()
+                return
+        self._replay_journal()
+
+    def _replay_journal(self):
+        if not os.path.exists(self._journal_path):
+            return
+        good = 0
+        with open(self._journal_path, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break
+                good += len(line)
+                if entry['generation'] != self._generation:
+                    continue
+                for change in entry['changes']:
+                    self._apply(change)
+                self._journal_lines += 1
+        # a torn last line after a crash is cut off, so the next append starts on a clean line
+        if os.path.getsize(self._journal_path) > good:
+            os.truncate(self._journal_path, good)
+
+    def _apply(self, change):
+        op, source, *args = change
+        if op == 'add':
+            doc = self._documents.setdefault(source, {'hash': None, 'chunks': {}})
+            doc['hash'] = None
+            doc['chunks'].update(args[0])
+        elif op == 'set':
+            self._documents[source] = {'hash': args[0], 'chunks': dict(args[1])}
+        elif op == 'remove':
+            self._documents.pop(source, None)
+
+    def _change(self, *change):
+        self._apply(change)
+        self._changes.append(change)
+
+    def is_unchanged(self, source, pdf_hash):
+        doc = self._documents.get(source)
+        return doc is not None and doc['hash'] == pdf_hash
+
+    def get_sources(self):
+        return set(self._documents.keys())
+
+    def get_chunks(self, source):
+        doc = self._documents.get(source)
+        return dict(doc['chunks']) if doc is not None else {}
+
+    def add_chunks(self, source, chunks):
+        self._change('add', source, dict(chunks))
+
+    def set_document(self, source, pdf_hash, chunks):
+        self._change('set', source, pdf_hash, dict(chunks))
+
+    def remove_document(self, source):
+        self._change('remove', source)
+
+    def reset(self):
+        self._documents = {}
+        self._changes = []
+        self.snapshot()
+
+    def commit(self):
+        if not self._changes:
+            return
+        line = json.dumps({'generation': self._generation, 'changes': self._changes}) + '\n'
+        with open(self._journal_path, 'a') as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._changes = []
+        self._journal_lines += 1
+        if self._journal_lines >= self._snapshot_every:
+            self.snapshot()
+
+    def snapshot(self):
+        # Writes the whole manifest under a new generation, the journal of the old one is then dropped
+        self._changes = []
+        self._generation = uuid.uuid4().hex
+        tmp_path = self._path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'key': self._key, 'generation': self._generation, 'documents': self._documents}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self._path)
+        if os.path.exists(self._journal_path):
+            os.truncate(self._journal_path, 0)
+        self._journal_lines = 0
+
+    def close(self):
+        self.commit()
+        self.snapshot()
+
+    def move_to(self, path):
+        # Replaces the manifest in directory `path` with this one (a manifest built next to a live store
+        # becomes the live manifest once the store is swapped). A journal left there belongs to an older
+        # generation and is ignored from the replace on.
+        self.close()
+        target = path + os.sep + os.path.basename(self._path)
+        os.makedirs(path, exist_ok=True)
+        os.replace(self._path, target)
+        if os.path.exists(self._journal_path):
+            os.remove(self._journal_path)
+        if os.path.exists(target + '.journal'):
+            os.truncate(target + '.journal', 0)
+        self._open(path)
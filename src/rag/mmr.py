@@ -0,0 +1,48 @@
+import numpy as np
+
+
+def _normalize(x):
+    return x / np.maximum(np.linalg.norm(x, axis=-1, keepdims=True), 1e-12)
+
+
+def mmr_select_batch(queries, candidates, limits, lambda_mult=0.5):
+    # Maximal marginal relevance for a batch of queries, same selection as LangChain's maximal_marginal_relevance:
+    # the most relevant candidate first, then the one maximizing
+    #     lambda_mult * sim(query, c) - (1 - lambda_mult) * max(sim(c, selected))
+    # candidates: per query an (m_i, dim) array of candidate vectors; limits: one int or a per-query list.
+    # Candidates are padded into one (n, m, dim) tensor, the (n, m, m) similarity matrix is computed once and
+    # every step updates the running max similarity to the selected set for all queries at once.
+    # Returns per query the selected candidate positions, in selection order.
+    n = len(candidates)
+    limits = limits if isinstance(limits, list) else [limits] * n
+    width = max((len(c) for c in candidates), default=0)
+    if width == 0:
+        return [[] for _ in range(n)]
+
+    queries = _normalize(np.asarray(queries, dtype=np.float32).reshape(n, -1))
+    padded = np.zeros((n, width, queries.shape[1]), dtype=np.float32)
+    available = np.zeros((n, width), dtype=bool)
+    for i, c in enumerate(candidates):
+        if len(c):
+            padded[i, :len(c)] = c
+            available[i, :len(c)] = True
+    padded = _normalize(padded)
+
+    relevance = np.einsum('nmd,nd->nm', padded, queries)
+    similarity = padded @ padded.transpose(0, 2, 1)
+
+    steps = min(max(limits), width)
+    selected = np.full((n, steps), -1, dtype=np.int64)
+    rows = np.arange(n)
+    redundancy = None
+    for step in range(steps):
+        scores = relevance if redundancy is None else lambda_mult * relevance - (1 - lambda_mult) * redundancy
+        scores = np.where(available, scores, -np.inf)
+        picked = scores.argmax(axis=1)
+        # queries with fewer candidates than steps have nothing left to pick
+        has_candidate = available[rows, picked]
+        selected[:, step] = np.where(has_candidate, picked, -1)
+        available[rows, picked] = False
+        picked_similarity = similarity[rows, picked]
+        redundancy = picked_similarity if redundancy is None else np.maximum(redundancy, picked_similarity)
+    return [[int(j) for j in selected[i, :limits[i]] if j >= 0] for i in range(n)]
@@ -0,0 +1,128 @@
+import json
+import os
+import shutil
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+_POOLINGS = ('cls', 'mean')
+
+
+def default_onnx_path(model_name, quantize=True):
+    return '../onnx_models/' + model_name.replace('/', '--') + ('-int8' if quantize else '-fp32')
+
+
+def export_onnx(model_name, path, quantize=True, opset=17):
+    # One-time export of a sentence-transformers model: the transformer goes to model.onnx (weights dynamically
+    # quantized to int8 if quantize), the tokenizer to tokenizer.json; pooling is done outside the graph.
+    # meta.json is written last, a directory without it is an interrupted export.
+    import torch
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+    from sentence_transformers import SentenceTransformer
+
+    model = SentenceTransformer(model_name, device='cpu')
+    transformer = model[0]
+    pooling = model[1].get_pooling_mode_str() if len(model) > 1 else 'cls'
+    if pooling not in _POOLINGS:
+        raise Exception(f"Pooling {pooling} of {model_name} is not supported by the ONNX backend")
+
+    class _HiddenStates(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask):
+            return self.auto_model(input_ids=input_ids, attention_mask=attention_mask).last_hidden_state
+
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    fp32_dir = path + os.sep + 'fp32' if quantize else path
+    os.makedirs(fp32_dir)
+    fp32_path = fp32_dir + os.sep + 'model.onnx'
+
+    print(f"Exporting {model_name} to {path}")
+    tokenizer = transformer.tokenizer
+    sample = tokenizer(['export sample text'], return_tensors='pt')
+    axes = {0: 'batch', 1: 'sequence'}
+    with torch.no_grad():
+        # the TorchScript exporter: dynamic batch/sequence axes without extra dependencies, and models
+        # over 2 GB (bge-m3 in fp32) are written with external weight files automatically
+        torch.onnx.export(_HiddenStates(transformer.auto_model.eval()),
+                          (sample['input_ids'], sample['attention_mask']), fp32_path,
+                          input_names=['input_ids', 'attention_mask'], output_names=['last_hidden_state'],
+                          dynamic_axes={'input_ids': axes, 'attention_mask': axes, 'last_hidden_state': axes},
+                          opset_version=opset, dynamo=False)
+
+    if quantize:
+        print("Quantizing weights to int8")
+        # int8 weights with activations quantized on the fly: no calibration set needed,
+        # MatMul/Gemm run on the VNNI / AVX2 integer kernels
+        quantize_dynamic(fp32_path, path + os.sep + 'model.onnx', weight_type=QuantType.QInt8, per_channel=True)
+        shutil.rmtree(fp32_dir)
+
+    tokenizer.save_pretrained(path)
+    meta = {
+        'model': model_name,
+        'pooling': pooling,
+        'max_seq_length': model.get_max_seq_length() or tokenizer.model_max_length,
+        'dim': model.get_sentence_embedding_dimension(),
+        'quantized': quantize,
+        'pad_token': tokenizer.pad_token,
+        'pad_token_id': tokenizer.pad_token_id,
+    }
+    with open(path + os.sep + 'meta.json.tmp', 'w') as f:
+        json.dump(meta, f, indent=2)
+    os.replace(path + os.sep + 'meta.json.tmp', path + os.sep + 'meta.json')
+    return path
+
+
+class OnnxEmbeddings(Embeddings):
+    # An exported model on ONNX Runtime's CPU provider. Same pooling and normalization as the
+    # sentence-transformers model it came from, so the vectors stay comparable with the fp32 ones.
+    def __init__(self, path, normalize=True, threads=None, batch_size=32):
+        import onnxruntime as ort
+        from tokenizers import Tokenizer
+
+        with open(path + os.sep + 'meta.json', 'r') as f:
+            self._meta = json.load(f)
+        self._normalize = normalize
+        self._batch_size = batch_size
+
+        # configured once: encode_batch of a tokenizer that is not reconfigured per call is safe from many threads
+        self._tokenizer = Tokenizer.from_file(path + os.sep + 'tokenizer.json')
+        self._tokenizer.enable_truncation(max_length=self._meta['max_seq_length'])
+        self._tokenizer.enable_padding(pad_id=self._meta['pad_token_id'], pad_token=self._meta['pad_token'])
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.inter_op_num_threads = 1
+        if threads:
+            options.intra_op_num_threads = threads
+        self._session = ort.InferenceSession(path + os.sep + 'model.onnx', options, providers=['CPUExecutionProvider'])
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(path + os.sep + 'meta.json')
+
+    def _embed(self, texts):
+        encodings = self._tokenizer.encode_batch(texts)
+        input_ids = np.asarray([e.ids for e in encodings], dtype=np.int64)
+        attention_mask = np.asarray([e.attention_mask for e in encodings], dtype=np.int64)
+        hidden = self._session.run(None, {'input_ids': input_ids, 'attention_mask': attention_mask})[0]
+        if self._meta['pooling'] == 'cls':
+            vectors = hidden[:, 0]
+        else:
+            mask = attention_mask[:, :, None].astype(hidden.dtype)
+            vectors = (hidden * mask).sum(axis=1) / np.maximum(mask.sum(axis=1), 1e-9)
+        if self._normalize:
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors.astype(np.float32).tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        result = []
+        for start in range(0, len(texts), self._batch_size):
+            result.extend(self._embed(texts[start:start + self._batch_size]))
+        return result
+
+    def embed_query(self, text: str) -> list[float]:
+        return self._embed([text])[0]
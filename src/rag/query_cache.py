@@ -0,0 +1,78 @@
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+
+from langchain_core.embeddings import Embeddings
+
+
+class QueryEmbeddingCache:
+    def __init__(self, max_size=1024, ttl=3600.0):
+        self._max_size = max_size
+        self._ttl = ttl
+        self._entries = OrderedDict()  # text -> (expires_at, vector)
+        self._inflight = {}  # text -> Future of the computation other callers wait on
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    def get_or_compute(self, key, compute):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[0] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+
+            future = self._inflight.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._inflight[key] = future
+                self.misses += 1
+            else:
+                self.coalesced += 1
+
+        if not owner:
+            return future.result()
+
+        try:
+            value = compute()
+        except BaseException as e:
+            with self._lock:
+                del self._inflight[key]
+            future.set_exception(e)
+            raise
+
+        with self._lock:
+            del self._inflight[key]
+            self._entries[key] = (time.monotonic() + self._ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self._max_size:
+                self._entries.popitem(last=False)
+        future.set_result(value)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def get_stats(self):
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses, 'coalesced': self.coalesced}
+
+
+class CachedQueryEmbeddings(Embeddings):
+    def __init__(self, embeddings: Embeddings, cache: QueryEmbeddingCache):
+        self._embeddings = embeddings
+        self._cache = cache
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self._embeddings.embed_documents(texts)
+
+    def embed_query(self, text: str) -> list[float]:
+        # Cached vectors are shared, hand out copies
+        return list(self._cache.get_or_compute(text, lambda: tuple(self._embeddings.embed_query(text))))
@@ -0,0 +1,101 @@
+import asyncio
+import threading
+import time
+
+from rag.embedder import Embedder
+from rag.vector_store import ChromaStore, QdrantStore, NumpyStore
+
+_STORE_TYPES = {
+    'chroma': ChromaStore,
+    'qdrant': QdrantStore,
+    'numpy': NumpyStore,
+}
+
+
+class StoreRegistry:
+    # config: store name -> {'type': 'chroma' | 'qdrant' | 'numpy', 'lexical': optional fusion kwargs,
+    #                        'classifier': optional category classifier kwargs, **constructor kwargs}
+    def __init__(self, config: dict, embedder_kwargs: dict = None):
+        self._config = config
+        self._embedder_kwargs = embedder_kwargs or {}
+        self._embedder = None
+        self._stores = {}
+        self._lock = threading.Lock()
+        self._store_locks = {name: threading.Lock() for name in config}
+        self._ready = False
+
+    def names(self):
+        return list(self._config.keys())
+
+    def get_type(self, name):
+        return self._config[name]['type']
+
+    def is_ready(self):
+        return self._ready
+
+    def get_embedder(self) -> Embedder:
+        if self._embedder is None:
+            with self._lock:
+                if self._embedder is None:
+                    start = time.time()
+                    self._embedder = Embedder(**self._embedder_kwargs)
+                    print(f"Embedder {self._embedder.get_model_name()} loaded for {time.time() - start} seconds")
+        return self._embedder
+
+    def get_loaded_embedder(self):
+        # None until something needed the model, for callers that must not trigger the load (metrics)
+        return self._embedder
+
+    def get(self, name):
+        store = self._stores.get(name)
+        if store is not None:
+            return store
+        if name not in self._config:
+            raise KeyError(f"Unknown store {name}")
+
+        with self._store_locks[name]:
+            if name not in self._stores:
+                config = dict(self._config[name])
+                store_type = _STORE_TYPES[config.pop('type')]
+                lexical = config.pop('lexical', None)
+                classifier = config.pop('classifier', None)
+                start = time.time()
+                store = store_type(embedder=self.get_embedder().get_model(), **config)
+                if lexical is not None:
+                    store.load_lexical_index(**lexical)
+                if classifier is not None:
+                    store.load_category_classifier(**classifier)
+                self._stores[name] = store
+                print(f"Store {name} built for {time.time() - start} seconds")
+        return self._stores[name]
+
+    def preload(self):
+        # Load the model weights only. Run it in a parent process before forking workers so they
+        # share the pages copy-on-write; inference (and its thread pools) must start after the fork.
+        self.get_embedder()
+        return self
+
+    async def awarm_up(self, names=None):
+        # Run on the serving event loop: searches go through the same async path as requests, so stores with
+        # an async client (Qdrant) open its connections here rather than on the first request.
+        # Loading the model and building the stores is blocking and stays in the executor.
+        loop = asyncio.get_running_loop()
+        timings = {}
+        start = time.time()
+        vector = await loop.run_in_executor(None, lambda: self.get_embedder().get_embedding('warm up'))
+        timings['embedder'] = time.time() - start
+
+        for name in names if names is not None else self.names():
+            start = time.time()
+            try:
+                store = await loop.run_in_executor(None, self.get, name)
+                await store.afind_splits('warm up', limit=1, vector=vector)
+                timings[name] = time.time() - start
+            except Exception as e:
+                # A store that is down must not keep the others from serving
+                print(f"Warm up of store {name} failed: {e}")
+                timings[name] = None
+
+        self._ready = True
+        print(f"Warm up done: {timings}")
+        return timings
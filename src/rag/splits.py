@@ -0,0 +1,110 @@
+from langchain_core.documents import Document
+
+
+class SplitRecord:
+    # One chunk: text, index of its metadata layout in the table and the per-chunk metadata values
+    __slots__ = ('id', 'text', 'meta', 'values')
+
+    def __init__(self, id, text, meta, values):
+        self.id = id
+        self.text = text
+        self.meta = meta
+        self.values = values
+
+
+class SplitTable:
+    # Resident splits without a metadata dict per chunk. Chunks of one PDF share everything but a few keys
+    # (page, offset, id), so the shared part is interned once per document and a chunk keeps only its values.
+    # Iterating yields regular Documents built on demand.
+    CHUNK_KEYS = frozenset({'page', 'page_label', 'start_index', 'chunk_id'})
+
+    def __init__(self):
+        self._records = []
+        # meta id -> (shared (key, value) items, per-chunk keys)
+        self._metas = []
+        self._meta_ids = {}
+
+    @classmethod
+    def from_documents(cls, docs):
+        table = cls()
+        table.extend(docs)
+        return table
+
+    def _intern(self, shared, chunk_keys):
+        key = (shared, chunk_keys)
+        try:
+            meta = self._meta_ids.get(key)
+        except TypeError:
+            # unhashable metadata values, keep this layout uninterned
+            self._metas.append(key)
+            return len(self._metas) - 1
+        if meta is None:
+            meta = len(self._metas)
+            self._metas.append(key)
+            self._meta_ids[key] = meta
+        return meta
+
+    def append(self, doc):
+        shared = []
+        chunk_keys = []
+        values = []
+        for k, v in doc.metadata.items():
+            if k in self.CHUNK_KEYS:
+                chunk_keys.append(k)
+                values.append(v)
+            else:
+                shared.append((k, v))
+        meta = self._intern(tuple(shared), tuple(chunk_keys))
+        self._records.append(SplitRecord(doc.id, doc.page_content, meta, tuple(values)))
+
+    def extend(self, docs):
+        for doc in docs:
+            self.append(doc)
+        return self
+
+    def clear(self):
+        self._records.clear()
+        self._metas.clear()
+        self._meta_ids.clear()
+
+    def _to_document(self, record):
+        shared, chunk_keys = self._metas[record.meta]
+        metadata = dict(shared)
+        metadata.update(zip(chunk_keys, record.values))
+        return Document(id=record.id, page_content=record.text, metadata=metadata)
+
+    def __len__(self):
+        return len(self._records)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._to_document(record) for record in self._records[i]]
+        return self._to_document(self._records[i])
+
+    def __iter__(self):
+        for record in self._records:
+            yield self._to_document(record)
+
+    def iter_texts(self):
+        for record in self._records:
+            yield record.text
+
+    def __getstate__(self):
+        # Column lists pickle much smaller than one slotted object per chunk (worker -> parent transfer)
+        return {
+            'ids': [r.id for r in self._records],
+            'texts': [r.text for r in self._records],
+            'metas': [r.meta for r in self._records],
+            'values': [r.values for r in self._records],
+            'layouts': self._metas,
+        }
+
+    def __setstate__(self, state):
+        self._metas = state['layouts']
+        self._meta_ids = {}
+        for meta, key in enumerate(self._metas):
+            try:
+                self._meta_ids.setdefault(key, meta)
+            except TypeError:
+                pass
+        self._records = [SplitRecord(*fields) for fields in zip(state['ids'], state['texts'], state['metas'], state['values'])]
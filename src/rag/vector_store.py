@@ -1,11 +1,30 @@
 from langchain_chroma import Chroma
+from langchain_core.documents import Document
+from langchain_core.runnables import RunnableLambda
 from langchain_qdrant import QdrantVectorStore
-from qdrant_client import QdrantClient, models
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
+import numpy as np
 
+import asyncio
+import functools
+import glob
+import json
 import os
+import queue
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from qdrant_client.models import HnswConfigDiff, VectorParams
 
+from rag.bm25 import BM25Index
+from rag.classifier import CategoryClassifier
+from rag.metrics import EMBEDDING_BATCH_SIZE, time_stage
+from rag.mmr import mmr_select_batch
+
 
 class VectorStore:
     def __init__(self, embedder, space='cosine', construction_ef=100, M=16, search_ef=10):
@@ -15,22 +34,325 @@ class VectorStore:
         self._M = M
         self._search_ef = search_ef
         self._vector_store = None
+        self._name = None
+        self._lexical_index = None
+        self._lock = threading.RLock()
+        self._fusion = {'dense_weight': 1.0, 'lexical_weight': 1.0, 'rrf_k': 60, 'candidates': 50}
+        self._bulk_load = None
+        self._classifier = None
+        self._classification = {'min_confidence': 0.6, 'coverage': 0.9, 'max_categories': 3}
 
     def get_embedder(self):
         return self._embedder
 
-    def store_splits(self, splits):
-        self._vector_store.add_documents(splits)
+    def get_name(self):
+        return self._name
+
+    def _get_vector_dim(self):
+        return len(self._embedder.embed_query('dimension probe'))
+
+    def store_splits(self, splits, ids=None):
+        self._vector_store.add_documents(splits, ids=ids)
+
+    def delete_splits(self, ids):
+        self._vector_store.delete(ids=ids)
+
+    def write_vectors(self, splits, vectors, ids=None):
+        raise NotImplementedError
+
+    def bulk_loads_in_place(self):
+        # True: a bulk load empties the live collection and fills it; False: it builds a copy that
+        # finish_bulk_load() swaps in, the live store (and its manifest) stay valid until then
+        return True
+
+    def begin_bulk_load(self):
+        # Full rebuild: start from an empty collection tuned for loading, finish_bulk_load() makes it searchable.
+        # Stores without a dedicated path just recreate the collection.
+        self._bulk_load = {'started': time.time()}
+        self.setup_collection(recreate=True)
+        self._bulk_load['loading'] = time.time()
+        return True
+
+    def finish_bulk_load(self):
+        # Returns per-phase seconds: create, load and index
+        bulk, self._bulk_load = self._bulk_load, None
+        if bulk is None:
+            raise Exception("finish_bulk_load() without begin_bulk_load()")
+        now = time.time()
+        timings = {'create_seconds': bulk['loading'] - bulk['started'], 'load_seconds': now - bulk['loading'],
+                   'index_seconds': 0.0}
+        timings['index_seconds'] = self._finish_bulk_load(bulk) or 0.0
+        timings['total_seconds'] = time.time() - bulk['started']
+        print(f"Bulk load of {self._name}: " + ", ".join(f"{k} {v:.1f}" for k, v in timings.items()))
+        return timings
+
+    def _finish_bulk_load(self, bulk):
+        return 0.0
+
+    def abort_bulk_load(self):
+        # A bulk load that failed half way. Stores loading in place finish it: what was written is in the store
+        # and in the manifest (committed batch by batch), an incremental run adds the rest.
+        # Stores building out of place discard the build instead.
+        if self._bulk_load is not None:
+            print(f"Bulk load of {self._name} interrupted, finishing it with the points loaded so far")
+            self.finish_bulk_load()
+
+    def iter_splits(self, batch_size=1024):
+        # Yields every stored split with Document.id set to the store id
+        raise NotImplementedError
+
+    def iter_rows(self, batch_size=1024):
+        # Yields (splits, vectors, ids) batches of every stored split together with its vector
+        raise NotImplementedError
+
+    def count(self):
+        raise NotImplementedError
+
+    def _get_version_path(self):
+        return f'../{self._name}_version'
+
+    def bump_version(self):
+        # Marks the content as changed for caches built on top of the store
+        with open(self._get_version_path(), 'w') as f:
+            f.write(uuid.uuid4().hex)
+
+    def get_version(self):
+        marker = None
+        if os.path.exists(self._get_version_path()):
+            with open(self._get_version_path(), 'r') as f:
+                marker = f.read().strip()
+        return self.count(), marker
+
+    def get_splits_by_ids(self, ids):
+        raise NotImplementedError
+
+    def get_lexical_path(self):
+        return f'../{self._name}_bm25/'
+
+    def build_lexical_index(self, k1=1.2, b=0.75):
+        self._lexical_index = BM25Index.build(self.get_lexical_path(), self.iter_splits(), k1=k1, b=b)
+        return self._lexical_index
+
+    def load_lexical_index(self, dense_weight=1.0, lexical_weight=1.0, rrf_k=60, candidates=50):
+        self._fusion = {'dense_weight': dense_weight, 'lexical_weight': lexical_weight, 'rrf_k': rrf_k, 'candidates': candidates}
+        if not BM25Index.exists(self.get_lexical_path()):
+            print(f"No lexical index at {self.get_lexical_path()}, hybrid search falls back to dense only")
+            return None
+        self._lexical_index = BM25Index(self.get_lexical_path())
+        return self._lexical_index
+
+    def get_classifier_path(self):
+        return f'../{self._name}_classifier/'
+
+    def build_category_classifier(self, temperature=0.02):
+        self._classifier = CategoryClassifier.build(self.get_classifier_path(), self.iter_rows(), temperature=temperature)
+        return self._classifier
+
+    def load_category_classifier(self, min_confidence=0.6, coverage=0.9, max_categories=3):
+        self._classification = {'min_confidence': min_confidence, 'coverage': coverage, 'max_categories': max_categories}
+        if not CategoryClassifier.exists(self.get_classifier_path()):
+            print(f"No category classifier at {self.get_classifier_path()}, queries are routed by the LLM")
+            return None
+        self._classifier = CategoryClassifier(self.get_classifier_path())
+        return self._classifier
+
+    def classify_query(self, vector):
+        # Categories predicted from the query vector, None when there is no classifier or it is not confident
+        if self._classifier is None:
+            return None
+        params = self._classification
+        with time_stage('classify', self._name):
+            categories, confidence = self._classifier.classify(vector, coverage=params['coverage'],
+                                                               max_categories=params['max_categories'])
+        if not categories or confidence < params['min_confidence']:
+            return None
+        return categories
+
+    def find_splits_hybrid(self, query: str, limit: int=100, categories: list[str] = None, vector: list[float] = None,
+                           search_params=None):
+        # Reciprocal-rank fusion of dense and BM25 results: score = sum(weight / (rrf_k + rank))
+        fusion = self._fusion
+        candidates = max(limit, fusion['candidates'])
+        dense = self.find_splits(query, limit=candidates, categories=categories, vector=vector, search_params=search_params)
+        if self._lexical_index is None:
+            return dense[:limit]
+        with time_stage('lexical_search', self._name):
+            lexical = self._lexical_index.search(query, limit=candidates, categories=categories)
+
+        scores = {}
+        docs = {}
+        for rank, (doc, _) in enumerate(dense):
+            key = doc.id or doc.metadata.get('chunk_id')
+            docs[key] = doc
+            scores[key] = scores.get(key, 0.0) + fusion['dense_weight'] / (fusion['rrf_k'] + rank + 1)
+        for rank, (key, _) in enumerate(lexical):
+            scores[key] = scores.get(key, 0.0) + fusion['lexical_weight'] / (fusion['rrf_k'] + rank + 1)
+
+        top = sorted(scores, key=scores.get, reverse=True)[:limit]
+        missing = [key for key in top if key not in docs]
+        if missing:
+            for doc in self.get_splits_by_ids(missing):
+                docs[doc.id] = doc
+        return [(docs[key], scores[key]) for key in top if key in docs]
+
+    async def afind_splits_hybrid(self, query: str, limit: int=100, categories: list[str] = None, vector: list[float] = None,
+                                  search_params=None):
+        if vector is None:
+            vector = await self.aembed_query(query)
+        return await self._run_in_executor(self.find_splits_hybrid, query, limit=limit, categories=categories, vector=vector,
+                                           search_params=search_params)
+
+    def embed_query(self, query: str):
+        with time_stage('embed_query', self._name):
+            return self._embedder.embed_query(query)
+
+    def find_splits(self, query: str, limit: int=100, categories: list[str] = None, vector: list[float] = None,
+                    search_params=None):
+        # Pass a precomputed vector to search several stores with one query embedding.
+        # search_params: a tier name or a dict of 'hnsw_ef', 'exact', 'rescore', 'oversampling';
+        # stores without search-time knobs ignore it.
+        if vector is None:
+            vector = self.embed_query(query)
+        with time_stage('search', self._name):
+            return self.find_splits_by_vector(vector, limit=limit, categories=categories, search_params=search_params)
+
+    def find_splits_by_vector(self, vector: list[float], limit: int=100, categories: list[str] = None, search_params=None):
+        raise NotImplementedError
+
+    @staticmethod
+    def _per_query(value, n):
+        return value if isinstance(value, list) else [value] * n
+
+    @staticmethod
+    def _group_by_categories(categories):
+        # Queries sharing the same filter can go to the backend in one call
+        groups = {}
+        for i, c in enumerate(categories):
+            groups.setdefault(None if c is None else tuple(sorted(c)), []).append(i)
+        return groups
+
+    def find_splits_batch(self, queries: list[str], limits=100, categories: list = None, vectors=None, search_params=None):
+        # limits: one int for all queries or a list; categories: None or a per-query list of category lists / None
+        if vectors is None:
+            vectors = self._embed_queries(queries)
+        with time_stage('search_batch', self._name):
+            return self.find_splits_batch_by_vectors(vectors, limits=limits, categories=categories, search_params=search_params)
+
+    def _embed_queries(self, queries):
+        EMBEDDING_BATCH_SIZE.observe(len(queries), path='query_batch')
+        with time_stage('embed_queries', self._name):
+            return self._embedder.embed_documents(queries)
+
+    def find_splits_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        limits = self._per_query(limits, len(vectors))
+        categories = categories or [None] * len(vectors)
+        return [self.find_splits_by_vector(v, limit=l, categories=c, search_params=search_params)
+                for v, l, c in zip(vectors, limits, categories)]
+
+    async def afind_splits_batch(self, queries: list[str], limits=100, categories: list = None, vectors=None,
+                                 search_params=None):
+        if vectors is None:
+            vectors = await self._run_in_executor(self._embed_queries, queries)
+        with time_stage('search_batch', self._name):
+            return await self.afind_splits_batch_by_vectors(vectors, limits=limits, categories=categories,
+                                                            search_params=search_params)
+
+    async def afind_splits_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return await self._run_in_executor(self.find_splits_batch_by_vectors, vectors, limits=limits, categories=categories,
+                                           search_params=search_params)
+
+    async def _run_in_executor(self, func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    async def aembed_query(self, query: str):
+        # CPU bound, keep it off the event loop
+        return await self._run_in_executor(self.embed_query, query)
+
+    async def afind_splits(self, query: str, limit: int=100, categories: list[str] = None, vector: list[float] = None,
+                           search_params=None):
+        if vector is None:
+            vector = await self.aembed_query(query)
+        with time_stage('search', self._name):
+            return await self.afind_splits_by_vector(vector, limit=limit, categories=categories, search_params=search_params)
+
+    async def afind_splits_by_vector(self, vector: list[float], limit: int=100, categories: list[str] = None,
+                                     search_params=None):
+        return await self._run_in_executor(self.find_splits_by_vector, vector, limit=limit, categories=categories,
+                                           search_params=search_params)
+
+    def find_candidates_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        # Same search as find_splits_batch_by_vectors, each result also carries the stored vectors of its splits:
+        # per query ([(split, score)], (n, dim) array), fetched in the same call
+        raise NotImplementedError
+
+    async def afind_candidates_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return await self._run_in_executor(self.find_candidates_batch_by_vectors, vectors, limits=limits,
+                                           categories=categories, search_params=search_params)
+
+    def _select_mmr(self, vectors, candidates, limits, lambda_mult):
+        with time_stage('mmr', self._name):
+            selections = mmr_select_batch(vectors, [candidate_vectors for _, candidate_vectors in candidates],
+                                          self._per_query(limits, len(candidates)), lambda_mult=lambda_mult)
+        return [[splits[j] for j in selection] for (splits, _), selection in zip(candidates, selections)]
+
+    def find_splits_mmr_batch(self, queries: list[str], limits=15, fetch_limits=70, lambda_mult=0.5, categories: list = None,
+                              vectors=None, search_params=None):
+        # Maximal marginal relevance over the fetch_limits nearest splits, on the vectors the store returns with them
+        # (nothing is re-embedded). limits / fetch_limits: one int for all queries or a list.
+        if vectors is None:
+            vectors = self._embed_queries(queries)
+        with time_stage('search_mmr', self._name):
+            candidates = self.find_candidates_batch_by_vectors(vectors, limits=fetch_limits, categories=categories,
+                                                               search_params=search_params)
+            return self._select_mmr(vectors, candidates, limits, lambda_mult)
+
+    async def afind_splits_mmr_batch(self, queries: list[str], limits=15, fetch_limits=70, lambda_mult=0.5,
+                                     categories: list = None, vectors=None, search_params=None):
+        if vectors is None:
+            vectors = await self._run_in_executor(self._embed_queries, queries)
+        with time_stage('search_mmr', self._name):
+            candidates = await self.afind_candidates_batch_by_vectors(vectors, limits=fetch_limits, categories=categories,
+                                                                      search_params=search_params)
+            return self._select_mmr(vectors, candidates, limits, lambda_mult)
+
+    def find_splits_mmr(self, query: str, limit: int=15, fetch_limit: int=70, lambda_mult=0.5, categories: list[str] = None,
+                        vector: list[float] = None, search_params=None):
+        if vector is None:
+            vector = self.embed_query(query)
+        return self.find_splits_mmr_batch(None, limits=limit, fetch_limits=fetch_limit, lambda_mult=lambda_mult,
+                                          categories=[categories], vectors=[vector], search_params=search_params)[0]
 
-    def find_splits(self, query: str, limit: int=100, categories: list[str] = None):
-        return self._vector_store.similarity_search_with_score(query, limit)
+    async def afind_splits_mmr(self, query: str, limit: int=15, fetch_limit: int=70, lambda_mult=0.5,
+                               categories: list[str] = None, vector: list[float] = None, search_params=None):
+        if vector is None:
+            vector = await self.aembed_query(query)
+        return (await self.afind_splits_mmr_batch(None, limits=limit, fetch_limits=fetch_limit, lambda_mult=lambda_mult,
+                                                  categories=[categories], vectors=[vector],
+                                                  search_params=search_params))[0]
 
-    def get_retriever(self, limit: int=100, fetch_limit: int=100, search_type: str='similarity'):
+    def _get_mmr_retriever(self, limit, fetch_limit, lambda_mult, search_params):
+        def _retrieve(query):
+            return [doc for doc, _ in self.find_splits_mmr(query, limit=limit, fetch_limit=fetch_limit,
+                                                           lambda_mult=lambda_mult, search_params=search_params)]
+
+        async def _aretrieve(query):
+            return [doc for doc, _ in await self.afind_splits_mmr(query, limit=limit, fetch_limit=fetch_limit,
+                                                                  lambda_mult=lambda_mult, search_params=search_params)]
+
+        return RunnableLambda(_retrieve, afunc=_aretrieve)
+
+    def _get_retriever_search_kwargs(self, search_params):
+        return {}
+
+    def get_retriever(self, limit: int=100, fetch_limit: int=100, search_type: str='similarity', search_params=None,
+                      lambda_mult=0.5):
+        # 'mmr' runs the store's own MMR (find_splits_mmr) instead of LangChain's per-request Python loop
+        if search_type == 'mmr':
+            return self._get_mmr_retriever(limit, fetch_limit, lambda_mult, search_params)
         search_kwargs = {
             'k': limit,
         }
-        if search_type == 'mmr':
-            search_kwargs['fetch_k'] = fetch_limit
+        search_kwargs.update(self._get_retriever_search_kwargs(search_params))
 
         return self._vector_store.as_retriever(
             search_type=search_type,
@@ -38,26 +360,200 @@ class VectorStore:
         )
 
 class ChromaStore(VectorStore):
-    def __init__(self, embedder, space='cosine', construction_ef=100, M=16, search_ef=10):
+    def __init__(self, embedder, space='cosine', construction_ef=100, M=16, search_ef=10, name_prefix=None):
         super().__init__(embedder=embedder, space=space, construction_ef=construction_ef, M=M, search_ef=search_ef)
-        self._vector_store = Chroma(collection_name='arxiv',
-                                    persist_directory=f'../chroma_{space}_{construction_ef}_{M}_{search_ef}/',
-                                    embedding_function=self.get_embedder(),
-                                    collection_metadata={
-                                        'hnsw:space': self._space,
-                                        'hnsw:construction_ef': self._construction_ef,
-                                        'hnsw:M': self._M,
-                                        'hnsw:search_ef': self._search_ef
-                                    })
-
-    def find_splits(self, query: str, limit: int=100, categories: list[str] = None):
+        # name_prefix keeps experiment stores (e.g. the HNSW sweep) apart from the served ones
+        self._name = (f'{name_prefix}_' if name_prefix else '') + f'chroma_{space}_{construction_ef}_{M}_{search_ef}'
+        self._persist_directory = f'../{self._name}'
+        self._vector_store = self._open(self._persist_directory)
+
+    def get_persist_directory(self):
+        return os.path.realpath(self._persist_directory)
+
+    def drop(self):
+        # Removes the whole persisted store, the object is unusable afterwards
+        self._vector_store = None
+        self._discard_leftover_builds()
+        shutil.rmtree(self.get_persist_directory(), ignore_errors=True)
+        if os.path.islink(self._persist_directory):
+            os.remove(self._persist_directory)
+
+    def _open(self, persist_directory, **metadata):
+        return Chroma(collection_name='arxiv',
+                      persist_directory=persist_directory + '/',
+                      embedding_function=self.get_embedder(),
+                      collection_metadata={
+                          'hnsw:space': self._space,
+                          'hnsw:construction_ef': self._construction_ef,
+                          'hnsw:M': self._M,
+                          'hnsw:search_ef': self._search_ef,
+                          **metadata,
+                      })
+
+    def bulk_loads_in_place(self):
+        return False
+
+    def _discard_leftover_builds(self):
+        # The generation replaced by the last swap, build directories of a bulk load that died before the swap
+        # and anything a crashed swap left behind. Only the next bulk load calls this: until then processes
+        # that opened the previous generation (a serving app's cached client) keep reading it.
+        live = os.path.realpath(self._persist_directory)
+        for path in glob.glob(f'{self._persist_directory}.build-*') + glob.glob(f'{self._persist_directory}.old-*') \
+                + glob.glob(f'{self._persist_directory}.link-*'):
+            if os.path.realpath(path) == live:
+                continue
+            print(f"Removing leftover {path}")
+            if os.path.islink(path) or not os.path.isdir(path):
+                os.remove(path)
+            else:
+                self._release_client(path)
+                shutil.rmtree(path, ignore_errors=True)
+
+    def begin_bulk_load(self, batch_size=10000, sync_threshold=100000):
+        # Builds into a fresh directory next to the live one, which keeps serving until the swap.
+        # Bigger HNSW batch / sync thresholds let Chroma insert and persist in larger steps.
+        # The build has its own manifest (see prepare_store), an interrupted build is discarded by the next run.
+        self._discard_leftover_builds()
+        self._bulk_load = {'started': time.time(), 'directory': f'{self._persist_directory}.build-{uuid.uuid4().hex[:8]}',
+                           'live': self._vector_store}
+        self._vector_store = self._open(self._bulk_load['directory'],
+                                        **{'hnsw:batch_size': batch_size, 'hnsw:sync_threshold': sync_threshold})
+        self._bulk_load['loading'] = time.time()
+        return True
+
+    def _finish_bulk_load(self, bulk):
+        # The live path is a symlink to the current build, replacing the link is atomic for readers.
+        # The previous generation stays on disk for readers that still have it open, the next bulk load removes it.
+        start = time.time()
+        target = self._persist_directory
+        if os.path.exists(target) and not os.path.islink(target):
+            # first bulk load over a plain directory: move it aside once
+            os.rename(target, f'{target}.old-{uuid.uuid4().hex[:8]}')
+        link = f'{target}.link-{uuid.uuid4().hex[:8]}'
+        os.symlink(os.path.basename(bulk['directory']), link)
+        os.replace(link, target)
+        # keep the build directory client: the live path's client still holds the pre-swap database
+        self._release_client(target)
+        return time.time() - start
+
+    @staticmethod
+    def _release_client(persist_directory):
+        # chromadb caches one System per persist path for the whole process, a later Chroma() on the same path
+        # would get it back. Stop and forget the one of a path whose database was swapped out or removed.
+        from chromadb.api.shared_system_client import SharedSystemClient
+        for key in (persist_directory, persist_directory + '/'):
+            system = SharedSystemClient._identifier_to_system.pop(key, None)
+            if system is not None:
+                system.stop()
+
+    def abort_bulk_load(self):
+        bulk, self._bulk_load = self._bulk_load, None
+        if bulk is None:
+            return
+        print(f"Bulk load of {self._name} interrupted, discarding {bulk['directory']}")
+        self._vector_store = bulk['live']
+        self._release_client(bulk['directory'])
+        shutil.rmtree(bulk['directory'], ignore_errors=True)
+
+    def setup_collection(self, recreate=True):
+        if recreate:
+            self._vector_store.reset_collection()
+        return self._vector_store._collection.count() == 0
+
+    def write_vectors(self, splits, vectors, ids=None):
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in splits]
+        collection = self._vector_store._collection
+        # upsert keeps re-runs of a crashed batch idempotent
+        max_batch = self._vector_store._client.get_max_batch_size()
+        for i in range(0, len(splits), max_batch):
+            collection.upsert(
+                ids=ids[i:i + max_batch],
+                embeddings=[list(v) for v in vectors[i:i + max_batch]],
+                documents=[s.page_content for s in splits[i:i + max_batch]],
+                metadatas=[s.metadata for s in splits[i:i + max_batch]],
+            )
+
+    def _get_filter(self, categories):
         if categories is None:
-            return super().find_splits(query=query, limit=limit)
+            return None
+        # Chroma keeps metadata flat, there is no 'metadata.' prefix
+        return {'loaded_category': {'$in': list(categories)}}
+
+    @staticmethod
+    def _to_documents(response):
+        return [
+            Document(id=cid, page_content=text, metadata=metadata or {})
+            for cid, text, metadata in zip(response['ids'], response['documents'], response['metadatas'])
+        ]
+
+    def iter_splits(self, batch_size=1024):
+        offset = 0
+        while True:
+            response = self._vector_store._collection.get(limit=batch_size, offset=offset, include=['documents', 'metadatas'])
+            if not response['ids']:
+                return
+            yield from self._to_documents(response)
+            offset += len(response['ids'])
+
+    def iter_rows(self, batch_size=1024):
+        offset = 0
+        while True:
+            response = self._vector_store._collection.get(limit=batch_size, offset=offset,
+                                                          include=['documents', 'metadatas', 'embeddings'])
+            if not response['ids']:
+                return
+            yield self._to_documents(response), np.asarray(response['embeddings'], dtype=np.float32), list(response['ids'])
+            offset += len(response['ids'])
 
-        return self._vector_store.similarity_search_with_score(query=query, k=limit, filter={'metadata.loaded_category': {'$in': categories}})
+    def count(self):
+        return self._vector_store._collection.count()
+
+    def get_splits_by_ids(self, ids):
+        return self._to_documents(self._vector_store._collection.get(ids=list(ids), include=['documents', 'metadatas']))
+
+    def find_splits_by_vector(self, vector: list[float], limit: int=100, categories: list[str] = None, search_params=None):
+        return self._vector_store.similarity_search_by_vector_with_relevance_scores(embedding=vector, k=limit, filter=self._get_filter(categories))
+
+    def _query_batch(self, vectors, limits, categories, with_vectors=False):
+        limits = self._per_query(limits, len(vectors))
+        results = [None] * len(vectors)
+        for group, indexes in self._group_by_categories(categories or [None] * len(vectors)).items():
+            n_results = max(limits[i] for i in indexes)
+            response = self._vector_store._collection.query(
+                query_embeddings=[list(vectors[i]) for i in indexes],
+                n_results=n_results,
+                where=self._get_filter(group),
+                include=['documents', 'metadatas', 'distances'] + (['embeddings'] if with_vectors else []),
+            )
+            for j, i in enumerate(indexes):
+                results[i] = [
+                    (Document(id=cid, page_content=text, metadata=metadata or {}), distance)
+                    for cid, text, metadata, distance in zip(response['ids'][j], response['documents'][j],
+                                                            response['metadatas'][j], response['distances'][j])
+                ][:limits[i]]
+                if with_vectors:
+                    results[i] = (results[i], np.asarray(response['embeddings'][j], dtype=np.float32)[:limits[i]])
+        return results
+
+    def find_splits_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return self._query_batch(vectors, limits, categories)
+
+    def find_candidates_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return self._query_batch(vectors, limits, categories, with_vectors=True)
 
 
 class QdrantStore(VectorStore):
+    # partitioning: None    - one collection, category filter on an indexed payload field
+    #               'tenant'  - one collection, category index marked is_tenant with per-category HNSW links
+    #               'collections' - one collection per category, queries are routed to the relevant ones
+    _COLLECTION_SUFFIXES = {None: '', 'tenant': '_tenant', 'collections': '_parts'}
+    # quantization: 'scalar' - INT8, 4x smaller vectors; 'binary' - 1 bit per dimension, 32x smaller,
+    # needs oversampling with rescoring on the original vectors to keep recall
+    _QUANTIZATION_SUFFIXES = {None: '_noq', 'scalar': '', 'binary': '_bq'}
+    # indexing threshold (KB) restored after a bulk load
+    _INDEXING_THRESHOLD = 20000
+
     def _get_distance(self):
         if self._space == 'cosine':
             return models.Distance.COSINE
@@ -70,80 +566,876 @@ class QdrantStore(VectorStore):
         else:
             raise Exception("Space must be one of 'cosine', 'euclid', 'dot', 'manhattan'")
 
-    def __init__(self, embedder, space='cosine', construction_ef=100, M=16, search_ef=10, need_setup=False):
+    def __init__(self, embedder, space='cosine', construction_ef=100, M=16, search_ef=10, need_setup=False,
+                 upload_batch_size=256, upload_parallel=1, location=None, partitioning=None, quantization='scalar',
+                 search_tiers=None, name_prefix=None):
 
         super().__init__(embedder=embedder, space=space, construction_ef=construction_ef, M=M, search_ef=search_ef)
+        if partitioning not in self._COLLECTION_SUFFIXES:
+            raise Exception("Partitioning must be one of None, 'tenant', 'collections'")
+        if quantization not in self._QUANTIZATION_SUFFIXES:
+            raise Exception("Quantization must be one of None, 'scalar', 'binary'")
+        self._upload_batch_size = upload_batch_size
+        self._upload_parallel = upload_parallel
+        self._partitioning = partitioning
+        self._quantization = quantization
+        # Search-time tiers served by the same collection; 'default' applies when a call passes nothing
+        self._search_tiers = {
+            'default': {'hnsw_ef': search_ef, 'exact': False, 'rescore': True,
+                        'oversampling': 3.0 if quantization == 'binary' else 1.0},
+            'fast': {'hnsw_ef': max(search_ef, 16), 'exact': False, 'rescore': False, 'oversampling': 1.0},
+            'accurate': {'hnsw_ef': max(search_ef, 256), 'exact': False, 'rescore': True,
+                         'oversampling': 4.0 if quantization == 'binary' else 2.0},
+            'exact': {'hnsw_ef': None, 'exact': True, 'rescore': True, 'oversampling': 1.0},
+            **(search_tiers or {}),
+        }
 
-        self._client = QdrantClient(url=os.environ['QDRANT_URL'])
-        self._collection_name = f'arxiv_{space}_{construction_ef}_{M}_{search_ef}'
+        # location: None = server from QDRANT_URL, ':memory:' or a local path = embedded Qdrant
+        self._async_client = None
+        if location is None:
+            self._client = QdrantClient(url=os.environ['QDRANT_URL'])
+            # Embedded modes keep data inside the sync client, so only a server gets an async client
+            self._async_client = AsyncQdrantClient(url=os.environ['QDRANT_URL'])
+        elif location == ':memory:':
+            self._client = QdrantClient(location=location)
+        else:
+            self._client = QdrantClient(path=location)
+        self._collection_name = (f'{name_prefix}_' if name_prefix else '') \
+            + f'arxiv_{space}_{construction_ef}_{M}_{search_ef}' + self._COLLECTION_SUFFIXES[partitioning] \
+            + self._QUANTIZATION_SUFFIXES[quantization]
+        self._name = self._collection_name
+        self._partitions = None
+        self._executor = None
 
         if need_setup:
             self.setup_collection()
 
-        self._vector_store = QdrantVectorStore(
-            collection_name=self._collection_name,
-            distance=self._get_distance(),
-            client=self._client,
-            embedding=self.get_embedder()
-        )
+    def _get_langchain_store(self):
+        if self._vector_store is None:
+            if self._partitioning == 'collections':
+                raise Exception("LangChain retrievers need a single collection layout")
+            self._vector_store = QdrantVectorStore(
+                collection_name=self._collection_name,
+                distance=self._get_distance(),
+                client=self._client,
+                embedding=self.get_embedder()
+            )
+        return self._vector_store
+
+    def get_retriever(self, limit: int=100, fetch_limit: int=100, search_type: str='similarity', search_params=None,
+                      lambda_mult=0.5):
+        # the native MMR retriever goes through query_batch_points and works with every partitioning
+        if search_type != 'mmr':
+            self._get_langchain_store()
+        return super().get_retriever(limit=limit, fetch_limit=fetch_limit, search_type=search_type, search_params=search_params,
+                                     lambda_mult=lambda_mult)
 
-    def find_splits(self, query: str, limit: int=100, categories: list[str] = None):
+    def _get_retriever_search_kwargs(self, search_params):
+        # QdrantVectorStore passes search_params through to query_points
+        return {'search_params': self._get_search_params(search_params)}
+
+    def resolve_search_params(self, search_params=None):
+        # None -> 'default' tier, a str -> that tier, a dict -> overrides on top of the default tier
+        if search_params is None:
+            search_params = 'default'
+        if isinstance(search_params, str):
+            if search_params not in self._search_tiers:
+                raise Exception(f"Unknown search tier {search_params}, known: {sorted(self._search_tiers)}")
+            return dict(self._search_tiers[search_params])
+        unknown = set(search_params) - {'hnsw_ef', 'exact', 'rescore', 'oversampling'}
+        if unknown:
+            raise Exception(f"Unknown search params {sorted(unknown)}")
+        return {**self._search_tiers['default'], **search_params}
+
+    def _get_search_params(self, search_params=None):
+        params = self.resolve_search_params(search_params)
+        quantization = None
+        if self._quantization is not None:
+            quantization = models.QuantizationSearchParams(
+                ignore=False,
+                rescore=params.get('rescore'),
+                oversampling=params.get('oversampling'),
+            )
+        return models.SearchParams(hnsw_ef=params.get('hnsw_ef'), exact=params.get('exact', False), quantization=quantization)
+
+    def _partition_name(self, category):
+        return f'{self._collection_name}__' + re.sub(r'[^A-Za-z0-9_-]', '_', str(category))
+
+    def _list_partitions(self, refresh=False):
+        if self._partitions is None or refresh:
+            prefix = f'{self._collection_name}__'
+            self._partitions = {c.name for c in self._client.get_collections().collections if c.name.startswith(prefix)}
+        return self._partitions
+
+    def _get_collections(self, categories=None):
+        if self._partitioning != 'collections':
+            return [self._collection_name]
+        partitions = self._list_partitions()
         if categories is None:
-            return super().find_splits(query=query, limit=limit)
-
-        return self._vector_store.similarity_search_with_score(query=query, k=limit,
-                                                               filter={
-                                                                   'must': [
-                                                                       {
-                                                                           'key': 'metadata.loaded_category',
-                                                                           'match': {'any': categories},
-                                                                       },
-                                                                   ],
-                                                                }
-                                                               )
-
-    def setup_index(self):
-        self._client.create_payload_index(
-            collection_name=self._collection_name,
-            field_name='metadata.category',
-            field_schema=models.PayloadSchemaType.KEYWORD,
-            wait=True
-        )
+            return sorted(partitions)
+        return sorted({self._partition_name(c) for c in categories} & partitions)
+
+    def _get_filter(self, categories):
+        # Partition collections already hold a single category
+        if categories is None or self._partitioning == 'collections':
+            return None
+        return models.Filter(must=[
+            models.FieldCondition(key='metadata.loaded_category', match=models.MatchAny(any=list(categories))),
+        ])
+
+    @staticmethod
+    def _point_to_document(point):
+        payload = point.payload or {}
+        return Document(id=str(point.id), page_content=payload.get('page_content', ''), metadata=payload.get('metadata') or {})
 
-    def setup_collection(self):
-        if self._client.collection_exists(self._collection_name):
-            self._client.delete_collection(self._collection_name)
+    def _route(self, vectors, limits, categories, search_params=None, with_vectors=False):
+        # collection -> [(query index, QueryRequest)]
+        limits = self._per_query(limits, len(vectors))
+        categories = categories or [None] * len(vectors)
+        params = self._get_search_params(search_params)
+        routes = {}
+        for i, (v, l, c) in enumerate(zip(vectors, limits, categories)):
+            request = models.QueryRequest(query=list(v), limit=l, filter=self._get_filter(c), params=params, with_payload=True,
+                                          with_vector=with_vectors)
+            for collection in self._get_collections(c):
+                routes.setdefault(collection, []).append((i, request))
+        return routes, limits
 
-        vector_dim = self.get_embedder()._client.get_sentence_embedding_dimension()
+    def _merge(self, routes, responses, limits, with_vectors=False):
+        # Cosine and dot scores are similarities, euclid and manhattan are distances
+        higher_is_better = self._space in ('cosine', 'dot')
+        points = [[] for _ in limits]
+        for (collection, requests), collection_responses in zip(routes.items(), responses):
+            for (i, _), response in zip(requests, collection_responses):
+                points[i].extend(response.points)
+        results = []
+        for query_points, limit in zip(points, limits):
+            query_points = sorted(query_points, key=lambda p: p.score, reverse=higher_is_better)[:limit]
+            result = [(self._point_to_document(point), point.score) for point in query_points]
+            if with_vectors:
+                result = (result, np.asarray([point.vector for point in query_points], dtype=np.float32))
+            results.append(result)
+        return results
 
-        print(f"Prepare collection {self._collection_name} with size {vector_dim}")
+    def _get_executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='qdrant-fanout')
+        return self._executor
 
+    def _query_batch(self, vectors, limits, categories, search_params, with_vectors=False):
+        routes, limits = self._route(vectors, limits, categories, search_params, with_vectors=with_vectors)
+
+        def _query(item):
+            collection, requests = item
+            return self._client.query_batch_points(collection_name=collection, requests=[r for _, r in requests])
+
+        if len(routes) <= 1:
+            responses = [_query(item) for item in routes.items()]
+        else:
+            responses = list(self._get_executor().map(_query, routes.items()))
+        return self._merge(routes, responses, limits, with_vectors=with_vectors)
+
+    async def _aquery_batch(self, vectors, limits, categories, search_params, with_vectors=False):
+        routes, limits = self._route(vectors, limits, categories, search_params, with_vectors=with_vectors)
+        responses = await asyncio.gather(*[
+            self._async_client.query_batch_points(collection_name=collection, requests=[r for _, r in requests])
+            for collection, requests in routes.items()
+        ])
+        return self._merge(routes, responses, limits, with_vectors=with_vectors)
+
+    def find_splits_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return self._query_batch(vectors, limits, categories, search_params)
+
+    def find_candidates_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return self._query_batch(vectors, limits, categories, search_params, with_vectors=True)
+
+    async def afind_splits_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        if self._async_client is None:
+            return await super().afind_splits_batch_by_vectors(vectors, limits=limits, categories=categories,
+                                                               search_params=search_params)
+        return await self._aquery_batch(vectors, limits, categories, search_params)
+
+    async def afind_candidates_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        if self._async_client is None:
+            return await super().afind_candidates_batch_by_vectors(vectors, limits=limits, categories=categories,
+                                                                   search_params=search_params)
+        return await self._aquery_batch(vectors, limits, categories, search_params, with_vectors=True)
+
+    def find_splits_by_vector(self, vector: list[float], limit: int=100, categories: list[str] = None, search_params=None):
+        return self.find_splits_batch_by_vectors([vector], limits=limit, categories=[categories], search_params=search_params)[0]
+
+    async def afind_splits_by_vector(self, vector: list[float], limit: int=100, categories: list[str] = None,
+                                     search_params=None):
+        return (await self.afind_splits_batch_by_vectors([vector], limits=limit, categories=[categories],
+                                                         search_params=search_params))[0]
+
+    def iter_splits(self, batch_size=1024):
+        for collection in self._get_collections():
+            offset = None
+            while True:
+                points, offset = self._client.scroll(collection_name=collection, limit=batch_size, offset=offset,
+                                                     with_payload=True, with_vectors=False)
+                yield from (self._point_to_document(point) for point in points)
+                if offset is None:
+                    break
+
+    def iter_rows(self, batch_size=1024):
+        for collection in self._get_collections():
+            offset = None
+            while True:
+                points, offset = self._client.scroll(collection_name=collection, limit=batch_size, offset=offset,
+                                                     with_payload=True, with_vectors=True)
+                if points:
+                    yield ([self._point_to_document(point) for point in points],
+                           np.asarray([point.vector for point in points], dtype=np.float32),
+                           [str(point.id) for point in points])
+                if offset is None:
+                    break
+
+    def count(self):
+        return sum(self._client.count(collection_name=collection, exact=True).count for collection in self._get_collections())
+
+    def get_splits_by_ids(self, ids):
+        docs = []
+        for collection in self._get_collections():
+            points = self._client.retrieve(collection_name=collection, ids=list(ids), with_payload=True)
+            docs.extend(self._point_to_document(point) for point in points)
+        return docs
+
+    def store_splits(self, splits, ids=None):
+        vectors = self._embedder.embed_documents([s.page_content for s in splits])
+        self.write_vectors(splits, vectors, ids=ids)
+
+    def delete_splits(self, ids):
+        for collection in self._get_collections():
+            self._client.delete(collection_name=collection, points_selector=models.PointIdsList(points=list(ids)), wait=True)
+
+    def write_vectors(self, splits, vectors, ids=None):
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in splits]
+        # Same payload layout as QdrantVectorStore, so langchain search keeps working
+        points = {}
+        for s, vector, cid in zip(splits, vectors, ids):
+            collection = self._collection_name
+            if self._partitioning == 'collections':
+                collection = self._partition_name(s.metadata.get('loaded_category'))
+            points.setdefault(collection, []).append(
+                models.PointStruct(id=cid, vector=list(vector), payload={'page_content': s.page_content, 'metadata': s.metadata}))
+
+        for collection, collection_points in points.items():
+            if self._partitioning == 'collections' and collection not in self._list_partitions():
+                with self._lock:
+                    if collection not in self._list_partitions(refresh=True):
+                        self._create_collection(collection, len(collection_points[0].vector))
+                        self._list_partitions(refresh=True)
+            # qdrant-client starts a process pool for parallel > 1, only worth it when the call spans several
+            # upload batches; the ingestion pipeline's writer threads already upload concurrently
+            batches = -(-len(collection_points) // self._upload_batch_size)
+            self._client.upload_points(
+                collection_name=collection,
+                points=collection_points,
+                batch_size=self._upload_batch_size,
+                parallel=max(1, min(self._upload_parallel, batches)),
+                wait=True,
+            )
+
+    def drop(self):
+        for collection in self._get_collections():
+            self._client.delete_collection(collection)
+        self._partitions = None
+
+    def get_collection_stats(self):
+        # points and indexed vectors summed over the collections of the store
+        stats = {'points': 0, 'indexed_vectors': 0, 'segments': 0}
+        for collection in self._get_collections():
+            info = self._client.get_collection(collection)
+            stats['points'] += info.points_count or 0
+            stats['indexed_vectors'] += info.indexed_vectors_count or 0
+            stats['segments'] += info.segments_count or 0
+        return stats
+
+    def get_collection_names(self):
+        return self._get_collections()
+
+    def setup_index(self, collection=None):
+        collection = collection or self._collection_name
+        category_schema = models.PayloadSchemaType.KEYWORD
+        if self._partitioning == 'tenant':
+            category_schema = models.KeywordIndexParams(type=models.KeywordIndexType.KEYWORD, is_tenant=True)
+        indexes = {
+            'metadata.loaded_category': category_schema,
+            'metadata.source': models.PayloadSchemaType.KEYWORD,
+            # authors are stored as one ';' separated string
+            'metadata.loaded_authors': models.TextIndexParams(type=models.TextIndexType.TEXT,
+                                                             tokenizer=models.TokenizerType.WORD, lowercase=True),
+        }
+        for field_name, field_schema in indexes.items():
+            self._client.create_payload_index(
+                collection_name=collection,
+                field_name=field_name,
+                field_schema=field_schema,
+                wait=True
+            )
+
+    def _create_collection(self, collection, vector_dim):
+        print(f"Prepare collection {collection} with size {vector_dim}")
+
+        optimizers_config = None
+        if self._bulk_load is not None:
+            # no HNSW building and no quantization while the points stream in, few large segments
+            optimizers_config = models.OptimizersConfigDiff(indexing_threshold=0, **self._bulk_load['optimizers'])
         self._client.create_collection(
-            collection_name=self._collection_name,
+            collection_name=collection,
             vectors_config=VectorParams(
                 size=vector_dim,
                 distance=self._get_distance()
-            )
+            ),
+            optimizers_config=optimizers_config,
         )
 
-        self.setup_index()
+        # payload indexes are cheap to fill during upload and the tenant layout needs them before HNSW
+        self.setup_index(collection)
+
+        if self._bulk_load is None:
+            self._enable_index(collection)
 
+    def _enable_index(self, collection, indexing_threshold=None):
+        # HNSW and quantization in one update; after a bulk load it also turns indexing back on
         self._client.update_collection(
-            collection_name=self._collection_name,
+            collection_name=collection,
             hnsw_config=HnswConfigDiff(
                 m=self._M,
                 ef_construct=self._construction_ef,
-            )
+                # builds additional per-category links, so filtered queries stay on the graph
+                payload_m=self._M if self._partitioning == 'tenant' else None,
+            ),
+            quantization_config=self._get_quantization_config(),
+            optimizers_config=models.OptimizersConfigDiff(indexing_threshold=indexing_threshold)
+            if indexing_threshold is not None else None,
         )
 
-        self._client.update_collection(
-            collection_name=self._collection_name,
-            quantization_config=models.ScalarQuantization(
+    def _wait_green(self, collection, timeout=3600.0, poll=1.0):
+        # The optimizer may not have picked the update up yet, so wait one poll before trusting GREEN
+        deadline = time.time() + timeout
+        time.sleep(poll)
+        while True:
+            info = self._client.get_collection(collection)
+            if info.status == models.CollectionStatus.GREEN:
+                return info
+            if info.status == models.CollectionStatus.RED:
+                raise Exception(f"Collection {collection} is red: {info.optimizer_status}")
+            if time.time() > deadline:
+                raise Exception(f"Collection {collection} is not green after {timeout} seconds")
+            time.sleep(poll)
+
+    def _recover_deferred_index(self, collection):
+        # indexing_threshold=0 is only set by a bulk load, finding it here means the load stopped before
+        # finish_bulk_load(); without this the collection would stay unindexed (and unquantized) for good
+        info = self._client.get_collection(collection)
+        if info.config.optimizer_config.indexing_threshold == 0:
+            print(f"Collection {collection} has indexing deferred by an interrupted bulk load, enabling it")
+            self._enable_index(collection, indexing_threshold=self._INDEXING_THRESHOLD)
+            self._wait_green(collection)
+
+    def begin_bulk_load(self, default_segment_number=2, max_segment_size=None, indexing_threshold=_INDEXING_THRESHOLD):
+        # Recreates the collection with indexing deferred; write points, then finish_bulk_load()
+        self._bulk_load = {
+            'started': time.time(),
+            'optimizers': {'default_segment_number': default_segment_number, 'max_segment_size': max_segment_size},
+            'indexing_threshold': indexing_threshold,
+        }
+        self.setup_collection(recreate=True)
+        self._bulk_load['loading'] = time.time()
+        return True
+
+    def _finish_bulk_load(self, bulk):
+        start = time.time()
+        collections = self._get_collections() if self._partitioning == 'collections' else [self._collection_name]
+        for collection in collections:
+            self._enable_index(collection, indexing_threshold=bulk['indexing_threshold'])
+        for collection in collections:
+            info = self._wait_green(collection)
+            print(f"Collection {collection}: {info.points_count} points, {info.indexed_vectors_count} indexed vectors")
+        return time.time() - start
+
+    def _get_quantization_config(self):
+        if self._quantization == 'scalar':
+            return models.ScalarQuantization(
                 scalar=models.ScalarQuantizationConfig(
                     type=models.ScalarType.INT8,
                     quantile=0.99,
                     always_ram=True,
                 )
             )
-        )
+        if self._quantization == 'binary':
+            return models.BinaryQuantization(binary=models.BinaryQuantizationConfig(always_ram=True))
+        return None
+
+    def setup_collection(self, recreate=True):
+        existing = self._get_collections() if self._partitioning == 'collections' else \
+            [c for c in [self._collection_name] if self._client.collection_exists(c)]
+        if existing:
+            if not recreate:
+                # Older collections may miss some payload indexes, creating them again is a no-op otherwise
+                for collection in existing:
+                    self.setup_index(collection)
+                    self._recover_deferred_index(collection)
+                return False
+            for collection in existing:
+                self._client.delete_collection(collection)
+
+        if self._partitioning == 'collections':
+            # partitions are created on first write, once their category shows up
+            self._list_partitions(refresh=True)
+        else:
+            self._create_collection(self._collection_name, self._get_vector_dim())
+
+        return True
+
+
+class NumpyStore(VectorStore):
+    # Exact search over one contiguous memory-mapped float32 matrix.
+    # Files are append-only: vectors.bin holds the rows, docs.jsonl the split texts,
+    # index.jsonl one record per row (or per deletion) so startup does not touch the texts.
+    def __init__(self, embedder, space='cosine', path=None):
+        if space not in ('cosine', 'dot', 'euclid'):
+            raise Exception("Space must be one of 'cosine', 'dot', 'euclid'")
+        super().__init__(embedder=embedder, space=space, construction_ef=0, M=0, search_ef=0)
+        self._name = f'numpy_{space}'
+        self._path = path or f'../{self._name}/'
+        os.makedirs(self._path, exist_ok=True)
+        self._vectors_path = self._path + 'vectors.bin'
+        self._docs_path = self._path + 'docs.jsonl'
+        self._index_path = self._path + 'index.jsonl'
+        self._meta_path = self._path + 'meta.json'
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        self._dim = None
+        self._rows = 0
+        self._ids = []
+        self._offsets = []
+        self._id_rows = {}
+        self._row_categories = []
+        # Tombstones: deleted rows stay in the matrix and are masked out of unfiltered searches,
+        # `_alive` grows by doubling so appends do not copy it every batch
+        self._alive = np.ones(1024, dtype=bool)
+        self._dead = 0
+        # category -> rows appended under it (deleted ones are dropped lazily) and the cached live rows array
+        self._category_rows = {}
+        self._category_arrays = {}
+        self._matrix = None
+        self._sq_norms = None
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path, 'r') as f:
+                self._dim = json.load(f)['dim']
+        if os.path.exists(self._index_path):
+            with open(self._index_path, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # torn last line after a crash
+                        break
+                    self._apply_index_record(record)
+        # Drop vectors written by a batch whose index records never made it to disk
+        if self._dim is not None and os.path.exists(self._vectors_path):
+            size = self._rows * self._dim * np.dtype(np.float32).itemsize
+            if os.path.getsize(self._vectors_path) > size:
+                os.truncate(self._vectors_path, size)
+        self._remap()
+        print(f"Numpy store {self._path}: {len(self._id_rows)} vectors")
+
+    def _apply_index_record(self, record):
+        # O(1) per record: the tombstone mask and the category index are updated in place
+        old_row = self._id_rows.pop(record['id'], None)
+        if old_row is not None:
+            self._ids[old_row] = None
+            self._alive[old_row] = False
+            self._dead += 1
+            self._category_arrays.pop(self._row_categories[old_row], None)
+        if record.get('deleted'):
+            return
+        row = record['row']
+        if row >= len(self._alive):
+            self._alive = np.concatenate([self._alive, np.ones(max(row + 1, 2 * len(self._alive)) - len(self._alive),
+                                                               dtype=bool)])
+        category = record.get('category')
+        self._id_rows[record['id']] = row
+        self._ids.append(record['id'])
+        self._offsets.append(record['offset'])
+        self._row_categories.append(category)
+        self._category_rows.setdefault(category, []).append(row)
+        self._category_arrays.pop(category, None)
+        self._rows = row + 1
+
+    def _remap(self):
+        # The memory map only needs to grow with the appended rows, the per-row state is kept incrementally
+        self._matrix = None
+        if self._rows > 0:
+            self._matrix = np.memmap(self._vectors_path, dtype=np.float32, mode='r', shape=(self._rows, self._dim))
+        self._sq_norms = None
+
+    def _get_sq_norms(self, matrix):
+        # euclid only, computed outside the lock on the first search after a write and kept while `matrix` is current
+        with self._lock:
+            if self._matrix is matrix and self._sq_norms is not None:
+                return self._sq_norms
+        sq_norms = np.einsum('ij,ij->i', matrix, matrix)
+        with self._lock:
+            if self._matrix is matrix:
+                self._sq_norms = sq_norms
+        return sq_norms
+
+    def _category_array(self, category):
+        rows = self._category_arrays.get(category)
+        if rows is None:
+            rows = np.asarray(self._category_rows[category], dtype=np.int64)
+            live = rows[self._alive[rows]]
+            if len(live) < len(rows):
+                # lazy compaction of the category list, deleted rows are dropped once
+                self._category_rows[category] = live.tolist()
+            rows = self._category_arrays[category] = live
+        return rows
+
+    def setup_collection(self, recreate=True):
+        with self._lock:
+            if recreate:
+                for path in (self._vectors_path, self._docs_path, self._index_path, self._meta_path):
+                    if os.path.exists(path):
+                        os.remove(path)
+                self._load()
+            return len(self._id_rows) == 0
+
+    def count(self):
+        return len(self._id_rows)
+
+    def get_dim(self):
+        return self._dim
+
+    def get_ids(self, rows):
+        return [self._ids[row] for row in rows]
+
+    def get_rows(self):
+        with self._lock:
+            return np.flatnonzero(self._alive[:self._rows]) if self._dead else np.arange(self._rows)
+
+    def iter_splits(self, batch_size=1024):
+        for splits, _, _ in self.iter_rows(batch_size=batch_size):
+            yield from splits
+
+    def get_splits_by_ids(self, ids):
+        with self._lock:
+            rows = [self._id_rows[cid] for cid in ids if cid in self._id_rows]
+        return self.get_documents(rows)
+
+    def iter_rows(self, batch_size=1024):
+        # Yields (splits, vectors, ids) of live rows, used to copy vectors into other stores
+        with self._lock:
+            matrix = self._matrix
+        rows = self.get_rows()
+        for i in range(0, len(rows), batch_size):
+            batch = rows[i:i + batch_size]
+            yield self.get_documents(batch), np.asarray(matrix[batch]), self.get_ids(batch)
+
+    def store_splits(self, splits, ids=None):
+        vectors = self._embedder.embed_documents([s.page_content for s in splits])
+        self.write_vectors(splits, vectors, ids=ids)
+
+    def _append_index(self, records):
+        with open(self._index_path, 'a') as f:
+            for record in records:
+                f.write(json.dumps(record) + '\n')
+
+    def delete_splits(self, ids):
+        with self._lock:
+            records = [{'id': cid, 'deleted': True} for cid in ids if cid in self._id_rows]
+            self._append_index(records)
+            for record in records:
+                self._apply_index_record(record)
+
+    def write_vectors(self, splits, vectors, ids=None):
+        if ids is None:
+            ids = [str(uuid.uuid4()) for _ in splits]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if self._space == 'cosine':
+            vectors = vectors / np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+
+        with self._lock:
+            if self._dim is None:
+                self._dim = int(vectors.shape[1])
+                with open(self._meta_path, 'w') as f:
+                    json.dump({'dim': self._dim, 'space': self._space}, f)
+
+            records = []
+            with open(self._docs_path, 'ab') as f:
+                for i, (split, cid) in enumerate(zip(splits, ids)):
+                    records.append({'id': cid, 'row': self._rows + i, 'offset': f.tell(),
+                                    'category': split.metadata.get('loaded_category')})
+                    f.write((json.dumps({'page_content': split.page_content, 'metadata': split.metadata}) + '\n').encode('utf-8'))
+            # Vectors before the index, so every indexed row is backed by data
+            with open(self._vectors_path, 'ab') as f:
+                f.write(vectors.tobytes())
+            self._append_index(records)
+            for record in records:
+                self._apply_index_record(record)
+            self._remap()
+
+    def get_documents(self, rows):
+        docs = []
+        with open(self._docs_path, 'rb') as f:
+            for row in rows:
+                f.seek(self._offsets[row])
+                data = json.loads(f.readline())
+                docs.append(Document(id=self._ids[row], page_content=data['page_content'], metadata=data['metadata']))
+        return docs
+
+    def _candidate_rows(self, categories):
+        # None = every row; deleted rows are masked in search_rows instead of copying the live part of the matrix
+        if categories is None:
+            return None
+        rows = [self._category_array(c) for c in categories if c in self._category_rows]
+        if not rows:
+            return np.empty(0, dtype=np.int64)
+        return np.sort(np.concatenate(rows))
+
+    def _scores(self, queries, matrix, rows):
+        # matrix: the full memory map, rows: the candidate rows or None for all of them
+        scores = queries @ (matrix if rows is None else matrix[rows]).T
+        if self._space == 'euclid':
+            sq_norms = self._get_sq_norms(matrix) if rows is None else self._get_sq_norms(matrix)[rows]
+            # Negative squared distance, so larger is better for every space
+            scores = 2 * scores - sq_norms[None, :] - np.einsum('ij,ij->i', queries, queries)[:, None]
+        return scores
+
+    def _to_result_score(self, score):
+        if self._space == 'euclid':
+            return float(np.sqrt(max(-score, 0.0)))
+        return float(score)
+
+    def search_rows(self, vectors, limit: int=100, categories: list[str] = None):
+        # Returns (rows, scores) arrays of shape (n_queries, k), best first
+        queries = np.atleast_2d(np.asarray(vectors, dtype=np.float32))
+        if self._space == 'cosine':
+            queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+
+        # Only a snapshot is taken under the lock, the search itself runs unlocked: the matrix is append-only
+        # (a write maps a new, longer view), cached category arrays are replaced rather than modified and the
+        # dead mask is a copy
+        with self._lock:
+            if self._matrix is None:
+                return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+            matrix = self._matrix
+            rows = self._candidate_rows(categories)
+            dead = ~self._alive[:len(matrix)] if rows is None and self._dead else None
+
+        scores = self._scores(queries, matrix, rows)
+        available = scores.shape[1]
+        if dead is not None:
+            scores[:, dead] = -np.inf
+            available -= int(dead.sum())
+
+        k = min(limit, available)
+        if k == 0:
+            return np.empty((len(queries), 0), dtype=np.int64), np.empty((len(queries), 0), dtype=np.float32)
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        top = np.take_along_axis(top, order, axis=1)
+        top_scores = np.take_along_axis(top_scores, order, axis=1)
+        if rows is not None:
+            top = rows[top]
+        return top, top_scores
+
+    def _query_batch(self, vectors, limits, categories, with_vectors=False):
+        vectors = np.asarray(vectors, dtype=np.float32)
+        limits = self._per_query(limits, len(vectors))
+        results = [None] * len(vectors)
+        for group, indexes in self._group_by_categories(categories or [None] * len(vectors)).items():
+            rows, scores = self.search_rows(vectors[indexes], limit=max(limits[i] for i in indexes),
+                                            categories=None if group is None else list(group))
+            # taken after the search: the matrix only grows, so it covers every row the search returned
+            with self._lock:
+                matrix = self._matrix
+            for query_rows, query_scores, i in zip(rows, scores, indexes):
+                query_rows = query_rows[:limits[i]]
+                docs = self.get_documents(query_rows)
+                results[i] = [(doc, self._to_result_score(score)) for doc, score in zip(docs, query_scores)]
+                if with_vectors:
+                    results[i] = (results[i], np.asarray(matrix[query_rows]) if len(query_rows)
+                                  else np.empty((0, self._dim or 0), dtype=np.float32))
+        return results
+
+    def find_splits_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return self._query_batch(vectors, limits, categories)
+
+    def find_candidates_batch_by_vectors(self, vectors, limits=100, categories: list = None, search_params=None):
+        return self._query_batch(vectors, limits, categories, with_vectors=True)
+
+    def find_splits_by_vector(self, vector: list[float], limit: int=100, categories: list[str] = None, search_params=None):
+        return self.find_splits_batch_by_vectors([vector], limits=limit, categories=[categories])[0]
+
+    def get_retriever(self, limit: int=100, fetch_limit: int=100, search_type: str='similarity', search_params=None,
+                      lambda_mult=0.5):
+        if search_type == 'mmr':
+            return self._get_mmr_retriever(limit, fetch_limit, lambda_mult, search_params)
+        if search_type != 'similarity':
+            raise Exception("NumpyStore supports only 'similarity' and 'mmr' retrievers")
+        return RunnableLambda(lambda query: [doc for doc, _ in self.find_splits(query, limit=limit)])
+
+
+class _StageStats:
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.batches = 0
+        self.busy = 0.0
+        self.wait = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, items, busy, wait):
+        with self._lock:
+            self.items += items
+            self.batches += 1
+            self.busy += busy
+            self.wait += wait
+
+    def to_dict(self, wall):
+        return {
+            'items': self.items,
+            'batches': self.batches,
+            'busy_seconds': self.busy,
+            'wait_seconds': self.wait,
+            'items_per_busy_second': self.items / self.busy if self.busy > 0 else 0.0,
+            'items_per_second': self.items / wall if wall > 0 else 0.0,
+        }
+
+
+class IngestionPipeline:
+    # put() -> [input queue] -> embed thread -> [bounded queue] -> writer threads -> store.write_vectors()
+    # on_written(items) is called from writer threads with the (split, id, tag) tuples that were stored.
+    def __init__(self, store, embed_batch_size=256, write_batch_size=256, write_workers=2, queue_size=4, on_written=None):
+        self._store = store
+        self._embed_batch_size = embed_batch_size
+        self._write_batch_size = write_batch_size
+        self._write_workers = write_workers
+        self._on_written = on_written
+
+        self._input = queue.Queue(maxsize=embed_batch_size * queue_size)
+        self._embedded = queue.Queue(maxsize=queue_size)
+        self._threads = []
+        self._error = None
+        self._started = None
+        self._finished = None
+        self._embed_stats = _StageStats('embed')
+        self._write_stats = _StageStats('write')
+
+    def start(self):
+        self._started = time.time()
+        self._threads = [threading.Thread(target=self._embed_loop, name='ingest-embed', daemon=True)]
+        self._threads += [
+            threading.Thread(target=self._write_loop, name=f'ingest-write-{i}', daemon=True)
+            for i in range(self._write_workers)
+        ]
+        for t in self._threads:
+            t.start()
+        return self
+
+    def put(self, split, id=None, tag=None):
+        self._raise_if_failed()
+        self._input.put((split, id, tag))
+
+    def close(self):
+        self._input.put(None)
+        for t in self._threads:
+            t.join()
+        self._finished = time.time()
+        self._raise_if_failed()
+        return self.get_stats()
+
+    def run(self, items):
+        self.start()
+        for split, id, tag in items:
+            self.put(split, id, tag)
+        return self.close()
+
+    def get_stats(self):
+        wall = (self._finished or time.time()) - self._started
+        return {
+            'wall_seconds': wall,
+            'embed': self._embed_stats.to_dict(wall),
+            'write': self._write_stats.to_dict(wall),
+        }
+
+    def print_stats(self):
+        stats = self.get_stats()
+        print(f"Ingestion took {stats['wall_seconds']:.1f} seconds")
+        for stage in ('embed', 'write'):
+            s = stats[stage]
+            print(f"  {stage}: {s['items']} items in {s['batches']} batches, busy {s['busy_seconds']:.1f}s, "
+                  f"waiting {s['wait_seconds']:.1f}s, {s['items_per_busy_second']:.1f} items/s busy, "
+                  f"{s['items_per_second']:.1f} items/s overall")
+
+    def _raise_if_failed(self):
+        if self._error is not None:
+            raise RuntimeError("Ingestion pipeline failed") from self._error
+
+    def _embed_batch(self, batch, wait):
+        start = time.time()
+        EMBEDDING_BATCH_SIZE.observe(len(batch), path='ingest')
+        vectors = self._store.get_embedder().embed_documents([split.page_content for split, _, _ in batch])
+        busy = time.time() - start
+        self._embed_stats.add(len(batch), busy, wait)
+        # Blocks when writers fall behind, which bounds memory held by the pipeline
+        self._embedded.put((batch, vectors))
+
+    def _embed_loop(self):
+        batch = []
+        wait = 0.0
+        try:
+            while True:
+                start = time.time()
+                item = self._input.get()
+                wait += time.time() - start
+                if item is None:
+                    break
+                batch.append(item)
+                if len(batch) >= self._embed_batch_size:
+                    self._embed_batch(batch, wait)
+                    batch = []
+                    wait = 0.0
+            if batch:
+                self._embed_batch(batch, wait)
+        except Exception as e:
+            self._error = e
+            # Keep draining so producers blocked on put() can notice the failure
+            while self._input.get() is not None:
+                pass
+        finally:
+            for _ in range(self._write_workers):
+                self._embedded.put(None)
+
+    def _write_loop(self):
+        while True:
+            start = time.time()
+            item = self._embedded.get()
+            wait = time.time() - start
+            if item is None:
+                return
+            if self._error is not None:
+                continue
 
+            batch, vectors = item
+            try:
+                for i in range(0, len(batch), self._write_batch_size):
+                    part = batch[i:i + self._write_batch_size]
+                    start = time.time()
+                    self._store.write_vectors([split for split, _, _ in part], vectors[i:i + self._write_batch_size],
+                                              ids=[id for _, id, _ in part] if part[0][1] is not None else None)
+                    self._write_stats.add(len(part), time.time() - start, wait)
+                    wait = 0.0
+                    if self._on_written is not None:
+                        self._on_written(part)
+            except Exception as e:
+                self._error = e
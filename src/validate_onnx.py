@@ -0,0 +1,107 @@
+import argparse
+import random
+import time
+
+import dotenv
+import numpy as np
+
+from rag.benchmark import ground_truth, load_queries, recall_at_k, sample_queries, write_report
+from rag.embedder import Embedder
+from rag.vector_store import NumpyStore
+
+dotenv.load_dotenv('../.env')
+
+
+def _embed_timed(embedder, texts):
+    start = time.perf_counter()
+    vectors = np.asarray(embedder.get_model().embed_documents(texts), dtype=np.float32)
+    return vectors, time.perf_counter() - start
+
+
+def _cosines(a, b):
+    return (a * b).sum(axis=1) / np.maximum(np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1), 1e-12)
+
+
+def _cosine_summary(prefix, cosines):
+    return {
+        f'{prefix}_cosine_mean': float(cosines.mean()),
+        f'{prefix}_cosine_p1': float(np.percentile(cosines, 1)),
+        f'{prefix}_cosine_min': float(cosines.min()),
+    }
+
+
+def _top_k(queries, docs, k):
+    scores = queries @ docs.T
+    top = np.argpartition(-scores, min(k, scores.shape[1] - 1), axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1).tolist()
+
+
+def _mean_recall(found, truth, k):
+    return float(np.mean([recall_at_k(f, t, k) for f, t in zip(found, truth)]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ONNX embedding backend with the fp32 torch model: '
+                                                 'cosine agreement, retrieval recall and throughput')
+    parser.add_argument('--model', default='BAAI/bge-m3')
+    parser.add_argument('--onnx-path', default=None, help='exported model directory, exported on first use if missing')
+    parser.add_argument('--no-quantize', action='store_true', help='validate the fp32 ONNX export instead of int8')
+    parser.add_argument('--threads', type=int, default=None, help='ONNX Runtime intra-op threads')
+    parser.add_argument('--exact-path', default=None, help='NumpyStore directory with the corpus (fp32 vectors)')
+    parser.add_argument('--docs', type=int, default=2000, help='corpus chunks re-embedded by both backends')
+    parser.add_argument('--queries', help='file with queries (one per line or JSONL with "query"), sampled from the corpus if omitted')
+    parser.add_argument('--sample', type=int, default=200)
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--output', default='../bench/onnx')
+    args = parser.parse_args()
+
+    # no caches: both backends must really run every text
+    reference = Embedder(model=args.model, query_cache_size=0)
+    candidate = Embedder(model=args.model, query_cache_size=0, backend='onnx', onnx_path=args.onnx_path,
+                         onnx_quantize=not args.no_quantize, threads_per_worker=args.threads)
+    exact_store = NumpyStore(embedder=reference.get_model(), path=args.exact_path)
+
+    queries = load_queries(args.queries) if args.queries else sample_queries(exact_store, n=args.sample)
+    rows = [int(row) for row in exact_store.get_rows()]
+    rows = random.Random(42).sample(rows, min(args.docs, len(rows)))
+    docs = [doc.page_content for doc in exact_store.get_documents(rows)]
+    print(f"{len(queries)} queries, {len(docs)} chunks")
+
+    # warm up both sessions so the first batch does not count model loading
+    reference.get_model().embed_documents(docs[:8])
+    candidate.get_model().embed_documents(docs[:8])
+    reference_docs, reference_seconds = _embed_timed(reference, docs)
+    candidate_docs, candidate_seconds = _embed_timed(candidate, docs)
+    reference_queries, _ = _embed_timed(reference, queries)
+    candidate_queries, _ = _embed_timed(candidate, queries)
+
+    k = args.k
+    truth = _top_k(reference_queries, reference_docs, k)
+    # the full store answers with its fp32 vectors, as it would after switching only the query side
+    store_truth = ground_truth(exact_store, reference_queries.tolist(), k)
+    store_found = ground_truth(exact_store, candidate_queries.tolist(), k)
+
+    row = {
+        'model': args.model,
+        'backend': 'onnx-fp32' if args.no_quantize else 'onnx-int8',
+        'docs': len(docs),
+        'queries': len(queries),
+        **_cosine_summary('doc', _cosines(reference_docs, candidate_docs)),
+        **_cosine_summary('query', _cosines(reference_queries, candidate_queries)),
+        # both sides re-embedded by the candidate: a store rebuilt with it
+        f'recall@{k}_rebuilt': _mean_recall(_top_k(candidate_queries, candidate_docs, k), truth, k),
+        # candidate queries against fp32 document vectors: an existing store, only queries switched
+        f'recall@{k}_mixed': _mean_recall(_top_k(candidate_queries, reference_docs, k), truth, k),
+        f'recall@{k}_store': _mean_recall(store_found, store_truth, k),
+        'torch_docs_per_second': len(docs) / reference_seconds,
+        'onnx_docs_per_second': len(docs) / candidate_seconds,
+        'speedup': reference_seconds / candidate_seconds,
+    }
+    for key, value in row.items():
+        print(f"{key}: {value:.4f}" if isinstance(value, float) else f"{key}: {value}")
+    write_report([row], args.output)
+
+
+if __name__ == "__main__":
+    main()